@@ -1,6 +1,17 @@
+import binascii
 import collections
+import fnmatch
+import hashlib
+import json
 import os
 from Queue import Queue
+import select
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+import zlib
 
 from utils import *
 
@@ -24,13 +35,20 @@ cmd formats between FileClient and FileServer:
 
 [client] cmd: exit
 
+// When a cmd fails in the server, the server skips its remaining items and
+// reports the error before the items of later cmds. The reply of the failed
+// cmd isn't sent.
+[server] server_error: cmd error_msg
+
 [client] cmd: send_file
 [client] local: local_path
 [client] remote: remote_path
 [client] file_type: a, b, c  # valild types: executable
-// Split to 4K per line
+// Split to 4K per line, holes and zero blocks are sent as skip. local is - when
+// data is read from a pipe, the size is only known at data_end.
 [client] data: data in hex format
 [client] data: data in hex format
+[client] skip: hole_size
 ...
 [client] data_end: data_size
 
@@ -38,8 +56,9 @@ cmd formats between FileClient and FileServer:
 [client] remote: remote_path
 [client] local: local_path
 [server] file_type: a, b, c # valid types: executable
-// Split to 4K per line
+// Split to 4K per line, holes and zero blocks are sent as skip.
 [server] data: data in hex format
+[server] skip: hole_size
 [server] data_end: data_size
 
 [client] cmd: mkdir
@@ -64,13 +83,275 @@ cmd formats between FileClient and FileServer:
 [client] local: local_path
 [server] link: link
 
+[client] cmd: stat
+[client] path: path
+[server] type: file or dir or not_exist
+[server] size: size
+[server] mtime: mtime
+[server] hash: sha256 of file data
+
+// Only changed blocks are sent, each block is an offset followed by its data.
+[client] cmd: send_file_delta
+[client] remote: remote_path
+[client] base_hash: sha256 of the remote file the delta is based on
+[client] offset: offset
+[client] data: data in hex format
+...
+[client] data_end: new file size
+[server] result: ok or base_mismatch
+
+// Used when the client has a content store, data is only sent when the client
+// doesn't have the hash in its store.
+[client] cmd: recv_file_by_hash
+[client] remote: remote_path
+[client] local: local_path
+[server] file_type: a, b, c # valid types: executable
+[server] hash: sha256 of file data
+[client] need_data: yes or no
+[server] data: data in hex format  # only when need_data is yes
+[server] data_end: data_size
+
+// Create remote_path from a file already sent, by hardlink or by copy.
+[client] cmd: link_file
+[client] remote: remote_path
+[client] target: remote_path of the file already sent
+[client] link_type: hardlink or copy
+[client] file_type: a, b, c # valid types: executable
+
+// Find files in a dir sharing inode or data with a file visited before in
+// os.walk order. Paths are relative to the dir.
+[client] cmd: find_duplicates
+[client] path: path
+[server] duplicate: path
+[server] original: path
+[server] link_type: hardlink or copy
+[server] file_type: a, b, c # valid types: executable
+...
+[server] duplicates_end: duplicate_count
+
+[client] cmd: tree_size
+[client] path: path
+[server] size: total size of regular files
+[server] files: regular file count
+
+[client] cmd: find_tools
+[client] names: a, b, c
+[server] tools: names of the executables found in PATH
+
+// Large dirs are sent as a tar stream compressed by zlib, if both ends have
+// tar. send_tar replaces remote_path like send_file, recv_tar extracts to the
+// local dir.
+[client] cmd: send_tar
+[client] remote: remote_path
+[client] data: data in hex format
+...
+[client] data_end: data_size
+[server] result: ok or error msg
+
+[client] cmd: recv_tar
+[client] remote: remote_path
+[server] data: data in hex format
+...
+[server] data_end: data_size
+[server] result: ok or error msg
+
+// Dirs with many small files ship a dictionary sampled from the files once,
+// then each small file is compressed by zlib primed with the dictionary.
+[client] cmd: set_compress_dict
+[client] data: dictionary compressed by zlib and sync flushed, in hex format
+...
+[client] data_end: data_size
+
+[client] cmd: send_small_file
+[client] remote: remote_path
+[client] file_type: file_type
+[client] size: file_size
+[client] data: file data compressed with the dictionary, in hex format
+
+// Run metadata ops in order, each op is a list of [op_name, args...]:
+//   ["mkdir", path], ["rmdir", path], ["path_type", path],
+//   ["send_link", remote_path, link], ["cd", path]
+// Each result is ["ok", value] or ["error", msg], value is the type for
+// path_type, otherwise empty. Strings are bytes decoded as latin-1, as paths
+// may not be utf-8. Results are split into items of at most 32K bytes, until
+// there is a result for each op.
+[client] cmd: batch
+[client] ops: json list of ops
+[server] results: json list of results
+...
+
+// Run a shell cmdline without a terminal, stdin is /dev/null. stdout and
+// stderr data are sent as they are read.
+[client] cmd: exec
+[client] cmdline: cmdline
+[server] stdout: stdout data in hex format  // or
+[server] stderr: stderr data in hex format
+...
+[server] exit_status: exit status, 128 + signal number if killed by a signal
+
+// Search files under path. In content mode, lines of regular files are
+// matched against the regex pattern by a pool of worker threads, binary files
+// are skipped. In name mode, names of files and dirs are matched against the
+// glob pattern. Matches of a file are sent together, files are in no order.
+// A content match is json [path, line_number, line], a name match is json [path].
+[client] cmd: search
+[client] path: path
+[client] mode: content or name
+[client] pattern: pattern
+[client] max_matches: max number of matches to send, 0 means no limit
+[server] match: json match
+...
+[server] search_end: number of matches  // or
+[server] search_error: error msg
+
+// Read part of a file. range is "bytes offset length" (a negative offset is
+// from the end, length -1 means to the end), "head lines" or "tail lines".
+[client] cmd: read_range
+[client] path: path
+[client] range: range
+[server] data: file data in hex format
+...
+[server] range_end: start end size inode  // offsets of the data sent, file size and inode
+// or
+[server] range_error: error msg
+
+// Wait up to timeout seconds until the file size isn't offset or its inode
+// changes, then send data from offset to the end, or from 0 if the file is
+// truncated or replaced. A missing file is waited for.
+[client] cmd: follow
+[client] path: path
+[client] offset: offset
+[client] inode: inode
+[client] timeout: timeout in seconds
+[server] data: file data in hex format
+...
+[server] range_end: start end size inode  // or
+[server] range_error: error msg
+
 """
 
+class DuplicateFinder(object):
+    """ Find files having the same inode or the same data as a file added
+        before. Files are only hashed when their sizes collide.
+    """
+    def __init__(self):
+        self.inodes = {}
+        self.sizes = {}
+        self.hashes = {}
+
+    def add(self, path, value):
+        """ Return (link_type, value of the original file) if path duplicates
+            a file added before, otherwise return None.
+        """
+        st = os.stat(path)
+        inode = (st.st_dev, st.st_ino)
+        if inode in self.inodes:
+            return 'hardlink', self.inodes[inode]
+        self.inodes[inode] = value
+        pending = self.sizes.get(st.st_size)
+        if pending is None:
+            self.sizes[st.st_size] = [(path, value)]
+            return None
+        for pending_path, pending_value in pending:
+            self.hashes.setdefault(get_file_hash(pending_path), pending_value)
+        del pending[:]
+        file_hash = get_file_hash(path)
+        if file_hash in self.hashes:
+            return 'copy', self.hashes[file_hash]
+        self.hashes[file_hash] = value
+        return None
+
+
+class TransferProgress(object):
+    """ Track bytes and files of a transfer, and report throughput and ETA.
+
+        mode is 'line' to rewrite a status line, 'json' to print a json object
+        per report, or 'off' to only track. Reports are printed at most once
+        per interval seconds.
+    """
+    def __init__(self, mode='line', interval=0.5):
+        self.mode = mode
+        self.interval = interval
+        self.start('', 0, 0)
+
+    def start(self, name, total_size, total_files):
+        self.name = name
+        self.total_size = total_size
+        self.total_files = total_files
+        self.size = 0
+        self.files = 0
+        self.start_time = self.last_report_time = time.time()
+        self.last_report_size = 0
+        self.rate = 0
+        self.finished = False
+
+    def add_bytes(self, size):
+        self.size += size
+        now = time.time()
+        if now - self.last_report_time >= self.interval:
+            self.report(now)
+
+    def add_file(self, count=1):
+        self.files += count
+
+    def finish(self):
+        self.finished = True
+        self.report(time.time())
+        if self.mode == 'line':
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+    def get_status(self, now=None):
+        now = now or time.time()
+        elapsed = now - self.start_time
+        avg_rate = self.size / elapsed if elapsed > 0 else 0
+        eta = None
+        if avg_rate > 0 and self.total_size >= self.size:
+            eta = (self.total_size - self.size) / avg_rate
+        return collections.OrderedDict([
+            ('name', self.name), ('size', self.size), ('total_size', self.total_size),
+            ('files', self.files), ('total_files', self.total_files),
+            ('rate', self.rate), ('avg_rate', avg_rate), ('elapsed', elapsed),
+            ('eta', eta), ('finished', self.finished)])
+
+    def get_summary(self, now=None):
+        status = self.get_status(now)
+        percent = ''
+        if status['total_size']:
+            percent = ' %d%%' % (status['size'] * 100 / status['total_size'])
+        eta = ''
+        if status['eta'] is not None and not status['finished']:
+            eta = ' ETA %d:%02d' % divmod(int(status['eta']), 60)
+        return '%s/%s%s %d/%d files %s/s (avg %s/s)%s' % (
+            format_size(status['size']), format_size(status['total_size']), percent,
+            status['files'], status['total_files'], format_size(status['rate']),
+            format_size(status['avg_rate']), eta)
+
+    def report(self, now):
+        if now > self.last_report_time:
+            self.rate = (self.size - self.last_report_size) / (now - self.last_report_time)
+        self.last_report_time = now
+        self.last_report_size = self.size
+        if self.mode == 'line':
+            sys.stdout.write('\r%s: %s\033[K' % (self.name, self.get_summary(now)))
+        elif self.mode == 'json':
+            sys.stdout.write(json.dumps(self.get_status(now)) + '\n')
+        else:
+            return
+        sys.stdout.flush()
+
+
 class FileBase(object):
     def __init__(self, write_line_function, read_line_function, logger):
         self.write_line_function = write_line_function
         self.read_line_function = read_line_function
         self.logger = logger
+        # Each data item or skip waits for all rate limiters, charged by the
+        # size of the data it sends.
+        self.rate_limiters = []
+        self.progress = None
+        self.error_count = 0
+        self.last_cmd = None
 
     def read_item(self, expected_key):
         return self.read_items([expected_key])[1]
@@ -80,6 +361,13 @@ class FileBase(object):
         self.logger.log('read_items(%s) = %s' % (expected_keys, line))
         if not line:
             log_exit('unexpected end')
+        if line.startswith('server_error: '):
+            cmd, msg = (line[len('server_error: '):].split(' ', 1) + [''])[:2]
+            self.error('remote %s failed: %s' % (cmd, msg))
+            if cmd == self.last_cmd:
+                # The reply of the failed cmd isn't coming.
+                raise FileTransferError()
+            return self.read_items(expected_keys)
         for expected_key in expected_keys:
             if line.startswith(expected_key + ': '):
                 return (expected_key, line[len(expected_key + ': '):])
@@ -87,29 +375,307 @@ class FileBase(object):
 
     def write_item(self, key, value):
         self.logger.log('write_item(%s: %s)' % (key, value))
+        if key == 'cmd':
+            self.last_cmd = value
         self.write_line_function(key + ': ' + value)
-    
+
+    def write_data_item(self, data, key='data'):
+        for rate_limiter in self.rate_limiters:
+            rate_limiter.consume(len(data))
+        self.write_item(key, self.binary_data_to_string(data))
+
     def binary_data_to_string(self, data):
-        s = []
-        for c in data:
-            s.append('%02x' % ord(c))
-        return ''.join(s)
+        return binascii.hexlify(data)
 
     def string_to_binary_data(self, s):
-        data = []
-        for i in range(0, len(s), 2):
-            data.append(chr(int(s[i:i+2], 16)))
-        return ''.join(data)
+        return binascii.unhexlify(s)
 
     def error(self, msg):
         sys.stderr.write(msg + '\n')
+        self.error_count += 1
+
+    def send_file_data(self, path):
+        zero_block = '\0' * 4096
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            size = 0
+            skip = 0
+            for offset, length in get_data_extents(f.fileno(), file_size):
+                skip = offset - size
+                f.seek(offset)
+                while size + skip < offset + length:
+                    data = f.read(min(4096, offset + length - size - skip))
+                    if not data:
+                        break
+                    if data == zero_block:
+                        skip += len(data)
+                        continue
+                    if skip:
+                        self.write_skip_item(skip)
+                        size += skip
+                        skip = 0
+                    size += len(data)
+                    self.write_data_item(data)
+                    if self.progress:
+                        self.progress.add_bytes(len(data))
+            if file_size > size:
+                self.write_skip_item(file_size - size)
+                size = file_size
+            self.write_item('data_end', '%d' % size)
+            if self.progress:
+                self.progress.add_file()
+
+    def write_skip_item(self, skip):
+        for rate_limiter in self.rate_limiters:
+            rate_limiter.consume(skip)
+        self.write_item('skip', '%d' % skip)
+        if self.progress:
+            self.progress.add_bytes(skip)
+
+    def recv_file_data(self, f, src, dst, cmd='recv_file'):
+        size = 0
+        while True:
+            key, value = self.read_items(('data', 'skip', 'data_end'))
+            if key == 'data':
+                data = self.string_to_binary_data(value)
+                size += len(data)
+                f.write(data)
+                if self.progress:
+                    self.progress.add_bytes(len(data))
+            elif key == 'skip':
+                f.seek(int(value), os.SEEK_CUR)
+                size += int(value)
+                if self.progress:
+                    self.progress.add_bytes(int(value))
+            elif key == 'data_end':
+                f.truncate(size)
+                sent_size = int(value)
+                if size != sent_size:
+                    self.error('%s %s to %s, sent_size %d, recv_size %d' %
+                        (cmd, src, dst, sent_size, size))
+                if self.progress:
+                    self.progress.add_file()
+                break
+
+    def write_tar_data(self, path):
+        """ Send a tar stream of dir path compressed by zlib as data items,
+            return an error msg or None. Holes of sparse files aren't sent.
+        """
+        error = None
+        size = 0
+        with tempfile.TemporaryFile() as error_fh:
+            try:
+                popen_obj = subprocess.Popen(['tar', 'cf', '-', '--sparse', '-C', path, '.'],
+                                             stdout=subprocess.PIPE, stderr=error_fh)
+            except OSError as e:
+                popen_obj = None
+                error = 'run tar failed: %s' % e
+            if popen_obj:
+                compressor = zlib.compressobj(1)
+                finished = False
+                try:
+                    while True:
+                        data = popen_obj.stdout.read(65536)
+                        if not data:
+                            break
+                        if self.progress:
+                            self.progress.add_bytes(len(data))
+                        size += self.write_data_items(compressor.compress(data))
+                    size += self.write_data_items(compressor.flush())
+                    finished = True
+                finally:
+                    if not finished:
+                        # Like a cancelled job.
+                        popen_obj.kill()
+                    status = popen_obj.wait()
+                if status != 0:
+                    error_fh.seek(0)
+                    error = 'tar exit status %d: %s' % (status, error_fh.read().strip())
+        self.write_item('data_end', '%d' % size)
+        return error
+
+    def write_data_items(self, data, item_size=16384):
+        for i in range(0, len(data), item_size):
+            self.write_data_item(data[i:i + item_size])
+        return len(data)
+
+    def read_tar_data(self, path):
+        """ Extract a tar stream sent by write_tar_data() to dir path, return
+            an error msg or None.
+        """
+        error = None
+        size = 0
+        with tempfile.TemporaryFile() as error_fh:
+            try:
+                popen_obj = subprocess.Popen(['tar', 'xf', '-', '--no-same-owner', '-C', path],
+                                             stdin=subprocess.PIPE, stderr=error_fh)
+            except OSError as e:
+                popen_obj = None
+                error = 'run tar failed: %s' % e
+            decompressor = zlib.decompressobj()
+            # Data items are read to the end even if tar fails.
+            writing = popen_obj is not None
+            while True:
+                key, value = self.read_items(('data', 'data_end'))
+                if key == 'data_end':
+                    break
+                data = self.string_to_binary_data(value)
+                size += len(data)
+                if writing:
+                    try:
+                        data = decompressor.decompress(data)
+                        if self.progress:
+                            self.progress.add_bytes(len(data))
+                        popen_obj.stdin.write(data)
+                    except (IOError, zlib.error) as e:
+                        error = 'extract tar failed: %s' % e
+                        writing = False
+            if popen_obj:
+                try:
+                    if writing:
+                        popen_obj.stdin.write(decompressor.flush())
+                    popen_obj.stdin.close()
+                except (IOError, zlib.error) as e:
+                    error = error or 'extract tar failed: %s' % e
+                status = popen_obj.wait()
+                if status != 0:
+                    error_fh.seek(0)
+                    error = 'tar exit status %d: %s' % (status, error_fh.read().strip())
+        if size != int(value):
+            error = error or 'sent_size %d, recv_size %d' % (int(value), size)
+        return error
+
+    def create_duplicate_file(self, target, path, link_type, file_type):
+        if os.path.lexists(path):
+            os.remove(path)
+        if link_type == 'hardlink':
+            os.link(target, path)
+        else:
+            shutil.copyfile(target, path)
+            if 'executable' in file_type:
+                run_cmd('chmod a+x %s' % path)
+
+class ContentStore(object):
+    """ Local content-addressed store of received file data.
+
+        Objects are stored read-only as store_dir/hash[:2]/hash, and are placed
+        at their destinations by reflink if the file system supports it, or by
+        copy. Destinations never share an inode with objects, so writing them
+        doesn't change the store.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = expand_path(store_dir)
+
+    def get_object_path(self, file_hash):
+        return os.path.join(self.store_dir, file_hash[:2], file_hash)
+
+    def has(self, file_hash):
+        return os.path.isfile(self.get_object_path(file_hash))
+
+    def get_temp_path(self):
+        mkdir(self.store_dir)
+        return os.path.join(self.store_dir, 'tmp.%d.%d' % (os.getpid(), threading.current_thread().ident))
+
+    def add(self, temp_path, file_hash):
+        obj = self.get_object_path(file_hash)
+        mkdir(os.path.dirname(obj))
+        os.chmod(temp_path, 0o444)
+        os.rename(temp_path, obj)
+
+    def materialize(self, file_hash, local, executable):
+        obj = self.get_object_path(file_hash)
+        if os.path.lexists(local):
+            os.remove(local)
+        with open(os.devnull, 'w') as null_fh:
+            if subprocess.call(['cp', '--reflink=always', obj, local], stderr=null_fh) == 0:
+                os.chmod(local, 0o755 if executable else 0o644)
+                return
+        shutil.copyfile(obj, local)
+        os.chmod(local, 0o755 if executable else 0o644)
+
+
+class StreamWriter(object):
+    """ Write received file data to a pipe or terminal, which can't seek or
+        truncate. Holes are written as zeros. Data is dropped after the reader
+        of the pipe exits, like `recv remote - | head`.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.reader_closed = False
+
+    def write(self, data):
+        if self.reader_closed:
+            return
+        try:
+            self.f.write(data)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.reader_closed = True
+
+    def seek(self, offset, whence):
+        # Only called with os.SEEK_CUR for skip items.
+        while offset > 0:
+            size = min(offset, 65536)
+            self.write('\0' * size)
+            offset -= size
+
+    def truncate(self, size):
+        pass
+
+    def flush(self):
+        if not self.reader_closed:
+            try:
+                self.f.flush()
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                self.reader_closed = True
+
 
 class FileClient(FileBase):
+    """ Dirs with at least tar_min_files files or tar_min_size bytes are sent
+        and received by tar if both ends have it, otherwise files are sent one
+        by one. engine is the one used by the last send or recv. Files smaller
+        than small_file_size are compressed with a shared dictionary when a
+        dir has at least compress_dict_min_files of them.
+    """
+    tar_min_files = 100
+    tar_min_size = 16 * 1024 * 1024
+    small_file_size = 16384
+    compress_dict_min_files = 16
+
+    def __init__(self, write_line_function, read_line_function, logger):
+        super(FileClient, self).__init__(write_line_function, read_line_function, logger)
+        self.content_store = None
+        self.remote_tools = None
+        self.engine = 'python'
+
     def set_remote_cwd(self, cwd):
         self.write_item('cmd', 'cd')
         self.write_item('path', cwd)
 
     def send(self, local, remote):
+        if local == '-':
+            self.send_stream(sys.stdin, remote)
+            return
+        size, file_count = get_tree_size(expand_path(local))
+        self.engine = 'python'
+        if os.path.isdir(expand_path(local)) and self.should_use_tar(size, file_count):
+            self.engine = 'tar'
+        self.logger.log('send %s %s by %s' % (local, remote, self.engine))
+        if self.progress:
+            self.progress.start('send %s %s (%s)' % (local, remote, self.engine), size,
+                                file_count)
+        try:
+            self.send_path(local, remote)
+            if self.engine == 'tar' and self.progress:
+                self.progress.add_file(file_count)
+        finally:
+            if self.progress:
+                self.progress.finish()
+
+    def send_path(self, local, remote):
         local = expand_path(local)
         if os.path.isfile(local):
             local_type = 'file'
@@ -130,11 +696,80 @@ class FileClient(FileBase):
         elif local_type == 'dir':
             if remote_type == 'file':
                 self.error("%s is a file, can't send dir to it" % remote)
-            elif remote_type == 'dir':
-                basename = os.path.basename(local[:-1] if local.endswith('/') else local)
-                self.send_dir(local, os.path.join(remote, basename))
-            elif remote_type == 'not_exist':
-                self.send_dir(local, remote)
+            else:
+                if remote_type == 'dir':
+                    basename = os.path.basename(local[:-1] if local.endswith('/') else local)
+                    remote = os.path.join(remote, basename)
+                if self.engine == 'tar':
+                    self.send_dir_by_tar(local, remote)
+                else:
+                    self.send_dir(local, remote)
+
+    def should_use_tar(self, size, file_count):
+        if size < self.tar_min_size and file_count < self.tar_min_files:
+            return False
+        return bool(find_tools(['tar'])) and 'tar' in self.get_remote_tools()
+
+    def get_remote_tools(self):
+        """ Return the tools found in the server, which are probed once. """
+        if self.remote_tools is None:
+            self.write_item('cmd', 'find_tools')
+            self.write_item('names', 'tar')
+            self.remote_tools = split_string(self.read_item('tools'))
+        return self.remote_tools
+
+    def send_dir_by_tar(self, local, remote):
+        self.write_item('cmd', 'send_tar')
+        self.write_item('remote', remote)
+        error = self.write_tar_data(local)
+        result = self.read_item('result')
+        if error or result != 'ok':
+            self.error('send %s to %s by tar failed: %s' % (local, remote, error or result))
+
+    def send_stream(self, f, remote):
+        """ Send data read from f until EOF to the remote file. f can be a pipe,
+            so the size isn't known until the end, and at most the sending
+            window of data is buffered.
+        """
+        self.write_item('cmd', 'path_type')
+        self.write_item('path', remote)
+        if self.read_item('type') == 'dir':
+            self.error("%s is a dir, can't send a stream to it" % remote)
+            return
+        if self.progress:
+            self.progress.start('send - %s' % remote, 0, 1)
+        try:
+            self.write_item('cmd', 'send_file')
+            self.write_item('local', '-')
+            self.write_item('remote', remote)
+            self.write_item('file_type', '')
+            zero_block = '\0' * 4096
+            size = 0
+            skip = 0
+            while True:
+                data = f.read(4096)
+                if not data:
+                    break
+                if data == zero_block:
+                    skip += len(data)
+                    continue
+                if skip:
+                    self.write_skip_item(skip)
+                    size += skip
+                    skip = 0
+                size += len(data)
+                self.write_data_item(data)
+                if self.progress:
+                    self.progress.add_bytes(len(data))
+            if skip:
+                self.write_skip_item(skip)
+                size += skip
+            self.write_item('data_end', '%d' % size)
+            if self.progress:
+                self.progress.add_file()
+        finally:
+            if self.progress:
+                self.progress.finish()
 
     def send_dir(self, local, remote):
         if not local.endswith('/'):
@@ -142,28 +777,190 @@ class FileClient(FileBase):
         if not remote.endswith('/'):
             remote += '/'
         self.logger.log('send_dir(local %s, remote %s)' % (local, remote))
-        self.rmdir(remote)
-        self.mkdir(remote)
-        for root, dirs, files in os.walk(local):
+        # Create dirs and links in batches before sending files.
+        ops = [['rmdir', remote], ['mkdir', remote]]
+        files = []
+        for root, dirs, filenames in os.walk(local):
             for d in dirs:
                 local_dir = os.path.join(root, d)
                 remote_dir = remote + local_dir[len(local):]
                 logger.log('local %s, remote %s, local_dir %s, remote_dir %s' %
                     (local, remote, local_dir, remote_dir))
                 if os.path.islink(local_dir):
-                    self.send_link(local_dir, remote_dir)
+                    ops.append(['send_link', remote_dir, os.readlink(local_dir)])
                 else:
-                    self.mkdir(remote_dir)
-            for f in files:
+                    ops.append(['mkdir', remote_dir])
+            for f in filenames:
                 local_file = os.path.join(root, f)
                 remote_file = remote + local_file[len(local):]
                 logger.log('local %s, remote %s, local_file %s, remote_file %s' %
                     (local, remote, local_file, remote_file))
                 if os.path.islink(local_file):
-                    self.send_link(local_file, remote_file)
+                    ops.append(['send_link', remote_file, os.readlink(local_file)])
                 else:
-                    self.send_file(local_file, remote_file)
+                    files.append((local_file, remote_file))
+        for op, result in zip(ops, self.run_batch(ops)):
+            if result[0] == 'error':
+                self.error('%s %s failed: %s' % (op[0], op[1], result[1]))
+        compressor = self.send_compress_dict([f[0] for f in files])
+        finder = DuplicateFinder()
+        for local_file, remote_file in files:
+            duplicate = finder.add(local_file, remote_file)
+            if duplicate:
+                self.link_file(local_file, remote_file, duplicate[1], duplicate[0])
+                if self.progress:
+                    self.progress.add_bytes(os.path.getsize(local_file))
+                    self.progress.add_file()
+            elif compressor and os.path.getsize(local_file) < self.small_file_size:
+                self.send_small_file(local_file, remote_file, compressor)
+            else:
+                self.send_file(local_file, remote_file)
+
+    def send_compress_dict(self, files):
+        """ Send a dictionary selected from the small files in files, return a
+            compressor primed with it, or None if there are too few small files.
+            zlib in python2 has no zdict, so both ends compress or decompress
+            the dictionary and copy the primed objects for each file.
+        """
+        small_files = [f for f in files if os.path.getsize(f) < self.small_file_size]
+        if len(small_files) < self.compress_dict_min_files:
+            return None
+        compressor = zlib.compressobj(6)
+        data = compressor.compress(select_compress_dict(small_files))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.write_item('cmd', 'set_compress_dict')
+        self.write_item('data_end', '%d' % self.write_data_items(data))
+        return compressor
+
+    def send_small_file(self, local, remote, compressor):
+        with open(local, 'rb') as f:
+            data = f.read()
+        compressor = compressor.copy()
+        self.write_item('cmd', 'send_small_file')
+        self.write_item('remote', remote)
+        self.write_item('file_type', ', '.join(get_file_type(local)))
+        self.write_item('size', '%d' % len(data))
+        compressed_data = compressor.compress(data) + compressor.flush()
+        self.write_data_item(compressed_data)
+        if self.progress:
+            self.progress.add_bytes(len(data))
+            self.progress.add_file()
+
+    def exec_cmd(self, cmdline, output_function, error_function=None):
+        """ Run cmdline in the server, pass its stdout data to output_function,
+            its stderr data to error_function (or output_function if not set),
+            and return its exit status.
+        """
+        self.write_item('cmd', 'exec')
+        self.write_item('cmdline', cmdline)
+        while True:
+            key, value = self.read_items(['stdout', 'stderr', 'exit_status'])
+            if key == 'exit_status':
+                return int(value)
+            data = self.string_to_binary_data(value)
+            if key == 'stderr' and error_function:
+                error_function(data)
+            else:
+                output_function(data)
 
+    def search(self, remote, mode, pattern, match_function, max_matches=0):
+        """ Search files under remote in content or name mode, pass each match
+            to match_function, and return the number of matches.
+        """
+        self.write_item('cmd', 'search')
+        self.write_item('path', remote)
+        self.write_item('mode', mode)
+        self.write_item('pattern', pattern)
+        self.write_item('max_matches', '%d' % max_matches)
+        while True:
+            key, value = self.read_items(['match', 'search_end', 'search_error'])
+            if key == 'match':
+                match_function(json.loads(value))
+            elif key == 'search_end':
+                return int(value)
+            else:
+                self.error('search in %s failed: %s' % (remote, value))
+                return 0
+
+    def read_range(self, remote, range_spec, output_function):
+        """ Read a range of remote like "bytes 100 -1", "head 10" or "tail 10",
+            pass data to output_function, and return (start, end, size, inode)
+            or None on error.
+        """
+        self.write_item('cmd', 'read_range')
+        self.write_item('path', remote)
+        self.write_item('range', range_spec)
+        return self.read_range_data(remote, output_function)
+
+    def read_range_data(self, remote, output_function):
+        while True:
+            key, value = self.read_items(['data', 'range_end', 'range_error'])
+            if key == 'data':
+                output_function(self.string_to_binary_data(value))
+            elif key == 'range_end':
+                return tuple(int(x) for x in value.split())
+            else:
+                self.error('read %s failed: %s' % (remote, value))
+                return None
+
+    def follow(self, remote, output_function, lines=10, timeout=10):
+        """ Pass the last lines of remote and data appended later to
+            output_function, like `tail -f`. Return on errors, or when the file
+            channel is closed.
+        """
+        result = self.read_range(remote, 'tail %d' % lines, output_function)
+        while result:
+            offset, inode = result[1], result[3]
+            self.write_item('cmd', 'follow')
+            self.write_item('path', remote)
+            self.write_item('offset', '%d' % offset)
+            self.write_item('inode', '%d' % inode)
+            self.write_item('timeout', '%d' % timeout)
+            result = self.read_range_data(remote, output_function)
+            if result and result[3] != inode:
+                sys.stderr.write('%s: file replaced\n' % remote)
+            elif result and result[0] != offset:
+                sys.stderr.write('%s: file truncated\n' % remote)
+
+    def run_batch(self, ops, max_batch_size=32768, max_pending_batches=16):
+        """ Run metadata ops in the server, return their results. Ops are split
+            into batches of max_batch_size bytes to fit in msgs, batches are sent
+            without waiting for results, costing one round trip. At most
+            max_pending_batches batches wait for results, to stay in the credits
+            of the file channel.
+        """
+        batches = [[]]
+        size = 0
+        for op in ops:
+            op = [arg.decode('latin-1') for arg in op]
+            op_size = len(json.dumps(op)) + 1
+            if batches[-1] and size + op_size > max_batch_size:
+                batches.append([])
+                size = 0
+            batches[-1].append(op)
+            size += op_size
+        results = []
+        for i, batch in enumerate(batches):
+            if i >= max_pending_batches:
+                results += self.read_batch_results(len(batches[i - max_pending_batches]))
+            self.write_item('cmd', 'batch')
+            self.write_item('ops', json.dumps(batch, separators=(',', ':')))
+        for batch in batches[max(0, len(batches) - max_pending_batches):]:
+            results += self.read_batch_results(len(batch))
+        return results
+
+    def read_batch_results(self, count):
+        results = []
+        while len(results) < count:
+            results += json.loads(self.read_item('results'))
+        return [[status, value.encode('latin-1')] for status, value in results]
+
+    def link_file(self, local, remote, target, link_type):
+        self.write_item('cmd', 'link_file')
+        self.write_item('remote', remote)
+        self.write_item('target', target)
+        self.write_item('link_type', link_type)
+        self.write_item('file_type', ', '.join(get_file_type(local)))
 
     def send_file(self, local, remote):
         self.write_item('cmd', 'send_file')
@@ -171,16 +968,7 @@ class FileClient(FileBase):
         self.write_item('remote', remote)
         file_type = get_file_type(local)
         self.write_item('file_type', ', '.join(file_type))
-        with open(local, 'rb') as f:
-            size = 0
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                size += len(data)
-                s = self.binary_data_to_string(data)
-                self.write_item('data', s)
-            self.write_item('data_end', '%d' % size)
+        self.send_file_data(local)
 
     def send_link(self, local, remote):
         if not os.path.islink(local):
@@ -193,6 +981,37 @@ class FileClient(FileBase):
         self.write_item('link', link)
 
     def recv(self, remote, local):
+        if local == '-':
+            self.recv_stream(remote, sys.stdout)
+            return
+        size, file_count = self.get_tree_size(remote)
+        self.engine = 'python'
+        # The content store is kept by receiving files one by one.
+        if not self.content_store and self.should_use_tar(size, file_count):
+            self.write_item('cmd', 'path_type')
+            self.write_item('path', remote)
+            if self.read_item('type') == 'dir':
+                self.engine = 'tar'
+        self.logger.log('recv %s %s by %s' % (remote, local, self.engine))
+        if self.progress:
+            self.progress.start('recv %s %s (%s)' % (remote, local, self.engine), size,
+                                file_count)
+        try:
+            self.recv_path(remote, local)
+            if self.engine == 'tar' and self.progress:
+                self.progress.add_file(file_count)
+        finally:
+            if self.progress:
+                self.progress.finish()
+
+    def get_tree_size(self, path):
+        self.write_item('cmd', 'tree_size')
+        self.write_item('path', path)
+        size = int(self.read_item('size'))
+        file_count = int(self.read_item('files'))
+        return size, file_count
+
+    def recv_path(self, remote, local):
         local = expand_path(local)
         if os.path.isfile(local):
             local_type = 'file'
@@ -212,11 +1031,45 @@ class FileClient(FileBase):
         elif remote_type == 'dir':
             if local_type == 'file':
                 self.error("%s is a file, can't recv dir to it" % local)
-            elif local_type == 'dir':
-                basename = os.path.basename(remote[:-1] if remote.endswith('/') else remote)
-                self.recv_dir(remote, os.path.join(local, basename))
-            elif local_type == 'not_exist':
-                self.recv_dir(remote, local)
+            else:
+                if local_type == 'dir':
+                    basename = os.path.basename(remote[:-1] if remote.endswith('/') else remote)
+                    local = os.path.join(local, basename)
+                if self.engine == 'tar':
+                    self.recv_dir_by_tar(remote, local)
+                else:
+                    self.recv_dir(remote, local)
+        else:
+            self.error('path %s not found' % remote)
+
+    def recv_stream(self, remote, f):
+        """ Write data of the remote file to f, which can be a pipe. Progress
+            isn't shown when f is stdout.
+        """
+        self.write_item('cmd', 'path_type')
+        self.write_item('path', remote)
+        remote_type = self.read_item('type')
+        if remote_type != 'file':
+            self.error("%s isn't a file, can't recv it to a stream" % remote)
+            return
+        progress = self.progress
+        if f is sys.stdout:
+            self.progress = None
+        if self.progress:
+            size, file_count = self.get_tree_size(remote)
+            self.progress.start('recv %s -' % remote, size, file_count)
+        try:
+            self.write_item('cmd', 'recv_file')
+            self.write_item('remote', remote)
+            self.write_item('local', '-')
+            self.read_item('file_type')
+            writer = StreamWriter(f)
+            self.recv_file_data(writer, remote, '-')
+            writer.flush()
+        finally:
+            if self.progress:
+                self.progress.finish()
+            self.progress = progress
 
     def recv_dir(self, remote, local):
         if not local.endswith('/'):
@@ -225,6 +1078,8 @@ class FileClient(FileBase):
             remote += '/'
         self.logger.log('recv_dir(remote %s, local %s)' % (remote, local))
         mkdir(local)
+        duplicates = self.find_duplicates(remote)
+        waiting_duplicates = []
         waiting_dirs = collections.deque()
         waiting_dirs.append(remote)
         while len(waiting_dirs) > 0:
@@ -243,13 +1098,139 @@ class FileClient(FileBase):
             for f in files:
                 remote_file = os.path.join(remote_path, f)
                 local_file = local + remote_file[len(remote):]
-                self.recv_file(remote_file, local_file)
+                if remote_file[len(remote):] in duplicates:
+                    waiting_duplicates.append(remote_file[len(remote):])
+                else:
+                    self.recv_file(remote_file, local_file)
             for l in links:
                 remote_link = os.path.join(remote_path, l)
                 local_link = local + remote_link[len(remote):]
                 self.recv_link(remote_link, local_link)
+        # Originals are never duplicates, so they have all been received.
+        for path in waiting_duplicates:
+            original, link_type, file_type = duplicates[path]
+            self.create_duplicate_file(local + original, local + path, link_type, file_type)
+            if self.progress:
+                self.progress.add_bytes(os.path.getsize(local + path))
+                self.progress.add_file()
+
+    def relay(self, remote, dst_client, dst_remote):
+        """ Copy remote files of this client's server to dst_remote of
+            dst_client's server. Data items are passed through as they are
+            read, so only the sending windows of the two channels are buffered.
+        """
+        if self.progress:
+            size, file_count = self.get_tree_size(remote)
+            self.progress.start('relay %s %s' % (remote, dst_remote), size, file_count)
+        try:
+            self.relay_path(remote, dst_client, dst_remote)
+        finally:
+            if self.progress:
+                self.progress.finish()
+
+    def relay_path(self, remote, dst_client, dst_remote):
+        self.write_item('cmd', 'path_type')
+        self.write_item('path', remote)
+        remote_type = self.read_item('type')
+        dst_client.write_item('cmd', 'path_type')
+        dst_client.write_item('path', dst_remote)
+        dst_type = dst_client.read_item('type')
+        if remote_type == 'file':
+            if dst_type == 'dir':
+                dst_remote = os.path.join(dst_remote, os.path.basename(remote))
+            self.relay_file(remote, dst_client, dst_remote)
+        elif remote_type == 'dir':
+            if dst_type == 'file':
+                self.error("%s is a file, can't relay dir to it" % dst_remote)
+            else:
+                if dst_type == 'dir':
+                    basename = os.path.basename(remote[:-1] if remote.endswith('/') else remote)
+                    dst_remote = os.path.join(dst_remote, basename)
+                self.relay_dir(remote, dst_client, dst_remote)
+        else:
+            self.error('path %s not found' % remote)
+
+    def relay_dir(self, remote, dst_client, dst_remote):
+        if not remote.endswith('/'):
+            remote += '/'
+        if not dst_remote.endswith('/'):
+            dst_remote += '/'
+        self.logger.log('relay_dir(remote %s, dst_remote %s)' % (remote, dst_remote))
+        dst_client.mkdir(dst_remote)
+        waiting_dirs = collections.deque()
+        waiting_dirs.append(remote)
+        while len(waiting_dirs) > 0:
+            remote_path = waiting_dirs.popleft()
+            self.write_item('cmd', 'list_dir')
+            self.write_item('path', remote_path)
+            dirs = split_string(self.read_item('dirs'))
+            files = split_string(self.read_item('files'))
+            links = split_string(self.read_item('links'))
+            for d in dirs:
+                remote_dir = os.path.join(remote_path, d)
+                dst_client.mkdir(dst_remote + remote_dir[len(remote):])
+                waiting_dirs.append(remote_dir)
+            for f in files:
+                remote_file = os.path.join(remote_path, f)
+                self.relay_file(remote_file, dst_client, dst_remote + remote_file[len(remote):])
+            for l in links:
+                remote_link = os.path.join(remote_path, l)
+                self.write_item('cmd', 'recv_link')
+                self.write_item('remote', remote_link)
+                self.write_item('local', dst_remote + remote_link[len(remote):])
+                link = self.read_item('link')
+                if link:
+                    dst_client.write_item('cmd', 'send_link')
+                    dst_client.write_item('local', remote_link)
+                    dst_client.write_item('remote', dst_remote + remote_link[len(remote):])
+                    dst_client.write_item('link', link)
+
+    def relay_file(self, remote, dst_client, dst_remote):
+        self.write_item('cmd', 'recv_file')
+        self.write_item('remote', remote)
+        self.write_item('local', dst_remote)
+        file_type = self.read_item('file_type')
+        dst_client.write_item('cmd', 'send_file')
+        dst_client.write_item('local', remote)
+        dst_client.write_item('remote', dst_remote)
+        dst_client.write_item('file_type', file_type)
+        while True:
+            key, value = self.read_items(('data', 'skip', 'data_end'))
+            dst_client.write_item(key, value)
+            if key == 'data_end':
+                break
+            if self.progress:
+                self.progress.add_bytes(len(value) / 2 if key == 'data' else int(value))
+        if self.progress:
+            self.progress.add_file()
+
+    def recv_dir_by_tar(self, remote, local):
+        mkdir(local)
+        self.write_item('cmd', 'recv_tar')
+        self.write_item('remote', remote)
+        error = self.read_tar_data(local)
+        result = self.read_item('result')
+        if error or result != 'ok':
+            self.error('recv %s to %s by tar failed: %s' % (remote, local, error or result))
 
-    def recv_file(self, remote, local):
+    def find_duplicates(self, remote):
+        self.write_item('cmd', 'find_duplicates')
+        self.write_item('path', remote)
+        duplicates = {}
+        while True:
+            key, value = self.read_items(['duplicate', 'duplicates_end'])
+            if key == 'duplicates_end':
+                break
+            original = self.read_item('original')
+            link_type = self.read_item('link_type')
+            file_type = split_string(self.read_item('file_type'))
+            duplicates[value] = (original, link_type, file_type)
+        return duplicates
+
+    def recv_file(self, remote, local, use_store=True):
+        if use_store and self.content_store:
+            self.recv_file_by_hash(remote, local)
+            return
         self.write_item('cmd', 'recv_file')
         self.write_item('remote', remote)
         self.write_item('local', local)
@@ -258,22 +1239,38 @@ class FileClient(FileBase):
             run_cmd('mkdir -p %s' % dirpath)
         file_type = self.read_item('file_type')
         with open(local, 'wb') as f:
-            size = 0
-            while True:
-                key, value = self.read_items(('data', 'data_end'))
-                if key == 'data':
-                    data = self.string_to_binary_data(value)
-                    size += len(data)
-                    f.write(data)
-                elif key == 'data_end':
-                    sent_size = int(value)
-                    if size != sent_size:
-                        self.error('recv_file %s to %s, sent_size %d, recv_size %d' %
-                            (remote, local, sent_size, size))
-                    break
+            self.recv_file_data(f, remote, local)
         if 'executable' in file_type:
             run_cmd('chmod a+x %s' % local)
 
+    def recv_file_by_hash(self, remote, local):
+        self.write_item('cmd', 'recv_file_by_hash')
+        self.write_item('remote', remote)
+        self.write_item('local', local)
+        dirpath = os.path.split(local)[0]
+        if dirpath:
+            run_cmd('mkdir -p %s' % dirpath)
+        file_type = self.read_item('file_type')
+        file_hash = self.read_item('hash')
+        store = self.content_store
+        if store.has(file_hash):
+            self.logger.log('recv_file_by_hash(%s) hits %s' % (remote, file_hash))
+            self.write_item('need_data', 'no')
+            if self.progress:
+                self.progress.add_bytes(os.path.getsize(store.get_object_path(file_hash)))
+                self.progress.add_file()
+        else:
+            self.write_item('need_data', 'yes')
+            temp_path = store.get_temp_path()
+            with open(temp_path, 'wb') as f:
+                self.recv_file_data(f, remote, local)
+            if get_file_hash(temp_path) != file_hash:
+                os.remove(temp_path)
+                self.error('recv_file %s to %s, hash mismatch' % (remote, local))
+                return
+            store.add(temp_path, file_hash)
+        store.materialize(file_hash, local, 'executable' in file_type)
+
     def recv_link(self, remote, local):
         dirpath = os.path.split(local)[0]
         if dirpath:
@@ -285,6 +1282,14 @@ class FileClient(FileBase):
         if link:
             run_cmd('ln -s %s %s' % (link, local))
 
+    def wait_cmds_done(self):
+        """ Return after the server finishes the cmds sent before, as cmds like
+            send_file have no reply.
+        """
+        self.write_item('cmd', 'path_type')
+        self.write_item('path', '.')
+        self.read_item('type')
+
     def get_possible_paths(self, path):
         self.write_item('cmd', 'get_possible_paths')
         self.write_item('path', path)
@@ -298,18 +1303,216 @@ class FileClient(FileBase):
         self.write_item('cmd', 'rmdir')
         self.write_item('path', path)
 
+    def stat(self, path):
+        self.write_item('cmd', 'stat')
+        self.write_item('path', path)
+        path_type = self.read_item('type')
+        size = int(self.read_item('size'))
+        mtime = self.read_item('mtime')
+        file_hash = self.read_item('hash')
+        return path_type, size, mtime, file_hash
+
+    def send_file_delta(self, local, base, remote, base_hash, block_size=4096):
+        """ Patch the remote file in place with blocks of local which differ
+            from the block at the same offset of base. Return False if the
+            remote file no longer matches base_hash. Blocks aren't matched at
+            other offsets, so inserting or deleting bytes sends all blocks
+            after them.
+        """
+        self.write_item('cmd', 'send_file_delta')
+        self.write_item('remote', remote)
+        self.write_item('base_hash', base_hash)
+        with open(local, 'rb') as f, open(base, 'rb') as base_f:
+            size = 0
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                if data != base_f.read(block_size):
+                    self.write_item('offset', '%d' % size)
+                    self.write_data_item(data)
+                size += len(data)
+            self.write_item('data_end', '%d' % size)
+        return self.read_item('result') == 'ok'
+
 class FileTransferError(Exception):
     pass
 
+class FileTransferJobEnd(Exception):
+    pass
+
+class CreditQueue(object):
+    """ A queue of lines received from a file channel with credit based flow
+        control. The sender can't send more than its credits, and the size of
+        lines taken from the queue is granted back by grant_function(size), so
+        the queue is bounded by the credits of the sender.
+    """
+    def __init__(self, grant_function=None, grant_size=256 * 1024):
+        self.queue = Queue()
+        self.grant_function = grant_function
+        self.grant_size = grant_size
+        self.taken_size = 0
+        self.closed = False
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def get(self):
+        data = self.queue.get()
+        if data is not None and self.grant_function and not self.closed:
+            self.taken_size += len(data)
+            if self.taken_size >= self.grant_size:
+                self.grant_function(self.taken_size)
+                self.taken_size = 0
+        return data
+
+    def close(self):
+        """ Stop granting credits, and make get() return None after queued lines. """
+        self.closed = True
+        self.queue.put(None)
+
+class FileTransferJob(object):
+    """ Run a send or recv cmd in a background thread, using its own file
+        channel to a FileServer.
+    """
+    def __init__(self, job_id, cmdline, write_line_function, close_function, logger,
+                 grant_function=None):
+        self.job_id = job_id
+        self.cmdline = cmdline
+        self.close_function = close_function
+        self.logger = logger
+        self.read_queue = CreditQueue(grant_function)
+        self.cancelled = threading.Event()
+        self.state = 'running'
+        self.rate_limiter = RateLimiter()
+        def job_write_line_function(data):
+            if self.cancelled.is_set():
+                raise FileTransferJobEnd()
+            write_line_function(data)
+        def job_read_line_function():
+            data = self.read_queue.get()
+            if data is None:
+                raise FileTransferJobEnd()
+            return data
+        self.client = FileClient(job_write_line_function, job_read_line_function, logger)
+        self.thread = None
+
+    def start(self, function, *args):
+        def job_thread_func():
+            try:
+                function(self.client, *args)
+                # Cmds like send_file have no reply, their msgs may still be
+                # queued, and closing the channel drops them.
+                self.client.wait_cmds_done()
+                self.state = 'done'
+            except FileTransferJobEnd:
+                self.state = 'cancelled'
+            except Exception as e:
+                self.logger.log('job %d failed: %s' % (self.job_id, e))
+                self.state = 'failed'
+            self.close_function(self.job_id)
+            sys.stdout.write('\n[%d] %s  %s  (%s/s)\n' % (self.job_id, self.state, self.cmdline,
+                             format_size(self.rate_limiter.get_achieved_rate())))
+            sys.stdout.flush()
+        self.thread = threading.Thread(target=job_thread_func)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_input(self, data):
+        self.read_queue.put(data)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.read_queue.close()
+        # Stop the job's FileServer, and wake up the job waiting to write.
+        self.close_function(self.job_id)
+
+    def wait(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+class EditCache(object):
+    """ Keep local copies of remote files opened by the edit cmd.
+
+        Each remote path has a directory in cache_dir containing:
+          base -- the remote file data when it was last fetched or sent.
+          meta -- the validator (size, mtime, hash) of the remote file.
+          work/basename -- the copy opened in the editor.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = expand_path(cache_dir)
+
+    def get_entry_dir(self, remote):
+        return os.path.join(self.cache_dir, hashlib.sha256(remote).hexdigest())
+
+    def get_base_path(self, remote):
+        return os.path.join(self.get_entry_dir(remote), 'base')
+
+    def get_work_path(self, remote):
+        return os.path.join(self.get_entry_dir(remote), 'work', os.path.basename(remote))
+
+    def is_current(self, remote, size, mtime, file_hash):
+        meta = {}
+        load_config(os.path.join(self.get_entry_dir(remote), 'meta'), meta)
+        return (os.path.isfile(self.get_base_path(remote)) and
+                meta.get('remote') == remote and meta.get('size') == '%d' % size and
+                meta.get('mtime') == mtime and meta.get('hash') == file_hash)
+
+    def update(self, remote, size, mtime, file_hash):
+        with open(os.path.join(self.get_entry_dir(remote), 'meta'), 'w') as f:
+            f.write('remote=%s\nsize=%d\nmtime=%s\nhash=%s\n' % (remote, size, mtime, file_hash))
+
+
 class FileClientCmdInterface(object):
-    def __init__(self, write_line_function, logger):
+    """ Run file transfer cmds.
+
+        Background send and recv cmds (ending with &) need a job channel:
+          write_job_line_function(job_id, data) sends a line to the job's
+            FileServer, and replies are passed back through add_job_input().
+          close_job_function(job_id) stops the job's FileServer.
+
+        set_remote_rate_function(job_id, rate) sets the rate limit of data
+        sent by the server, job_id 0 is for the whole session.
+
+        grant_credit_function(channel, size) grants credits of data consumed
+        from a file channel to the server, channel 0 is for foreground cmds,
+        others are job_ids.
+
+        run_interactive_function(cmdline) runs a local program using the
+        terminal, like the editor of the edit cmd, and returns its exit status.
+        It stops reading input meanwhile.
+    """
+    def __init__(self, write_line_function, logger, cache_dir='~/.ssh_wrapper_cache',
+                 content_store_dir=None, write_job_line_function=None,
+                 close_job_function=None, set_remote_rate_function=None,
+                 grant_credit_function=None, run_interactive_function=None):
         self.logger = logger
-        self.read_queue = Queue()
+        self.run_interactive_function = run_interactive_function or (
+            lambda cmdline: subprocess.call(cmdline, shell=True))
+        self.grant_credit_function = grant_credit_function
+        self.read_queue = CreditQueue(self.get_grant_function(0))
         def read_line_function():
-            return self.read_queue.get()
+            data = self.read_queue.get()
+            if data is None:
+                self.error('file channel closed.')
+            return data
         self.client = FileClient(write_line_function, read_line_function, logger)
+        self.rate_limiter = RateLimiter()
+        self.client.rate_limiters = [self.rate_limiter]
+        self.client.progress = TransferProgress()
+        self.set_remote_rate_function = set_remote_rate_function
+        if content_store_dir:
+            self.client.content_store = ContentStore(content_store_dir)
+        self.edit_cache = EditCache(cache_dir)
+        self.search_result_path = os.path.join(expand_path(cache_dir), 'search_results')
+        self.write_job_line_function = write_job_line_function
+        self.close_job_function = close_job_function
+        self.jobs = collections.OrderedDict()
+        self.next_job_id = 1
         self.cmds = ['lls', 'lcp', 'lcd', 'lrm', 'lmkdir', 'local',
-                     'rcp', 'send', 'recv', 'test', 'help']
+                     'rcp', 'send', 'recv', 'edit', 'jobs', 'wait', 'cancel',
+                     'limit', 'progress', 'rgrep', 'rfind', 'rhead', 'rtail', 'follow',
+                     'test', 'help']
         self.current_dir = ''
 
     def is_cmd_supported(self, cmdline):
@@ -328,9 +1531,39 @@ class FileClientCmdInterface(object):
     def add_input(self, data):
         self.read_queue.put(data)
 
+    def add_job_input(self, job_id, data):
+        job = self.jobs.get(job_id)
+        if job:
+            job.add_input(data)
+
+    def get_grant_function(self, channel):
+        if not self.grant_credit_function:
+            return None
+        return lambda size: self.grant_credit_function(channel, size)
+
+    def reset_channels(self):
+        """ Fail the running cmd and jobs after the file channels are lost. """
+        read_queue = self.read_queue
+        self.read_queue = CreditQueue(self.get_grant_function(0))
+        read_queue.close()
+        for job in self.jobs.values():
+            job.cancel()
+        # The remote cwd of a new channel isn't known.
+        self.current_dir = ''
+
     def run_cmd(self, cmdline):
         try:
+            pipe_cmd = self.get_pipe_cmd(cmdline)
+            if pipe_cmd:
+                self.run_pipe_cmd(*pipe_cmd)
+                return True
             args = cmdline.split()
+            if args[-1].endswith('&') and args[0] in ('lcp', 'send', 'rcp', 'recv', 'follow'):
+                args[-1] = args[-1][:-1]
+                if not args[-1]:
+                    args = args[:-1]
+                self.start_job(args)
+                return True
             if args[0] in ('lls', 'lrm', 'lmkdir'):
                 args[0] = args[0][1:]
                 self.run_local_cmd(args)
@@ -342,6 +1575,25 @@ class FileClientCmdInterface(object):
                 self.send_files(args)
             elif args[0] in ('rcp', 'recv'):
                 self.recv_files(args)
+            elif args[0] == 'edit':
+                self.edit_file(args)
+            elif args[0] in ('rgrep', 'rfind'):
+                # Patterns may have spaces.
+                self.search_files(shlex.split(cmdline))
+            elif args[0] in ('rhead', 'rtail'):
+                self.read_file_range(args)
+            elif args[0] == 'follow':
+                self.error('follow only runs in background, need `follow remote_path [local_path] &`.')
+            elif args[0] == 'jobs':
+                self.list_jobs()
+            elif args[0] == 'wait':
+                self.wait_jobs(args)
+            elif args[0] == 'cancel':
+                self.cancel_jobs(args)
+            elif args[0] == 'limit':
+                self.set_rate_limit(args)
+            elif args[0] == 'progress':
+                self.set_progress_mode(args)
             elif args[0] == 'test':
                 self.run_test()
             elif args[0] == 'help':
@@ -352,6 +1604,46 @@ class FileClientCmdInterface(object):
             return False
         return True
 
+    def get_pipe_cmd(self, cmdline):
+        """ Return (local_cmdline, args) for `local cmd | send - remote_path` and
+            `recv remote_path - | cmd`, otherwise return None.
+        """
+        if '|' not in cmdline:
+            return None
+        left, right = cmdline.rsplit('|', 1)
+        args = right.split()
+        left_args = left.split(None, 1)
+        if (len(left_args) == 2 and left_args[0] == 'local' and len(args) == 3 and
+                args[0] in ('lcp', 'send') and args[1] == '-'):
+            return left_args[1], args
+        left, right = cmdline.split('|', 1)
+        args = left.split()
+        if len(args) == 3 and args[0] in ('rcp', 'recv') and args[2] == '-' and right.strip():
+            return right.strip(), args
+        return None
+
+    def run_pipe_cmd(self, local_cmdline, args):
+        """ Stream data between a local cmd and a remote file through a pipe. """
+        if args[0] in ('lcp', 'send'):
+            popen_obj = subprocess.Popen(local_cmdline, shell=True, stdout=subprocess.PIPE)
+            try:
+                self.client.send_stream(popen_obj.stdout, args[2])
+            finally:
+                popen_obj.stdout.close()
+                status = popen_obj.wait()
+        else:
+            popen_obj = subprocess.Popen(local_cmdline, shell=True, stdin=subprocess.PIPE)
+            try:
+                self.client.recv_stream(args[1], popen_obj.stdin)
+            finally:
+                try:
+                    popen_obj.stdin.close()
+                except IOError:
+                    pass
+                status = popen_obj.wait()
+        if status != 0:
+            self.error('run %s failed' % local_cmdline)
+
     def run_local_cmd(self, args):
         if subprocess.call(' '.join(args), shell=True) != 0:
             self.error('run %s failed' % (' '.join(args)))
@@ -367,6 +1659,8 @@ class FileClientCmdInterface(object):
     def send_files(self, args):
         if len(args) != 3:
             self.error('wrong options, need `%s local remote`.' % args[0])
+        if args[1] == '-':
+            self.error('need `local cmd | %s - remote` to send output of a local cmd.' % args[0])
         self.client.send(args[1], args[2])
 
     def recv_files(self, args):
@@ -374,6 +1668,194 @@ class FileClientCmdInterface(object):
             self.error('wrong options, need `%s remote local`.' % args[0])
         self.client.recv(args[1], args[2])
 
+    def start_job(self, args):
+        if not self.write_job_line_function:
+            self.error("background cmds aren't supported.")
+        if args[0] == 'follow':
+            if len(args) not in (2, 3):
+                self.error('wrong options, need `follow remote_path [local_path] &`.')
+        elif len(args) != 3:
+            self.error('wrong options, need `%s src dst &`.' % args[0])
+        if '-' in args[1:]:
+            self.error("- can't be used in background cmds.")
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        def write_line_function(data):
+            self.write_job_line_function(job_id, data)
+        job = FileTransferJob(job_id, ' '.join(args), write_line_function,
+                              self.close_job_function, self.logger,
+                              self.get_grant_function(job_id))
+        job.client.rate_limiters = [self.rate_limiter, job.rate_limiter]
+        job.client.progress = TransferProgress('off')
+        self.jobs[job_id] = job
+        # The foreground cwds can change while the job is running.
+        def get_remote_path(path):
+            if path.startswith('~'):
+                return path
+            return os.path.join(self.current_dir, path)
+        if args[0] in ('lcp', 'send'):
+            job.start(FileClient.send, os.path.abspath(expand_path(args[1])),
+                      get_remote_path(args[2]))
+        elif args[0] == 'follow':
+            job.start(FileClient.follow, get_remote_path(args[1]),
+                      self.get_output_function(args[2] if len(args) == 3 else None))
+        else:
+            job.start(FileClient.recv, get_remote_path(args[1]),
+                      os.path.abspath(expand_path(args[2])))
+        sys.stdout.write('[%d] %s\n' % (job_id, job.cmdline))
+
+    def get_jobs(self, args):
+        if len(args) == 1:
+            return self.jobs.values()
+        jobs = []
+        for arg in args[1:]:
+            job_id = int(arg.lstrip('%')) if arg.lstrip('%').isdigit() else None
+            if job_id not in self.jobs:
+                self.error('no such job: %s' % arg)
+            jobs.append(self.jobs[job_id])
+        return jobs
+
+    def list_jobs(self):
+        for job in self.jobs.values():
+            sys.stdout.write('[%d] %-10s %s  %s\n' % (job.job_id, job.state, job.cmdline,
+                                                      job.client.progress.get_summary()))
+        for job_id in [job.job_id for job in self.jobs.values() if job.state != 'running']:
+            del self.jobs[job_id]
+
+    def set_rate_limit(self, args):
+        if len(args) == 1:
+            sys.stdout.write('session: limit %s/s, achieved %s/s\n' % (
+                format_size(self.rate_limiter.get_rate()),
+                format_size(self.rate_limiter.get_achieved_rate())))
+            for job in self.jobs.values():
+                sys.stdout.write('[%d] limit %s/s, achieved %s/s  %s\n' % (
+                    job.job_id, format_size(job.rate_limiter.get_rate()),
+                    format_size(job.rate_limiter.get_achieved_rate()), job.cmdline))
+            return
+        if len(args) > 3:
+            self.error('wrong options, need `limit [job_id] rate`.')
+        try:
+            rate = parse_size(args[-1])
+        except ValueError:
+            self.error('wrong rate: %s' % args[-1])
+        if len(args) == 2:
+            job_id = 0
+            self.rate_limiter.set_rate(rate)
+        else:
+            job = self.get_jobs(args[:2])[0]
+            job_id = job.job_id
+            job.rate_limiter.set_rate(rate)
+        if self.set_remote_rate_function:
+            self.set_remote_rate_function(job_id, rate)
+
+    def set_progress_mode(self, args):
+        if len(args) != 2 or args[1] not in ('line', 'json', 'off'):
+            self.error('wrong options, need `progress line|json|off`.')
+        self.client.progress.mode = args[1]
+
+    def wait_jobs(self, args):
+        for job in self.get_jobs(args):
+            job.wait()
+            if job.job_id in self.jobs:
+                del self.jobs[job.job_id]
+
+    def cancel_jobs(self, args):
+        for job in self.get_jobs(args):
+            job.cancel()
+        for job in self.get_jobs(args):
+            job.wait()
+
+    def edit_file(self, args):
+        if len(args) != 2:
+            self.error('wrong options, need `edit remote_path`.')
+        remote = os.path.normpath(os.path.join(self.current_dir, args[1]))
+        path_type, size, mtime, file_hash = self.client.stat(remote)
+        if path_type == 'dir':
+            self.error("%s is a dir, can't edit it." % remote)
+        # Transfers of the edit don't show progress, which would be mixed with
+        # the editor.
+        progress = self.client.progress
+        self.client.progress = None
+        try:
+            cache = self.edit_cache
+            base = cache.get_base_path(remote)
+            work = cache.get_work_path(remote)
+            mkdir(os.path.dirname(work))
+            if path_type == 'not_exist':
+                touch(base)
+            elif not cache.is_current(remote, size, mtime, file_hash):
+                self.client.recv_file(remote, base, use_store=False)
+                cache.update(remote, size, mtime, file_hash)
+            run_cmd('cp -p %s %s' % (base, work))
+            editor = os.environ.get('EDITOR', 'vi')
+            if self.run_interactive_function('%s %s' % (editor, work)) != 0:
+                self.error('run %s failed' % editor)
+            if get_file_hash(work) == get_file_hash(base):
+                return
+            if path_type == 'not_exist':
+                self.client.send_file(work, remote)
+            else:
+                new_type, new_size, new_mtime, new_hash = self.client.stat(remote)
+                if new_hash != file_hash or not self.client.send_file_delta(work, base, remote,
+                                                                            file_hash):
+                    self.error('%s changed remotely, edited copy is kept in %s' % (remote, work))
+            run_cmd('cp -p %s %s' % (work, base))
+            cache.update(remote, *self.client.stat(remote)[1:])
+        finally:
+            self.client.progress = progress
+
+    def get_output_function(self, local=None):
+        """ Return a function writing data to stdout, or appending it to local. """
+        if local:
+            local = os.path.abspath(expand_path(local))
+        def write_output(data):
+            if local:
+                with open(local, 'ab') as f:
+                    f.write(data)
+            else:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+        return write_output
+
+    def read_file_range(self, args):
+        if len(args) not in (2, 3) or (len(args) == 3 and not args[2].isdigit()):
+            self.error('wrong options, need `%s remote_path [lines]`.' % args[0])
+        lines = int(args[2]) if len(args) == 3 else 10
+        range_spec = '%s %d' % (args[0][1:], lines)
+        if not self.client.read_range(args[1], range_spec, self.get_output_function()):
+            raise FileTransferError()
+
+    def search_files(self, args):
+        """ Search remote files, matches are saved in a local file and the
+            first page of them is shown.
+        """
+        if len(args) not in (3, 4):
+            self.error('wrong options, need `%s pattern remote_path [local_path]`.' % args[0])
+        result_path = expand_path(args[3]) if len(args) == 4 else self.search_result_path
+        mkdir(os.path.dirname(os.path.abspath(result_path)))
+        try:
+            page_size = get_terminal_size(0)[1] - 2
+        except IOError:
+            page_size = 20
+        shown = [0]
+        def write_match(match):
+            if args[0] == 'rgrep':
+                line = u'%s:%d:%s\n' % tuple(match)
+            else:
+                line = match[0] + u'\n'
+            line = line.encode('utf-8')
+            f.write(line)
+            if shown[0] < page_size:
+                sys.stdout.write(line)
+                shown[0] += 1
+        error_count = self.client.error_count
+        with open(result_path, 'wb') as f:
+            count = self.client.search(args[2], 'content' if args[0] == 'rgrep' else 'name',
+                                       args[1], write_match)
+        if self.client.error_count != error_count:
+            raise FileTransferError()
+        sys.stdout.write('%d matches saved in %s\n' % (count, result_path))
+
     def run_test(self):
         run_file_transfer_tests(self.client)
 
@@ -389,39 +1871,120 @@ class FileClientCmdInterface(object):
     lcp   -- alias to send cmd.
     recv remote_path local_path -- recv remote files to local.
     rcp   -- alias to recv cmd.
+    local cmd args... | send - remote_path -- stream output of a local cmd to a remote file.
+    recv remote_path - | cmd args... -- stream a remote file to a local cmd, or to
+                             stdout without `| cmd`.
+    edit remote_path -- edit remote file using local $EDITOR.
+    rgrep pattern remote_path [local_path] -- search lines matching a regex in remote
+                             files, save matches in local_path, show the first page.
+    rfind pattern remote_path [local_path] -- search remote files with names matching
+                             a glob pattern, save paths in local_path, show the first page.
+    rhead remote_path [lines] -- show the first lines of a remote file, 10 by default.
+    rtail remote_path [lines] -- show the last lines of a remote file, 10 by default.
+    follow remote_path [local_path] & -- show the last lines of a remote file and lines
+                             appended later in background, or append them to local_path.
+    send/recv src dst & -- run send/recv cmd in background.
+    jobs  -- list background jobs.
+    wait [job_id...] -- wait background jobs to finish.
+    cancel [job_id...] -- cancel background jobs.
+    progress line|json|off -- show send/recv progress as a status line, json lines, or not.
+    limit [job_id] [rate] -- show or set file data bytes per second of the session or
+                             a job, like 500K, 2M, 0 means unlimited.
     run script_path -- run a script.
     test  -- run file transfer test.
 """)
 
 
 class FileServer(FileBase):
+    compress_dict_decompressor = None
+    # Set after a cmd fails, until the next cmd is read.
+    skip_items = False
+
     def run(self):
         while True:
-            cmd = self.read_item('cmd')
-            if cmd == 'cd':
-                self.handle_cd()
-            elif cmd == 'get_possible_paths':
-                self.handle_get_possible_paths()
-            elif cmd == 'path_type':
-                self.handle_path_type()
-            elif cmd == 'exit':
+            cmd = self.read_cmd()
+            if cmd == 'exit':
                 break
-            elif cmd == 'send_file':
-                self.handle_send_file()
-            elif cmd == 'recv_file':
-                self.handle_recv_file()
-            elif cmd == 'mkdir':
-                self.handle_mkdir()
-            elif cmd == 'rmdir':
-                self.handle_rmdir()
-            elif cmd == 'send_link':
-                self.handle_send_link()
-            elif cmd == 'recv_link':
-                self.handle_recv_link()
-            elif cmd == 'list_dir':
-                self.handle_list_dir()
-            else:
-                self.error('unknown cmd: %s' % cmd)
+            try:
+                self.run_cmd(cmd)
+            except FileTransferJobEnd:
+                raise
+            except Exception as e:
+                # Reported by the client, which may not see the stderr of the server.
+                self.logger.log('cmd %s failed: %s' % (cmd, e))
+                self.error_count += 1
+                self.write_item('server_error', '%s %s' % (cmd, e))
+                self.skip_items = True
+
+    def read_cmd(self):
+        """ Read the next cmd. Items of a failed cmd not read by its handler
+            are skipped.
+        """
+        if not self.skip_items:
+            return self.read_item('cmd')
+        while True:
+            line = self.read_line_function()
+            if not line:
+                log_exit('unexpected end')
+            if line.startswith('cmd: '):
+                self.skip_items = False
+                return line[len('cmd: '):]
+
+    def run_cmd(self, cmd):
+        if cmd == 'cd':
+            self.handle_cd()
+        elif cmd == 'get_possible_paths':
+            self.handle_get_possible_paths()
+        elif cmd == 'path_type':
+            self.handle_path_type()
+        elif cmd == 'send_file':
+            self.handle_send_file()
+        elif cmd == 'recv_file':
+            self.handle_recv_file()
+        elif cmd == 'mkdir':
+            self.handle_mkdir()
+        elif cmd == 'rmdir':
+            self.handle_rmdir()
+        elif cmd == 'send_link':
+            self.handle_send_link()
+        elif cmd == 'recv_link':
+            self.handle_recv_link()
+        elif cmd == 'list_dir':
+            self.handle_list_dir()
+        elif cmd == 'stat':
+            self.handle_stat()
+        elif cmd == 'send_file_delta':
+            self.handle_send_file_delta()
+        elif cmd == 'recv_file_by_hash':
+            self.handle_recv_file_by_hash()
+        elif cmd == 'link_file':
+            self.handle_link_file()
+        elif cmd == 'find_duplicates':
+            self.handle_find_duplicates()
+        elif cmd == 'tree_size':
+            self.handle_tree_size()
+        elif cmd == 'find_tools':
+            self.handle_find_tools()
+        elif cmd == 'send_tar':
+            self.handle_send_tar()
+        elif cmd == 'recv_tar':
+            self.handle_recv_tar()
+        elif cmd == 'set_compress_dict':
+            self.handle_set_compress_dict()
+        elif cmd == 'send_small_file':
+            self.handle_send_small_file()
+        elif cmd == 'batch':
+            self.handle_batch()
+        elif cmd == 'exec':
+            self.handle_exec()
+        elif cmd == 'search':
+            self.handle_search()
+        elif cmd == 'read_range':
+            self.handle_read_range()
+        elif cmd == 'follow':
+            self.handle_follow()
+        else:
+            self.error('unknown cmd: %s' % cmd)
 
     def handle_cd(self):
         path = self.read_item('path')
@@ -430,6 +1993,78 @@ class FileServer(FileBase):
         else:
             self.error("Can't switch to %s" % path)
 
+    def handle_batch(self, max_results_size=32768):
+        ops = json.loads(self.read_item('ops'))
+        results = []
+        size = 0
+        for op in ops:
+            op = [arg.encode('latin-1') for arg in op]
+            try:
+                result = ['ok', self.run_batch_op(op[0], op[1:])]
+            except (OSError, IOError, ValueError) as e:
+                result = ['error', getattr(e, 'strerror', None) or str(e)]
+            result[1] = result[1].decode('latin-1')
+            result_size = len(json.dumps(result)) + 1
+            if results and size + result_size > max_results_size:
+                self.write_item('results', json.dumps(results, separators=(',', ':')))
+                results = []
+                size = 0
+            results.append(result)
+            size += result_size
+        self.write_item('results', json.dumps(results, separators=(',', ':')))
+
+    def handle_exec(self):
+        cmdline = self.read_item('cmdline')
+        with open(os.devnull, 'rb') as devnull:
+            popen_obj = subprocess.Popen(cmdline, shell=True, stdin=devnull,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        keys = {popen_obj.stdout.fileno(): 'stdout', popen_obj.stderr.fileno(): 'stderr'}
+        while keys:
+            for fd in select.select(list(keys), [], [])[0]:
+                data = os.read(fd, 4096)
+                if data:
+                    self.write_data_item(data, keys[fd])
+                else:
+                    del keys[fd]
+        popen_obj.stdout.close()
+        popen_obj.stderr.close()
+        status = popen_obj.wait()
+        self.write_item('exit_status', '%d' % (128 - status if status < 0 else status))
+
+    def run_batch_op(self, op_name, args):
+        if op_name == 'mkdir':
+            path = expand_path(args[0])
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        elif op_name == 'rmdir':
+            if args[0] in ('~', '/'):
+                return ''
+            path = expand_path(args[0])
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+        elif op_name == 'path_type':
+            return self.get_path_type(expand_path(args[0]))
+        elif op_name == 'send_link':
+            remote, link = args
+            dirpath = os.path.split(remote)[0]
+            if dirpath and not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            os.symlink(link, remote)
+        elif op_name == 'cd':
+            os.chdir(args[0])
+        else:
+            raise ValueError('unknown op: %s' % op_name)
+        return ''
+
+    def get_path_type(self, path):
+        if os.path.isfile(path):
+            return 'file'
+        if os.path.isdir(path):
+            return 'dir'
+        return 'not_exist'
+
     def handle_get_possible_paths(self):
         path = self.read_item('path')
         possible_paths = get_possible_local_paths(path)
@@ -438,13 +2073,7 @@ class FileServer(FileBase):
     def handle_path_type(self):
         path = self.read_item('path')
         path = expand_path(path)
-        if os.path.isfile(path):
-            path_type = 'file'
-        elif os.path.isdir(path):
-            path_type = 'dir'
-        else:
-            path_type = 'not_exist'
-        self.write_item('type', path_type)
+        self.write_item('type', self.get_path_type(path))
 
     def handle_send_file(self):
         local = self.read_item('local')
@@ -454,19 +2083,7 @@ class FileServer(FileBase):
             mkdir(dirpath)
         file_type = self.read_item('file_type')
         with open(remote, 'wb') as f:
-            size = 0
-            while True:
-                key, value = self.read_items(['data', 'data_end'])
-                if key == 'data':
-                    data = self.string_to_binary_data(value)
-                    size += len(data)
-                    f.write(data)
-                elif key == 'data_end':
-                    sent_size = int(value)
-                    if size != sent_size:
-                        sys.stderr.write('send_file %s to %s, sent_size %d, recv_size %d' % (
-                            local, remote, sent_size, size))
-                    break
+            self.recv_file_data(f, local, remote, 'send_file')
         if 'executable' in file_type:
             run_cmd('chmod a+x %s' % remote)
 
@@ -475,16 +2092,16 @@ class FileServer(FileBase):
         local = self.read_item('local')
         file_type = get_file_type(remote)
         self.write_item('file_type', ', '.join(file_type))
-        with open(remote, 'rb') as f:
-            size = 0
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                size += len(data)
-                s = self.binary_data_to_string(data)
-                self.write_item('data', s)
-            self.write_item('data_end', '%d' % size)
+        self.send_file_data(remote)
+
+    def handle_recv_file_by_hash(self):
+        remote = self.read_item('remote')
+        local = self.read_item('local')
+        file_type = get_file_type(remote)
+        self.write_item('file_type', ', '.join(file_type))
+        self.write_item('hash', get_file_hash(remote))
+        if self.read_item('need_data') == 'yes':
+            self.send_file_data(remote)
 
     def handle_mkdir(self):
         path = self.read_item('path')
@@ -534,6 +2151,296 @@ class FileServer(FileBase):
         self.write_item('files', ', '.join(files))
         self.write_item('links', ', '.join(links))
 
+    def handle_stat(self):
+        path = expand_path(self.read_item('path'))
+        size = 0
+        mtime = ''
+        file_hash = ''
+        if os.path.isfile(path):
+            path_type = 'file'
+            st = os.stat(path)
+            size = st.st_size
+            mtime = '%f' % st.st_mtime
+            file_hash = get_file_hash(path)
+        elif os.path.isdir(path):
+            path_type = 'dir'
+        else:
+            path_type = 'not_exist'
+        self.write_item('type', path_type)
+        self.write_item('size', '%d' % size)
+        self.write_item('mtime', mtime)
+        self.write_item('hash', file_hash)
+
+    def handle_send_file_delta(self):
+        remote = expand_path(self.read_item('remote'))
+        base_hash = self.read_item('base_hash')
+        blocks = []
+        while True:
+            key, value = self.read_items(['offset', 'data_end'])
+            if key == 'data_end':
+                new_size = int(value)
+                break
+            blocks.append((int(value), self.string_to_binary_data(self.read_item('data'))))
+        if not os.path.isfile(remote) or get_file_hash(remote) != base_hash:
+            self.write_item('result', 'base_mismatch')
+            return
+        with open(remote, 'r+b') as f:
+            for offset, data in blocks:
+                f.seek(offset)
+                f.write(data)
+            f.truncate(new_size)
+        self.write_item('result', 'ok')
+
+    def handle_link_file(self):
+        remote = self.read_item('remote')
+        target = self.read_item('target')
+        link_type = self.read_item('link_type')
+        file_type = split_string(self.read_item('file_type'))
+        dirpath = os.path.split(remote)[0]
+        if dirpath:
+            mkdir(dirpath)
+        self.create_duplicate_file(target, remote, link_type, file_type)
+
+    def handle_find_duplicates(self):
+        path = expand_path(self.read_item('path'))
+        if not path.endswith('/'):
+            path += '/'
+        finder = DuplicateFinder()
+        count = 0
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                sub_path = os.path.join(root, f)
+                if os.path.islink(sub_path) or not os.path.isfile(sub_path):
+                    continue
+                duplicate = finder.add(sub_path, sub_path[len(path):])
+                if duplicate:
+                    self.write_item('duplicate', sub_path[len(path):])
+                    self.write_item('original', duplicate[1])
+                    self.write_item('link_type', duplicate[0])
+                    self.write_item('file_type', ', '.join(get_file_type(sub_path)))
+                    count += 1
+        self.write_item('duplicates_end', '%d' % count)
+
+    def handle_search(self, worker_count=4, max_line_size=1024, block_size=1024 * 1024):
+        path = expand_path(self.read_item('path'))
+        mode = self.read_item('mode')
+        pattern = self.read_item('pattern')
+        max_matches = int(self.read_item('max_matches'))
+        if not os.path.exists(path):
+            self.write_item('search_error', "%s doesn't exist" % path)
+            return
+        if mode == 'content':
+            try:
+                regex = re.compile(pattern)
+                block_regex = re.compile(pattern, re.MULTILINE)
+            except re.error as e:
+                self.write_item('search_error', 'bad pattern: %s' % e)
+                return
+        elif mode != 'name':
+            self.write_item('search_error', 'unknown mode: %s' % mode)
+            return
+
+        def to_unicode(s):
+            return s.decode('utf-8', 'replace')
+
+        def search_file(file_path):
+            # Search blocks of whole lines, and only split lines around matches.
+            # A match in a block may span lines, so the line is searched again.
+            # Matches are sent per block, and searching stops at max_matches
+            # even in the middle of a large file.
+            try:
+                with open(file_path, 'rb') as f:
+                    block = f.read(block_size)
+                    if '\0' in block[:8192]:
+                        return
+                    line_number = 1
+                    while block and not stop_event.is_set():
+                        data = f.read(block_size)
+                        end = block.rfind('\n') + 1 if data else len(block)
+                        if end == 0:
+                            block += data
+                            continue
+                        matches = []
+                        pos = counted_pos = 0
+                        while pos < end:
+                            m = block_regex.search(block, pos, end)
+                            # An empty match at the end isn't in a line.
+                            if not m or (m.start() == end and block[end - 1] == '\n'):
+                                break
+                            line_start = block.rfind('\n', 0, m.start()) + 1
+                            line_end = block.find('\n', m.start(), end)
+                            if line_end == -1:
+                                line_end = end
+                            line = block[line_start:line_end].rstrip('\r')
+                            if regex.search(line):
+                                line_number += block.count('\n', counted_pos, line_start)
+                                counted_pos = line_start
+                                matches.append([to_unicode(file_path), line_number,
+                                                to_unicode(line[:max_line_size])])
+                            pos = line_end + 1
+                        line_number += block.count('\n', counted_pos, end)
+                        block = block[end:] + data
+                        if matches:
+                            match_queue.put(matches)
+            except IOError:
+                pass
+
+        stop_event = threading.Event()
+        # Both queues are bounded, so walking dirs doesn't run ahead of searching,
+        # and searching doesn't run ahead of sending matches.
+        path_queue = Queue(maxsize=1024)
+        match_queue = Queue(maxsize=worker_count * 4)
+
+        def walk_thread_func():
+            walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+            if os.path.isdir(path):
+                walk = os.walk(path)
+            for root, dirs, files in walk:
+                if stop_event.is_set():
+                    break
+                for name in dirs + files:
+                    file_path = os.path.join(root, name)
+                    if mode == 'name':
+                        if fnmatch.fnmatch(name, pattern):
+                            match_queue.put([[to_unicode(file_path)]])
+                    elif os.path.isfile(file_path):
+                        path_queue.put(file_path)
+            for i in range(worker_count):
+                path_queue.put(None)
+            match_queue.put(None)
+
+        def search_thread_func():
+            while True:
+                file_path = path_queue.get()
+                if file_path is None:
+                    break
+                if not stop_event.is_set():
+                    search_file(file_path)
+            match_queue.put(None)
+
+        threads = [threading.Thread(target=walk_thread_func)]
+        if mode == 'content':
+            threads += [threading.Thread(target=search_thread_func) for i in range(worker_count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        count = 0
+        running_threads = len(threads)
+        while running_threads:
+            matches = match_queue.get()
+            if matches is None:
+                running_threads -= 1
+                continue
+            for match in matches:
+                if stop_event.is_set():
+                    break
+                self.write_item('match', json.dumps(match, separators=(',', ':')))
+                count += 1
+                if count == max_matches:
+                    stop_event.set()
+        self.write_item('search_end', '%d' % count)
+
+    def handle_read_range(self):
+        path = expand_path(self.read_item('path'))
+        args = self.read_item('range').split()
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if args[0] == 'bytes':
+                    start = int(args[1])
+                    start = max(0, size + start) if start < 0 else min(start, size)
+                    end = size if int(args[2]) < 0 else min(size, start + int(args[2]))
+                elif args[0] == 'head':
+                    start, end = 0, get_head_end(f, size, int(args[1]))
+                elif args[0] == 'tail':
+                    start, end = get_tail_start(f, size, int(args[1])), size
+                else:
+                    raise ValueError('unknown range: %s' % ' '.join(args))
+                self.send_range(f, start, end, size)
+        except (IOError, OSError, ValueError, IndexError) as e:
+            self.write_item('range_error', getattr(e, 'strerror', None) or str(e))
+
+    def handle_follow(self):
+        path = expand_path(self.read_item('path'))
+        offset = int(self.read_item('offset'))
+        inode = int(self.read_item('inode'))
+        timeout = float(self.read_item('timeout'))
+        wait_file_change(path, offset, timeout, inode)
+        if not os.path.exists(path):
+            self.write_item('range_end', '%d %d %d %d' % (offset, offset, offset, inode))
+            return
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                start = offset if st.st_size >= offset and st.st_ino == inode else 0
+                self.send_range(f, start, st.st_size, st.st_size)
+        except (IOError, OSError) as e:
+            self.write_item('range_error', e.strerror or str(e))
+
+    def send_range(self, f, start, end, size):
+        f.seek(start)
+        offset = start
+        while offset < end:
+            data = f.read(min(4096, end - offset))
+            if not data:
+                break
+            self.write_data_item(data)
+            offset += len(data)
+        self.write_item('range_end', '%d %d %d %d' % (start, offset, size,
+                                                       os.fstat(f.fileno()).st_ino))
+
+    def handle_tree_size(self):
+        path = expand_path(self.read_item('path'))
+        size, file_count = get_tree_size(path)
+        self.write_item('size', '%d' % size)
+        self.write_item('files', '%d' % file_count)
+
+    def handle_find_tools(self):
+        names = split_string(self.read_item('names'))
+        self.write_item('tools', ', '.join(find_tools(names)))
+
+    def handle_send_tar(self):
+        path = expand_path(self.read_item('remote'))
+        remove(path)
+        mkdir(path)
+        self.write_item('result', self.read_tar_data(path) or 'ok')
+
+    def handle_recv_tar(self):
+        path = expand_path(self.read_item('remote'))
+        self.write_item('result', self.write_tar_data(path) or 'ok')
+
+    def handle_set_compress_dict(self):
+        decompressor = zlib.decompressobj()
+        size = 0
+        while True:
+            key, value = self.read_items(('data', 'data_end'))
+            if key == 'data_end':
+                break
+            data = self.string_to_binary_data(value)
+            size += len(data)
+            decompressor.decompress(data)
+        if size != int(value):
+            self.error('set_compress_dict, sent_size %s, recv_size %d' % (value, size))
+        self.compress_dict_decompressor = decompressor
+
+    def handle_send_small_file(self):
+        remote = self.read_item('remote')
+        file_type = self.read_item('file_type')
+        size = int(self.read_item('size'))
+        decompressor = self.compress_dict_decompressor.copy()
+        data = self.string_to_binary_data(self.read_item('data'))
+        data = decompressor.decompress(data) + decompressor.flush()
+        if len(data) != size:
+            self.error('send_small_file %s, sent_size %d, recv_size %d' %
+                (remote, size, len(data)))
+        dirpath = os.path.split(remote)[0]
+        if dirpath:
+            mkdir(dirpath)
+        with open(remote, 'wb') as f:
+            f.write(data)
+        if 'executable' in file_type:
+            run_cmd('chmod a+x %s' % remote)
+
 
 class FileTransferTests(object):
     def __init__(self, file_client):
@@ -550,6 +2457,17 @@ class FileTransferTests(object):
         with open(path, 'wb') as f:
             f.write(self.test_data)
 
+    def write_sparse_test_file(self, path):
+        with open(path, 'wb') as f:
+            f.seek(1 << 20)
+            f.write(self.test_data)
+            f.truncate(4 << 20)
+
+    def check_sparse_file(self, path, expected_path):
+        self.check_file(path, expected_path)
+        if os.stat(path).st_blocks * 512 >= os.stat(path).st_size:
+            self.file_client.error('%s is not sparse' % path)
+
     def check_file(self, path, expected_path):
         def get_file_data(path):
             with open(path, 'rb') as f:
@@ -657,6 +2575,280 @@ class FileTransferTests(object):
         self.check_dir(recv_dir, send_dir)
         self.teardown_test()
 
+    def test_send_recv_dirs_by_tar(self):
+        if not find_tools(['tar']):
+            return
+        self.setup_test()
+        client = self.file_client
+        client.tar_min_files = 0
+        try:
+            send_dir = os.path.join(get_script_dir(), 'testdata')
+            client.send(send_dir, self.remote_test_dir)
+            if client.engine != 'tar':
+                client.error('send dir by %s, expected tar' % client.engine)
+            client.recv(os.path.join(self.remote_test_dir, 'testdata'), self.test_dir)
+            if client.engine != 'tar':
+                client.error('recv dir by %s, expected tar' % client.engine)
+            self.check_dir(os.path.join(self.test_dir, 'testdata'), send_dir)
+            sparse_dir = os.path.join(self.test_dir, 'sparse_dir')
+            mkdir(sparse_dir)
+            self.write_sparse_test_file(os.path.join(sparse_dir, 'sparse_file'))
+            client.send(sparse_dir, self.remote_test_dir)
+            recv_dir = os.path.join(self.test_dir, 'recv')
+            mkdir(recv_dir)
+            client.recv(os.path.join(self.remote_test_dir, 'sparse_dir'), recv_dir)
+            self.check_sparse_file(os.path.join(recv_dir, 'sparse_dir', 'sparse_file'),
+                                   os.path.join(sparse_dir, 'sparse_file'))
+        finally:
+            del client.tar_min_files
+        self.teardown_test()
+
+    def test_send_recv_dirs_with_compress_dict(self):
+        self.setup_test()
+        send_dir = os.path.join(self.test_dir, 'small_files')
+        mkdir(send_dir)
+        for i in range(40):
+            with open(os.path.join(send_dir, 'file%d.py' % i), 'wb') as f:
+                f.write('# Test file shared header.\nimport os\nimport sys\n\n')
+                f.write('def f%d():\n    return %d\n' % (i, i * i))
+        run_cmd('chmod a+x %s' % os.path.join(send_dir, 'file0.py'))
+        self.file_client.send(send_dir, self.remote_test_dir)
+        mkdir(os.path.join(self.test_dir, 'recv'))
+        self.file_client.recv(os.path.join(self.remote_test_dir, 'small_files'),
+                              os.path.join(self.test_dir, 'recv'))
+        self.check_dir(os.path.join(self.test_dir, 'recv', 'small_files'), send_dir)
+        self.teardown_test()
+
+    def test_recv_file_by_content_store(self):
+        self.setup_test()
+        client = self.file_client
+        test_file = os.path.join(self.test_dir, 'file_transfer_test')
+        self.write_test_file(test_file)
+        remote_test_file = os.path.join(self.remote_test_dir, 'file_transfer_test')
+        client.send(test_file, remote_test_file)
+        content_store = client.content_store
+        client.content_store = ContentStore(os.path.join(self.test_dir, 'store'))
+        try:
+            recv_files = [os.path.join(self.test_dir, 'recv%d' % i) for i in range(2)]
+            for recv_file in recv_files:
+                client.recv(remote_test_file, recv_file)
+            # The second file is from the store, writing the first doesn't change it.
+            with open(recv_files[0], 'ab') as f:
+                f.write('x')
+            self.check_file(recv_files[1], test_file)
+        finally:
+            client.content_store = content_store
+        self.teardown_test()
+
+    def test_server_error(self):
+        self.setup_test()
+        client = self.file_client
+        test_file = os.path.join(self.test_dir, 'file_transfer_test')
+        self.write_test_file(test_file)
+        remote_test_file = os.path.join(self.remote_test_dir, 'file_transfer_test')
+        client.send(test_file, remote_test_file)
+        errors = []
+        client.error = errors.append
+        try:
+            # Fails in the server, as the parent dir is a file.
+            client.send(test_file, os.path.join(remote_test_file, 'x'))
+            client.wait_cmds_done()
+        finally:
+            del client.error
+        if len(errors) != 1 or not errors[0].startswith('remote send_file failed'):
+            client.error('expected a send_file error, but get %s' % errors)
+        # The server still runs cmds after the failed one.
+        client.recv(remote_test_file, os.path.join(self.test_dir, 'recv_test'))
+        self.check_file(os.path.join(self.test_dir, 'recv_test'), test_file)
+        self.teardown_test()
+
+    def test_send_file_delta(self):
+        self.setup_test()
+        test_file = os.path.join(self.test_dir, 'file_transfer_test')
+        self.write_test_file(test_file)
+        remote_test_file = os.path.join(self.remote_test_dir, 'file_transfer_test')
+        self.file_client.send(test_file, remote_test_file)
+        base_hash = self.file_client.stat(remote_test_file)[3]
+        edit_file = os.path.join(self.test_dir, 'file_transfer_edit_file')
+        with open(edit_file, 'wb') as f:
+            f.write(self.test_data[:5000] + 'edit' + self.test_data[5004:-100])
+        if not self.file_client.send_file_delta(edit_file, test_file, remote_test_file, base_hash):
+            self.file_client.error('send_file_delta(%s) failed' % remote_test_file)
+        recv_file = os.path.join(self.test_dir, 'file_transfer_recv_file')
+        self.file_client.recv(remote_test_file, recv_file)
+        self.check_file(recv_file, edit_file)
+        self.teardown_test()
+
+    def test_send_recv_dirs_with_duplicates(self):
+        self.setup_test()
+        send_dir = os.path.join(self.test_dir, 'send_dir')
+        mkdir(os.path.join(send_dir, 'subdir'))
+        self.write_test_file(os.path.join(send_dir, 'file'))
+        self.write_test_file(os.path.join(send_dir, 'subdir', 'copy'))
+        os.link(os.path.join(send_dir, 'file'), os.path.join(send_dir, 'subdir', 'link'))
+        self.file_client.send(send_dir, self.remote_test_dir)
+        self.file_client.recv(os.path.join(self.remote_test_dir, 'send_dir'), self.test_dir + '/recv_dir')
+        recv_dir = os.path.join(self.test_dir, 'recv_dir')
+        self.check_dir(recv_dir, send_dir)
+        if (os.stat(os.path.join(recv_dir, 'file')).st_ino !=
+                os.stat(os.path.join(recv_dir, 'subdir', 'link')).st_ino):
+            self.file_client.error('hardlink in %s is not preserved' % recv_dir)
+        self.teardown_test()
+
+    def test_send_recv_sparse_file(self):
+        self.setup_test()
+        test_file = os.path.join(self.test_dir, 'file_transfer_sparse_file')
+        self.write_sparse_test_file(test_file)
+        remote_test_file = os.path.join(self.remote_test_dir, 'file_transfer_sparse_file')
+        self.file_client.send(test_file, remote_test_file)
+        recv_file = os.path.join(self.test_dir, 'file_transfer_recv_file')
+        self.file_client.recv(remote_test_file, recv_file)
+        self.check_sparse_file(recv_file, test_file)
+        self.teardown_test()
+
+    def test_send_recv_stream(self):
+        self.setup_test()
+        test_file = os.path.join(self.test_dir, 'file_transfer_test_file')
+        self.write_test_file(test_file)
+        expected_data = self.test_data + '\0' * 8192 + self.test_data[:100]
+        remote_test_file = os.path.join(self.remote_test_dir, 'file_transfer_stream_file')
+        popen_obj = subprocess.Popen("cat %s; head -c 8192 /dev/zero; head -c 100 %s" % (
+                                     test_file, test_file), shell=True, stdout=subprocess.PIPE)
+        self.file_client.send_stream(popen_obj.stdout, remote_test_file)
+        popen_obj.wait()
+        popen_obj = subprocess.Popen('cat', shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        def recv_thread_func():
+            self.file_client.recv_stream(remote_test_file, popen_obj.stdin)
+            popen_obj.stdin.close()
+        thread = threading.Thread(target=recv_thread_func)
+        thread.start()
+        data = popen_obj.stdout.read()
+        thread.join()
+        popen_obj.wait()
+        if data != expected_data:
+            self.file_client.error('recv_stream gets %d bytes, expected %d' % (
+                                   len(data), len(expected_data)))
+        # The reader of the pipe exits early.
+        popen_obj = subprocess.Popen('head -c 10 >/dev/null', shell=True,
+                                     stdin=subprocess.PIPE)
+        self.file_client.recv_stream(remote_test_file, popen_obj.stdin)
+        popen_obj.stdin.close()
+        popen_obj.wait()
+        self.teardown_test()
+
+    def test_relay(self):
+        self.setup_test()
+        send_dir = os.path.join(get_script_dir(), 'testdata')
+        self.file_client.send(send_dir, self.remote_test_dir)
+        # Relay to a FileServer in this process.
+        server_read_queue, server_write_queue = Queue(), Queue()
+        server = FileServer(server_write_queue.put, server_read_queue.get, self.file_client.logger)
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        dst_client = FileClient(server_read_queue.put, server_write_queue.get,
+                                self.file_client.logger)
+        self.file_client.relay(os.path.join(self.remote_test_dir, 'testdata'), dst_client,
+                               self.test_dir)
+        dst_client.write_item('cmd', 'exit')
+        thread.join()
+        self.check_dir(os.path.join(self.test_dir, 'testdata'), send_dir)
+        self.teardown_test()
+
+    def test_exec_cmd(self):
+        output = []
+        error = []
+        status = self.file_client.exec_cmd('echo out; echo err >&2; exit 3', output.append,
+                                           error.append)
+        if status != 3 or ''.join(output) != 'out\n' or ''.join(error) != 'err\n':
+            self.file_client.error('exec_cmd returns %d, stdout %r, stderr %r' % (
+                                   status, ''.join(output), ''.join(error)))
+        output = []
+        status = self.file_client.exec_cmd('head -c 100000 /dev/zero; kill -9 $$',
+                                           output.append)
+        if status != 128 + 9 or ''.join(output) != '\0' * 100000:
+            self.file_client.error('exec_cmd returns %d, output size %d' % (
+                                   status, len(''.join(output))))
+
+    def test_read_range(self):
+        self.setup_test()
+        test_file = os.path.join(self.test_dir, 'lines')
+        lines = ['line %d\n' % i for i in range(10000)]
+        with open(test_file, 'w') as f:
+            f.write(''.join(lines))
+        remote_file = os.path.join(self.remote_test_dir, 'lines')
+        self.file_client.send(test_file, remote_file)
+        size = len(''.join(lines))
+        for range_spec, expected_data in [('head 3', lines[:3]), ('tail 2', lines[-2:]),
+                                     ('bytes 7 9', ['line 1\nli']), ('bytes -7 -1', ['e 9999\n']),
+                                     ('bytes 0 -1', lines), ('head 0', [])]:
+            data = []
+            result = self.file_client.read_range(remote_file, range_spec, data.append)
+            expected_data = ''.join(expected_data)
+            if ''.join(data) != expected_data or not result or result[2] != size:
+                self.file_client.error('read_range %s returns %s, data size %d' % (
+                                       range_spec, result, len(''.join(data))))
+        self.teardown_test()
+
+    def test_search(self):
+        self.setup_test()
+        remote_dir = os.path.join(self.remote_test_dir, 'search')
+        self.file_client.mkdir(os.path.join(remote_dir, 'sub'))
+        for i in range(20):
+            test_file = os.path.join(self.test_dir, 'file%d.txt' % i)
+            with open(test_file, 'w') as f:
+                f.write(''.join('line %d of file %d\n' % (j, i) for j in range(100)))
+            self.file_client.send(test_file, os.path.join(remote_dir, 'sub', 'file%d.txt' % i))
+        binary_file = os.path.join(self.test_dir, 'binary')
+        self.write_test_file(binary_file)
+        self.file_client.send(binary_file, os.path.join(remote_dir, 'binary'))
+        matches = []
+        count = self.file_client.search(remote_dir, 'content', r'line 7\d of file 1\b',
+                                        matches.append)
+        expected = [[os.path.join(remote_dir, 'sub', 'file1.txt'), i + 1,
+                     'line %d of file 1' % i] for i in range(70, 80)]
+        if count != 10 or sorted(matches) != expected:
+            self.file_client.error('search content returns %d, %s' % (count, matches))
+        matches = []
+        count = self.file_client.search(remote_dir, 'name', 'file1?.txt', matches.append)
+        if count != 10 or len(matches) != 10:
+            self.file_client.error('search name returns %d, %s' % (count, matches))
+        count = self.file_client.search(remote_dir, 'content', 'line', lambda match: None, 5)
+        if count != 5:
+            self.file_client.error('search with max_matches returns %d' % count)
+        count = self.file_client.search(remote_dir, 'content', '^$', lambda match: None)
+        if count != 0:
+            self.file_client.error('search empty lines returns %d' % count)
+        self.teardown_test()
+
+    def test_run_batch(self):
+        self.setup_test()
+        remote_dir = os.path.join(self.remote_test_dir, 'batch')
+        ops = [['mkdir', os.path.join(remote_dir, 'dir%d' % i, 'subdir')] for i in range(3000)]
+        ops += [['send_link', os.path.join(remote_dir, 'link'), 'dir0'],
+                ['path_type', os.path.join(remote_dir, 'dir0')],
+                ['path_type', os.path.join(remote_dir, 'not_exist')],
+                ['rmdir', os.path.join(remote_dir, 'dir1')],
+                ['path_type', os.path.join(remote_dir, 'dir1')],
+                ['cd', os.path.join(remote_dir, 'not_exist')]]
+        results = self.file_client.run_batch(ops, max_pending_batches=2)
+        if (len(results) != len(ops) or results[0] != ['ok', ''] or
+                results[-6:-1] != [['ok', ''], ['ok', 'dir'], ['ok', 'not_exist'], ['ok', ''],
+                                   ['ok', 'not_exist']] or results[-1][0] != 'error'):
+            self.file_client.error('run_batch returns %s' % results[-6:])
+        # Results of short failed ops are larger than the ops.
+        ops = [['cd', 'nx%x' % i] for i in range(3000)]
+        results = self.file_client.run_batch(ops)
+        if results != [['error', 'No such file or directory']] * len(ops):
+            self.file_client.error('run_batch returns %s' % results[:2])
+        # Paths may not be utf-8.
+        ops = [['mkdir', os.path.join(remote_dir, '\xff')],
+               ['path_type', os.path.join(remote_dir, '\xff')]]
+        results = self.file_client.run_batch(ops)
+        if results != [['ok', ''], ['ok', 'dir']]:
+            self.file_client.error('run_batch returns %s' % results)
+        self.teardown_test()
+
 def run_file_transfer_tests(file_client):
     test = FileTransferTests(file_client)
     test.test_send_recv_file()
@@ -664,6 +2856,19 @@ def run_file_transfer_tests(file_client):
     test.test_send_recv_exec_file()
     test.test_send_recv_link_file()
     test.test_send_recv_dirs()
+    test.test_send_recv_dirs_by_tar()
+    test.test_send_recv_dirs_with_compress_dict()
+    test.test_recv_file_by_content_store()
+    test.test_server_error()
+    test.test_send_file_delta()
+    test.test_send_recv_dirs_with_duplicates()
+    test.test_send_recv_sparse_file()
+    test.test_send_recv_stream()
+    test.test_relay()
+    test.test_run_batch()
+    test.test_exec_cmd()
+    test.test_search()
+    test.test_read_range()
     sys.stdout.write('test done!\n')
 
 
@@ -0,0 +1,468 @@
+"""
+screen: a VT100 screen model fed with pty output.
+
+SSHServer uses it in screen mode: when the pty writes more than a screen of
+data in a frame, only the difference between the screen and what the client
+terminal shows is sent.
+"""
+
+import codecs
+import re
+import unicodedata
+
+
+class Screen(object):
+    """ Keep the content of a VT100 screen.
+
+        What the client terminal shows before the first clear is unknown, so
+        the screen starts untrusted unless trusted is set. Sequences not
+        understood also make the screen untrusted, until the screen is
+        cleared or reset. Sequences which don't change the screen content,
+        like terminal modes, titles and bells, are kept as side effects, which
+        should be passed to the client terminal as is.
+    """
+    text_pattern = re.compile(u'[^\x00-\x1f\x7f-\x9f]+')
+
+    # Private modes only affecting the client terminal.
+    side_effect_modes = (1, 12, 25, 1000, 1002, 1003, 1004, 1005, 1006, 1015, 2004)
+
+    def __init__(self, width=80, height=24, trusted=False):
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.width = width
+        self.height = height
+        self.state = 'normal'
+        self.seq = u''
+        self.side_effects = []
+        self.trusted = trusted
+        # Set when a side effect changes what the client terminal shows.
+        self.client_screen_changed = False
+        self.reset()
+
+    def reset(self):
+        self.rows = [self.blank_row() for _ in range(self.height)]
+        self.alt_rows = None
+        self.x = 0
+        self.y = 0
+        self.wrap_pending = False
+        self.autowrap = True
+        self.top = 0
+        self.bottom = self.height - 1
+        self.sgr_flags = []
+        self.fg = None
+        self.bg = None
+        self.attr = ''
+        self.saved_cursor = (0, 0, [], None, None)
+
+    def blank_row(self):
+        return [(u' ', '')] * self.width
+
+    def resize(self, width, height):
+        if width == self.width and height == self.height:
+            return
+        def resize_rows(rows):
+            rows = [(row + [(u' ', '')] * width)[:width] for row in rows]
+            if height < len(rows):
+                rows = rows[len(rows) - height:]
+            return rows + [[(u' ', '')] * width for _ in range(height - len(rows))]
+        self.y = max(0, min(height - 1, self.y - max(0, self.height - height)))
+        self.x = min(width - 1, self.x)
+        self.width = width
+        self.height = height
+        self.rows = resize_rows(self.rows)
+        if self.alt_rows is not None:
+            self.alt_rows = resize_rows(self.alt_rows)
+        self.top = 0
+        self.bottom = height - 1
+        self.wrap_pending = False
+
+    def take_side_effects(self):
+        side_effects = ''.join(self.side_effects)
+        self.side_effects = []
+        return side_effects
+
+    def snapshot(self):
+        return ([row[:] for row in self.rows], self.top, self.bottom)
+
+    def take_raw_snapshot(self):
+        """ Called when the raw data fed to the screen has been sent to the
+            client. Return what the client terminal shows, or None if unknown.
+        """
+        self.side_effects = []
+        self.client_screen_changed = False
+        return self.snapshot() if self.trusted else None
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        i = 0
+        while i < len(text):
+            if self.state == 'normal':
+                m = self.text_pattern.match(text, i)
+                if m:
+                    self.put_text(m.group())
+                    i = m.end()
+                    continue
+                self.handle_control(text[i])
+            elif self.state == 'esc':
+                self.handle_esc(text[i])
+            elif self.state == 'csi':
+                self.seq += text[i]
+                if u'\x40' <= text[i] <= u'\x7e':
+                    self.state = 'normal'
+                    self.handle_csi(self.seq)
+            elif self.state == 'string':
+                # OSC, DCS and other string sequences end with BEL or ESC \.
+                self.seq += text[i]
+                if text[i] == u'\x07' or self.seq.endswith(u'\x1b\\'):
+                    self.state = 'normal'
+                    self.add_side_effect(self.seq)
+            elif self.state == 'charset':
+                self.state = 'normal'
+                if text[i] not in u'B':
+                    self.trusted = False
+                self.add_side_effect(self.seq + text[i])
+            elif self.state == 'esc_hash':
+                self.state = 'normal'
+                self.trusted = False
+            i += 1
+
+    def add_side_effect(self, seq):
+        self.side_effects.append(seq)
+
+    def put_text(self, text):
+        for c in text:
+            if c >= u'\u0300' and (unicodedata.combining(c) or
+                                   unicodedata.east_asian_width(c) in ('W', 'F')):
+                self.trusted = False
+            if self.wrap_pending:
+                self.wrap_pending = False
+                if self.autowrap:
+                    self.x = 0
+                    self.linefeed()
+            self.rows[self.y][self.x] = (c, self.attr)
+            if self.x == self.width - 1:
+                self.wrap_pending = True
+            else:
+                self.x += 1
+
+    def handle_control(self, c):
+        if c == u'\x1b':
+            self.state = 'esc'
+            self.seq = c
+            return
+        self.wrap_pending = False
+        if c == u'\r':
+            self.x = 0
+        elif c in u'\n\x0b\x0c':
+            self.linefeed()
+        elif c == u'\b':
+            self.x = max(0, self.x - 1)
+        elif c == u'\t':
+            self.x = min(self.width - 1, (self.x // 8 + 1) * 8)
+        elif c == u'\x07':
+            self.add_side_effect(c)
+        elif c in u'\x0e\x0f' or c >= u'\x80':
+            self.trusted = False
+
+    def handle_esc(self, c):
+        self.state = 'normal'
+        self.seq += c
+        if c == u'[':
+            self.state = 'csi'
+            self.seq = u''
+        elif c in u']P^_X':
+            self.state = 'string'
+        elif c in u'()*+':
+            self.state = 'charset'
+        elif c == u'#':
+            self.state = 'esc_hash'
+        elif c == u'7':
+            self.save_cursor()
+        elif c == u'8':
+            self.restore_cursor()
+        elif c == u'D':
+            self.linefeed()
+        elif c == u'E':
+            self.x = 0
+            self.linefeed()
+        elif c == u'M':
+            if self.y == self.top:
+                self.scroll_down(1)
+            else:
+                self.y = max(0, self.y - 1)
+        elif c == u'c':
+            self.reset()
+            self.trusted = True
+            self.client_screen_changed = True
+            self.add_side_effect(self.seq)
+        elif c in u'=>':
+            self.add_side_effect(self.seq)
+        else:
+            self.trusted = False
+
+    def handle_csi(self, seq):
+        final = seq[-1]
+        body = seq[:-1]
+        private = ''
+        if body and body[0] in u'?>=<':
+            private = body[0]
+            body = body[1:]
+        if re.search(u'[^0-9;]', body):
+            # Sequences with intermediate bytes, like cursor style.
+            self.add_side_effect(u'\x1b[' + seq)
+            return
+        params = [int(p) if p else None for p in body.split(u';')] if body else []
+        def param(i, default=1):
+            if i < len(params) and params[i]:
+                return params[i]
+            return default
+        if private:
+            if private == u'?' and final in u'hl':
+                self.set_private_modes(params, final == u'h', u'\x1b[' + seq)
+            else:
+                self.add_side_effect(u'\x1b[' + seq)
+            return
+        self.wrap_pending = False
+        if final == u'A':
+            self.y = max(0, self.y - param(0))
+        elif final in u'Be':
+            self.y = min(self.height - 1, self.y + param(0))
+        elif final in u'Ca':
+            self.x = min(self.width - 1, self.x + param(0))
+        elif final == u'D':
+            self.x = max(0, self.x - param(0))
+        elif final == u'E':
+            self.x = 0
+            self.y = min(self.height - 1, self.y + param(0))
+        elif final == u'F':
+            self.x = 0
+            self.y = max(0, self.y - param(0))
+        elif final in u'G`':
+            self.x = min(self.width - 1, param(0) - 1)
+        elif final == u'd':
+            self.y = min(self.height - 1, param(0) - 1)
+        elif final in u'Hf':
+            self.y = min(self.height - 1, param(0) - 1)
+            self.x = min(self.width - 1, param(1) - 1)
+        elif final == u'J':
+            self.erase_display(param(0, 0))
+        elif final == u'K':
+            self.erase_line(param(0, 0))
+        elif final == u'L':
+            if self.top <= self.y <= self.bottom:
+                self.scroll_down(param(0), self.y)
+        elif final == u'M':
+            if self.top <= self.y <= self.bottom:
+                self.scroll_up(param(0), self.y)
+        elif final == u'@':
+            row = self.rows[self.y]
+            n = min(param(0), self.width - self.x)
+            row[self.x:] = ([(u' ', '')] * n + row[self.x:])[:self.width - self.x]
+        elif final == u'P':
+            row = self.rows[self.y]
+            n = min(param(0), self.width - self.x)
+            row[self.x:] = row[self.x + n:] + [(u' ', self.get_erase_attr())] * n
+        elif final == u'X':
+            n = min(param(0), self.width - self.x)
+            self.rows[self.y][self.x:self.x + n] = [(u' ', self.get_erase_attr())] * n
+        elif final == u'S':
+            self.scroll_up(param(0))
+        elif final == u'T':
+            self.scroll_down(param(0))
+        elif final == u'r':
+            top = param(0) - 1
+            bottom = min(self.height, param(1, self.height)) - 1
+            if top < bottom:
+                self.top = top
+                self.bottom = bottom
+                self.x = 0
+                self.y = 0
+        elif final == u'm':
+            self.set_sgr(params)
+        elif final == u's':
+            self.save_cursor()
+        elif final == u'u':
+            self.restore_cursor()
+        elif final in u'hl':
+            if 4 in params:  # insert mode
+                self.trusted = False
+            self.add_side_effect(u'\x1b[' + seq)
+        elif final in u'nctq':
+            self.add_side_effect(u'\x1b[' + seq)
+        else:
+            self.trusted = False
+
+    def set_private_modes(self, params, enable, seq):
+        for mode in params:
+            if mode in (47, 1047, 1049):
+                if mode == 1049:
+                    if enable:
+                        self.save_cursor()
+                if enable and self.alt_rows is None:
+                    self.alt_rows = self.rows
+                    self.rows = [self.blank_row() for _ in range(self.height)]
+                elif not enable and self.alt_rows is not None:
+                    self.rows = self.alt_rows
+                    self.alt_rows = None
+                if mode == 1049 and not enable:
+                    self.restore_cursor()
+                self.client_screen_changed = True
+            elif mode == 7:
+                self.autowrap = enable
+            elif mode not in self.side_effect_modes:
+                self.trusted = False
+        self.add_side_effect(seq)
+
+    def set_sgr(self, params):
+        if not params:
+            params = [0]
+        i = 0
+        while i < len(params):
+            p = params[i] or 0
+            if p == 0:
+                self.sgr_flags = []
+                self.fg = None
+                self.bg = None
+            elif p in (38, 48):
+                if i + 2 < len(params) and params[i + 1] == 5:
+                    color = '%d;5;%d' % (p, params[i + 2] or 0)
+                    i += 2
+                elif i + 4 < len(params) and params[i + 1] == 2:
+                    color = '%d;2;%s' % (p, ';'.join('%d' % (x or 0) for x in params[i + 2:i + 5]))
+                    i += 4
+                else:
+                    color = None
+                    i = len(params)
+                if p == 38:
+                    self.fg = color
+                else:
+                    self.bg = color
+            elif 30 <= p <= 37 or 90 <= p <= 97:
+                self.fg = '%d' % p
+            elif p == 39:
+                self.fg = None
+            elif 40 <= p <= 47 or 100 <= p <= 107:
+                self.bg = '%d' % p
+            elif p == 49:
+                self.bg = None
+            elif 1 <= p <= 9:
+                if p not in self.sgr_flags:
+                    self.sgr_flags = sorted(self.sgr_flags + [p])
+            elif p == 22:
+                self.sgr_flags = [x for x in self.sgr_flags if x not in (1, 2)]
+            elif 23 <= p <= 29:
+                self.sgr_flags = [x for x in self.sgr_flags if x != p - 20]
+            i += 1
+        self.update_attr()
+
+    def update_attr(self):
+        items = ['%d' % x for x in self.sgr_flags]
+        if self.fg:
+            items.append(self.fg)
+        if self.bg:
+            items.append(self.bg)
+        self.attr = ';'.join(items)
+
+    def get_erase_attr(self):
+        # Erased cells use the background color of the current attributes.
+        return self.bg or ''
+
+    def save_cursor(self):
+        self.saved_cursor = (self.x, self.y, self.sgr_flags, self.fg, self.bg)
+
+    def restore_cursor(self):
+        self.x, self.y, self.sgr_flags, self.fg, self.bg = self.saved_cursor
+        self.x = min(self.x, self.width - 1)
+        self.y = min(self.y, self.height - 1)
+        self.wrap_pending = False
+        self.update_attr()
+
+    def linefeed(self):
+        if self.y == self.bottom:
+            self.scroll_up(1)
+        elif self.y < self.height - 1:
+            self.y += 1
+
+    def scroll_up(self, n, top=None):
+        top = self.top if top is None else top
+        n = min(n, self.bottom - top + 1)
+        del self.rows[top:top + n]
+        for _ in range(n):
+            self.rows.insert(self.bottom - n + 1, [(u' ', self.get_erase_attr())] * self.width)
+
+    def scroll_down(self, n, top=None):
+        top = self.top if top is None else top
+        n = min(n, self.bottom - top + 1)
+        del self.rows[self.bottom - n + 1:self.bottom + 1]
+        for _ in range(n):
+            self.rows.insert(top, [(u' ', self.get_erase_attr())] * self.width)
+
+    def erase_display(self, mode):
+        blank = (u' ', self.get_erase_attr())
+        if mode == 0:
+            self.erase_line(0)
+            for y in range(self.y + 1, self.height):
+                self.rows[y] = [blank] * self.width
+        elif mode == 1:
+            self.erase_line(1)
+            for y in range(self.y):
+                self.rows[y] = [blank] * self.width
+        elif mode in (2, 3):
+            self.rows = [[blank] * self.width for _ in range(self.height)]
+            if not self.trusted:
+                self.trusted = True
+                self.client_screen_changed = True
+
+    def erase_line(self, mode):
+        row = self.rows[self.y]
+        blank = (u' ', self.get_erase_attr())
+        if mode == 0:
+            row[self.x:] = [blank] * (self.width - self.x)
+        elif mode == 1:
+            row[:self.x + 1] = [blank] * (self.x + 1)
+        elif mode == 2:
+            self.rows[self.y] = [blank] * self.width
+
+    def render_diff(self, snapshot):
+        """ Return data changing the client terminal from snapshot to the
+            current screen. Redraw the whole screen if snapshot is None.
+            Data ends with the text before the cursor on its row, so prompts
+            can still be found at the end of output.
+        """
+        if self.client_screen_changed:
+            snapshot = None
+        out = [self.take_side_effects()]
+        if snapshot is None or snapshot[1:] != (self.top, self.bottom):
+            out.append(u'\x1b[%d;%dr' % (self.top + 1, self.bottom + 1))
+        state = {'attr': None}
+        def render_cells(cells):
+            for c, attr in cells:
+                if attr != state['attr']:
+                    out.append(u'\x1b[0;%sm' % attr if attr else u'\x1b[0m')
+                    state['attr'] = attr
+                out.append(c)
+        def strip_blanks(cells):
+            end = len(cells)
+            while end > 0 and cells[end - 1] == (u' ', ''):
+                end -= 1
+            return cells[:end]
+        for y, row in enumerate(self.rows):
+            if y == self.y or (snapshot is not None and snapshot[0][y] == row):
+                continue
+            out.append(u'\x1b[%d;1H' % (y + 1))
+            render_cells(strip_blanks(row))
+            out.append(u'\x1b[0m\x1b[K')
+            state['attr'] = ''
+        row = self.rows[self.y]
+        end = self.x + 1 if self.wrap_pending else self.x
+        out.append(u'\x1b[%d;1H\x1b[0m\x1b[2K' % (self.y + 1))
+        state['attr'] = ''
+        tail = strip_blanks(row[end:])
+        if tail:
+            render_cells(row[:end] + tail)
+            out.append(u'\x1b[%d;%dH' % (self.y + 1, self.x + 1))
+        else:
+            render_cells(row[:end])
+        if state['attr'] != self.attr:
+            out.append(u'\x1b[0;%sm' % self.attr if self.attr else u'\x1b[0m')
+        self.client_screen_changed = False
+        return u''.join(out).encode('utf-8')
@@ -8,19 +8,24 @@ It uses only one ssh connection.
 
 from __future__ import print_function
 import argparse
+import collections
 import os
 import pty
 from Queue import Queue
 import re
 import select
+import shlex
 import signal
+import socket
 import subprocess
 import termios
 import threading
 import time
 import tty
 
-from file_transfer import FileClientCmdInterface, FileServer
+from file_transfer import (ContentStore, CreditQueue, FileClient, FileClientCmdInterface,
+                           FileServer, FileTransferError, FileTransferJobEnd)
+from screen import Screen
 from utils import *
 
 help_msg = """
@@ -29,179 +34,1111 @@ Normal ssh connection with additional file transfer commands.
 It suppoprts both terminal and non terminal mode.
 It supports terminal commands like vi, info, man.
 It uses only one ssh connection.
+
+Without a terminal, ops like send, recv, exec and tail can be given as arguments:
+  ssh2.py --host-name xxx send local remote recv remote local exec "cmdline"
+  ssh2.py --host-name xxx tail remote_log 100
+  ssh2.py --host-name xxx follow remote_log
+  ssh2.py --host-name xxx recv big.tar.gz - | tar xz
+  pg_dump | ssh2.py --host-name xxx send - backup.sql
+  ssh2.py --host-name xxx relay build/out.tar other_host:out.tar
+  ssh2.py --hosts web send app.conf app.conf exec "service app reload"
+  ssh2.py --host-name xxx forward 8080:localhost:80
 """
 
+UPDATE_SERVER_CMD = ('rm -rf .ssh_wrapper && mkdir .ssh_wrapper && ' +
+                     'git clone https://github.com/yabincui/ssh_wrapper .ssh_wrapper && ')
+
 class MsgHelper(object):
     """
     We send msg between SSHClient and SSHServer:
     struct msg {
         // SSHClient to SSHServer:
-        // T - terminal data, please pass directly to shell.
+        // T - terminal data, please pass directly to shell, data is "pty_id data".
         // F - for file transfer cmd.
         // E - client has closed connection.
-        // W - set window size.
-        // S - sync dir between shell and SSHServer.
+        // W - set window size, data is "pty_id width_height".
+        // S - sync dir between shell and SSHServer, data is "pty_id".
+        // O - open a pty running a new shell, data is "width_height".
+        // J - for file transfer cmd of a background job, data is "job_id line".
+        // K - close the file channel of a background job, data is "job_id".
+        // R - set rate limit of file data, data is "job_id bytes_per_second",
+        //     job_id 0 is for the whole session.
+        // A - attach to a session, data is "pty_id:offset ..." for each pty
+        //     known by the client, offset is the size of terminal data received.
+        // G - grant credits of a file channel, data is "channel size".
+        // N - open a forwarded TCP connection to host:port, data is "conn_id host port".
+        // D - data of a forwarded TCP connection, data is "conn_id data".
+        // X - no more data of a forwarded TCP connection, like a TCP FIN,
+        //     data is "conn_id".
         // SSHServer to SSHClient:
-        // T - terminal data, please pass directly to the client terminal.
+        // T - terminal data, please pass directly to the client terminal,
+        //     data is "pty_id data".
         // F - for file transfer cmd.
         // E - server has closed connection.
         // S - reply new dir of SSHServer.
+        // J - for file transfer cmd of a background job, data is "job_id line".
+        // P - the shell shows a prompt, data is "pty_id exit_status;cwd".
+        // A - reply attach for each pty, data is "pty_id offset", offset is of
+        //     the next terminal data, the terminal data missed by the client follows.
+        // O - reply open pty, data is "pty_id".
+        // C - the shell of a pty has exited, data is "pty_id".
+        // G - grant credits of a file channel, data is "channel size".
+        // D - data of a forwarded TCP connection, data is "conn_id data".
+        // X - no more data of a forwarded TCP connection, data is "conn_id".
         char type;
         uint32_t size;  // size of msg data
         char data[size];
     };
+
+    Msgs are written by a writer thread. F, J, D and X msgs are bulk msgs, they are only
+    written when no other msg is waiting, and at most max_bulk_msgs of them
+    can wait to be written, so terminal msgs don't queue behind file data.
+
+    Each channel (0 for F msgs, job_id for J msgs, -conn_id for D and X msgs)
+    has credits of window_size bytes. Writing a bulk msg takes credits of its
+    payload size, which is what the peer queues, and waits when there
+    aren't enough. The peer grants credits back by G msgs when it has consumed
+    the data, so a slow consumer stops the producer instead of growing queues.
+    G msgs are handled in read_msg().
     """
-    def __init__(self, read_fh, write_fh, logger):
+    def __init__(self, read_fh, write_fh, logger, max_bulk_msgs=16, window_size=4 * 1024 * 1024):
         self.read_fh = read_fh
         self.write_fh = write_fh
         self.logger = logger
+        self.max_bulk_msgs = max_bulk_msgs
+        self.window_size = window_size
+        # A signal handler may write msgs in a thread already holding the lock.
+        self.write_cond = threading.Condition(threading.RLock())
+        # All below are protected by self.write_cond.
+        self.urgent_msgs = collections.deque()
+        self.bulk_msgs = collections.deque()
+        self.urgent_size = 0
+        self.writing = False
+        self.write_closed = False
+        # Map from channel to credits left.
+        self.credits = {}
+        self.closed_channels = set()
+        self.write_thread = threading.Thread(target=self._run_write_thread)
+        self.write_thread.daemon = True
+        self.write_thread.start()
 
-    def write_terminal_msg(self, data):
-        self.write_msg('T', data)
+    def write_terminal_msg(self, pty_id, data):
+        self.write_msg('T', '%d %s' % (pty_id, data))
 
     def write_exit_msg(self):
         self.write_msg('E', '')
+        self.flush()
 
-    def write_window_msg(self, data):
-        self.write_msg('W', data)
+    def write_window_msg(self, pty_id, data):
+        self.write_msg('W', '%d %s' % (pty_id, data))
 
     def write_file_msg(self, data):
-        self.write_msg('F', data)
+        self.write_msg('F', data, 0)
 
     def write_sync_dir_msg(self, data):
         self.write_msg('S', data)
 
-    def write_msg(self, type, data):
+    def write_job_msg(self, job_id, data):
+        self.write_msg('J', '%d %s' % (job_id, data), job_id, len(data))
+
+    def write_close_job_msg(self, job_id):
+        self.write_msg('K', '%d' % job_id)
+
+    def write_prompt_msg(self, pty_id, data):
+        self.write_msg('P', '%d %s' % (pty_id, data))
+
+    def write_rate_limit_msg(self, job_id, rate):
+        self.write_msg('R', '%d %d' % (job_id, rate))
+
+    def write_attach_msg(self, offsets):
+        """ offsets is a map from pty_id to offset. """
+        self.write_msg('A', ' '.join('%d:%d' % item for item in sorted(offsets.items())))
+
+    def write_attach_reply_msg(self, pty_id, offset):
+        self.write_msg('A', '%d %d' % (pty_id, offset))
+
+    def write_open_pty_msg(self, data):
+        self.write_msg('O', data)
+
+    def write_close_pty_msg(self, pty_id):
+        self.write_msg('C', '%d' % pty_id)
+
+    def write_credit_msg(self, channel, size):
+        self.write_msg('G', '%d %d' % (channel, size))
+
+    def write_forward_open_msg(self, conn_id, host, port):
+        self.write_msg('N', '%d %s %d' % (conn_id, host, port))
+
+    def write_forward_msg(self, conn_id, data):
+        self.write_msg('D', '%d %s' % (conn_id, data), -conn_id, len(data))
+
+    def write_forward_end_msg(self, conn_id):
+        self.write_msg('X', '%d' % conn_id, -conn_id, 0)
+
+    def write_msg(self, type, data, channel=None, cost=None):
+        """ Write a msg, bulk msgs pass the channel taking cost credits, which is
+            the size of data by default.
+        """
+        if cost is None:
+            cost = len(data)
         msg = type + ('%04x' % len(data)) + data
-        self.logger.log('write_msg(%s, %s)' % (msg, to_hex_str(data)))
-        self.write_fh.write(msg)
-        self.write_fh.flush()
+        # Don't format large msgs when not logging.
+        if self.logger.enable_log:
+            self.logger.log('write_msg(%s, %s)' % (msg, to_hex_str(data)))
+        with self.write_cond:
+            if self.write_closed:
+                return
+            if channel is not None:
+                while not self.write_closed and channel not in self.closed_channels and (
+                        len(self.bulk_msgs) >= self.max_bulk_msgs or
+                        self.credits.get(channel, self.window_size) < cost):
+                    self.write_cond.wait()
+                if self.write_closed or channel in self.closed_channels:
+                    return
+                self.credits[channel] = self.credits.get(channel, self.window_size) - cost
+                self.bulk_msgs.append((channel, msg))
+            else:
+                self.urgent_msgs.append(msg)
+                self.urgent_size += len(msg)
+            self.write_cond.notify_all()
+
+    def add_credits(self, channel, size):
+        with self.write_cond:
+            if channel not in self.closed_channels:
+                self.credits[channel] = self.credits.get(channel, self.window_size) + size
+                self.write_cond.notify_all()
+
+    def close_channel(self, channel):
+        """ Drop msgs of a file channel waiting to be written and written later. """
+        with self.write_cond:
+            self.closed_channels.add(channel)
+            self.credits.pop(channel, None)
+            self.bulk_msgs = collections.deque(item for item in self.bulk_msgs
+                                               if item[0] != channel)
+            self.write_cond.notify_all()
+
+    def get_urgent_size(self):
+        """ Return the size of msgs waiting to be written before bulk msgs. """
+        with self.write_cond:
+            return self.urgent_size
+
+    def close(self):
+        """ Drop msgs waiting to be written and msgs written later. """
+        with self.write_cond:
+            self.write_closed = True
+            self.urgent_msgs.clear()
+            self.urgent_size = 0
+            self.bulk_msgs.clear()
+            self.write_cond.notify_all()
+
+    def flush(self):
+        """ Wait until all msgs are written. """
+        with self.write_cond:
+            while (self.urgent_msgs or self.bulk_msgs or self.writing) and not self.write_closed:
+                self.write_cond.wait()
+
+    def _run_write_thread(self):
+        # write thread
+        while True:
+            with self.write_cond:
+                self.writing = False
+                self.write_cond.notify_all()
+                while not self.urgent_msgs and not self.bulk_msgs:
+                    self.write_cond.wait()
+                if self.urgent_msgs:
+                    data = ''.join(self.urgent_msgs)
+                    self.urgent_msgs.clear()
+                    self.urgent_size = 0
+                else:
+                    data = self.bulk_msgs.popleft()[1]
+                self.writing = True
+                self.write_cond.notify_all()
+            try:
+                self.write_fh.write(data)
+                self.write_fh.flush()
+            except (IOError, ValueError) as e:
+                self.logger.log('write msg failed: %s' % e)
+                with self.write_cond:
+                    self.write_closed = True
+                    self.writing = False
+                    self.urgent_msgs.clear()
+                    self.urgent_size = 0
+                    self.bulk_msgs.clear()
+                    self.write_cond.notify_all()
+                return
 
     def read_msg(self):
         def read_fully(size):
             data = ''
             while len(data) < size:
-                data += self.read_fh.read(size - len(data))
+                new_data = self.read_fh.read(size - len(data))
+                if not new_data:
+                    raise EOFError()
+                data += new_data
             return data
-        msg_type = read_fully(1)
-        size = int(read_fully(4), 16)
-        msg_data = read_fully(size)
-        self.logger.log('read_msg(%c, %s, %s)' % (msg_type, msg_data, to_hex_str(msg_data)))
-        return msg_type, msg_data
+        while True:
+            msg_type = read_fully(1)
+            size = int(read_fully(4), 16)
+            msg_data = read_fully(size)
+            if self.logger.enable_log:
+                self.logger.log('read_msg(%c, %s, %s)' % (msg_type, msg_data,
+                                                          to_hex_str(msg_data)))
+            if msg_type != 'G':
+                return msg_type, msg_data
+            channel, size = [int(x) for x in msg_data.split()]
+            self.add_credits(channel, size)
+
+
+class ForwardConnection(object):
+    """ Relay a TCP connection over the channel -conn_id of a MsgHelper.
+
+        Data read from the socket is sent in D msgs, which wait for credits of
+        the channel. Data of D msgs from the peer is queued in a CreditQueue and
+        written to the socket by a writer thread, which grants credits back as
+        it writes, so each direction buffers at most window_size bytes.
+        Sockets are read in msgs as large as possible, and send buffers are
+        left to the kernel to size.
+
+        An X msg is sent after the socket reaches EOF. After an X msg from the
+        peer, the socket is shut down for writing. Data from the peer is taken
+        even if it can't be written, so the peer never waits for credits.
+    """
+    # Data of a msg is at most 0xffff bytes, with "conn_id " in front.
+    max_read_size = 65504
+
+    def __init__(self, conn_id, msg_helper, logger, close_function):
+        self.conn_id = conn_id
+        self.msg_helper = msg_helper
+        self.logger = logger
+        self.close_function = close_function
+        self.data_q = CreditQueue(lambda size: msg_helper.write_credit_msg(-conn_id, size))
+        self.sock = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.running_threads = 2
+
+    def start(self, sock=None, address=None):
+        """ Relay sock, or connect to address first. """
+        thread = threading.Thread(target=self._run_read_thread, args=(sock, address))
+        thread.daemon = True
+        thread.start()
+
+    def add_data(self, data):
+        self.data_q.put(data)
+
+    def end_data(self):
+        self.data_q.put(None)
+
+    def close(self):
+        """ Close the connection when its MsgHelper is closed. """
+        self.closed = True
+        self.data_q.close()
+        sock = self.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _run_read_thread(self, sock, address):
+        if sock is None:
+            try:
+                sock = socket.create_connection(address, 10)
+                sock.settimeout(None)
+            except socket.error as e:
+                self.logger.log('forward %d to %s:%d failed: %s' % (
+                                self.conn_id, address[0], address[1], e))
+                sock = None
+        if sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = sock
+            if self.closed:
+                self.close()
+        write_thread = threading.Thread(target=self._run_write_thread)
+        write_thread.daemon = True
+        write_thread.start()
+        while sock:
+            try:
+                data = sock.recv(self.max_read_size)
+            except socket.error as e:
+                self.logger.log('forward %d recv failed: %s' % (self.conn_id, e))
+                break
+            if not data:
+                break
+            self.msg_helper.write_forward_msg(self.conn_id, data)
+        self.msg_helper.write_forward_end_msg(self.conn_id)
+        self._finish_thread()
+
+    def _run_write_thread(self):
+        sock = self.sock
+        while True:
+            data = self.data_q.get()
+            if data is None:
+                break
+            if sock:
+                try:
+                    sock.sendall(data)
+                except socket.error as e:
+                    self.logger.log('forward %d send failed: %s' % (self.conn_id, e))
+                    sock = None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+        self._finish_thread()
+
+    def _finish_thread(self):
+        with self.lock:
+            self.running_threads -= 1
+            if self.running_threads:
+                return
+        if self.sock:
+            self.sock.close()
+        self.close_function(self)
+
+
+class PortForwarder(object):
+    """ Forward TCP connections over a MsgHelper.
+
+        In the client, listen() accepts local connections, and opens each of
+        them to a target by an N msg. In the server, open_connection()
+        connects to the target of an N msg. D and X msgs of a connection are
+        passed to add_data() and end_data() in both ends.
+    """
+
+    def __init__(self, msg_helper, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        # All below are protected by self.lock.
+        self.msg_helper = msg_helper
+        # Map from conn_id to ForwardConnection.
+        self.conns = {}
+        self.next_conn_id = 1
+
+    def listen(self, spec):
+        """ Accept connections of spec like [bind_address:]port:host:host_port,
+            raise ValueError or socket.error if failed.
+        """
+        bind_address, port, host, host_port = parse_forward_spec(spec)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((bind_address, port))
+        sock.listen(16)
+        thread = threading.Thread(target=self._run_accept_thread, args=(sock, host, host_port))
+        thread.daemon = True
+        thread.start()
+
+    def _run_accept_thread(self, sock, host, host_port):
+        # accept thread
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.error as e:
+                self.logger.log('accept failed: %s' % e)
+                break
+            with self.lock:
+                conn_id = self.next_conn_id
+                self.next_conn_id += 1
+                forward_conn = ForwardConnection(conn_id, self.msg_helper, self.logger,
+                                                 self.remove_connection)
+                self.conns[conn_id] = forward_conn
+                self.msg_helper.write_forward_open_msg(conn_id, host, host_port)
+            forward_conn.start(sock=conn)
+
+    def open_connection(self, conn_id, host, port):
+        with self.lock:
+            forward_conn = ForwardConnection(conn_id, self.msg_helper, self.logger,
+                                             self.remove_connection)
+            self.conns[conn_id] = forward_conn
+        forward_conn.start(address=(host, port))
+
+    def add_data(self, conn_id, data):
+        with self.lock:
+            forward_conn = self.conns.get(conn_id)
+        if forward_conn:
+            forward_conn.add_data(data)
+
+    def end_data(self, conn_id):
+        with self.lock:
+            forward_conn = self.conns.get(conn_id)
+        if forward_conn:
+            forward_conn.end_data()
+
+    def remove_connection(self, forward_conn):
+        with self.lock:
+            if self.conns.get(forward_conn.conn_id) is forward_conn:
+                del self.conns[forward_conn.conn_id]
+
+    def reset(self, msg_helper):
+        """ Close connections of the old MsgHelper, and use a new one. """
+        with self.lock:
+            conns = list(self.conns.values())
+            self.conns = {}
+            self.msg_helper = msg_helper
+        for forward_conn in conns:
+            forward_conn.close()
+
+
+def parse_forward_spec(spec):
+    """ Parse [bind_address:]port:host:host_port, bind_address is 127.0.0.1
+        by default.
+    """
+    items = spec.split(':')
+    if len(items) == 3:
+        items = ['127.0.0.1'] + items
+    if len(items) != 4 or not items[1].isdigit() or not items[3].isdigit():
+        raise ValueError('wrong forward spec %s, need [bind_address:]port:host:host_port' %
+                         spec)
+    return items[0], int(items[1]), items[2], int(items[3])
+
+
+class ShellMarkerParser(object):
+    """ Split shell markers "\033]777;ssh2;exit_status;cwd\007" written by
+        ssh2_bashrc from pty output.
+    """
+    prefix = '\033]777;ssh2;'
+
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, data):
+        """ Return a list of ('T', output) and ('P', 'exit_status;cwd') items. """
+        data = self.pending + data
+        self.pending = ''
+        items = []
+        while data:
+            start = data.find(self.prefix)
+            if start == -1:
+                # Keep a partial prefix at the end for the next feed.
+                keep = 0
+                for n in range(min(len(self.prefix) - 1, len(data)), 0, -1):
+                    if self.prefix.startswith(data[-n:]):
+                        keep = n
+                        break
+                self.pending = data[len(data) - keep:]
+                data = data[:len(data) - keep]
+                if data:
+                    items.append(('T', data))
+                break
+            if start > 0:
+                items.append(('T', data[:start]))
+            end = data.find('\007', start)
+            if end == -1:
+                if len(data) - start > 4096:
+                    # Not a marker.
+                    items.append(('T', data[start:]))
+                else:
+                    self.pending = data[start:]
+                break
+            items.append(('P', data[start + len(self.prefix):end]))
+            data = data[end + 1:]
+        return items
+
+
+class ServerPty(object):
+    """ A pty running a shell in SSHServer. """
+
+    def __init__(self, pty_id, width, height, screen_mode, scrollback):
+        self.pty_id = pty_id
+        self.child_pid, self.fd = self.create_child_shell()
+        if width and height:
+            set_terminal_size(self.fd, width, height)
+        make_file_nonblocking(self.fd)
+        self.shell_pid = None
+        self.marker_parser = ShellMarkerParser()
+        # The shell dir reported by the last shell marker.
+        self.shell_dir = None
+        # The last shell marker if no input is sent after it, it is sent again
+        # to clients attaching to the session.
+        self.prompt = None
+        # In screen mode, pty output is sent at most once per frame, as raw data
+        # or as a diff of the screen when raw data is more than a screen.
+        self.screen = None
+        if screen_mode:
+            self.screen = Screen(width, height) if width and height else Screen()
+        # What the client terminal shows, None if unknown.
+        self.client_screen = None
+        self.pending_data = []
+        self.last_flush_time = 0
+        # Terminal data kept for clients attaching to the session again.
+        self.output_ring = OutputRing(scrollback) if scrollback else None
+
+    def create_child_shell(self):
+        pid, fd = pty.fork()
+        if pid == 0:
+            # child process
+            subprocess.call(['/bin/bash', '--rcfile', os.path.join(get_script_dir(), 'ssh2_bashrc')],
+                            shell=False)
+            os._exit(0)
+        return pid, fd
+
+    def get_shell_dir(self):
+        if self.shell_dir is not None:
+            return self.shell_dir
+        if self.shell_pid is None:
+            self.shell_pid = self.find_shell_pid()
+        return os.readlink('/proc/%d/cwd' % self.shell_pid)
+
+    def find_shell_pid(self):
+        output = subprocess.check_output('ps -eo ppid,pid | grep %d' % self.child_pid, shell=True)
+        for line in output.split('\n'):
+            items = line.strip().split()
+            if len(items) == 2 and items[0] == str(self.child_pid):
+                return int(items[1])
+        return None
 
 
 class SSHServer(object):
     """ Start a server, run terminal and file transfer cmds.
+
+        It runs a shell in each pty opened by clients, and exits when all
+        shells exit. Without shell, no pty is opened at start, which is used by
+        clients only running file transfer cmds.
+
+        With a session_name, the server outlives client connections. It accepts
+        clients on the session socket, a new client replaces the old one. It
+        keeps the last scrollback bytes of terminal data of each pty, to send
+        the data missed by a client when it attaches again.
     """
-    def __init__(self, enable_log):
-        sys.stdout.write('\nssh server started\n')
-        sys.stdout.flush()
+    def __init__(self, enable_log, screen_mode=False, frame_rate=20, session_name=None,
+                 scrollback=1024 * 1024, shell=True):
         self.logger = Logger('~/ssh2.log', enable_log)
-        self.msg_helper = MsgHelper(sys.stdin, sys.stdout, self.logger)
-        self.child_pid, self.pty_fd = self.create_child_shell()
-        self.shell_pid = None
+        self.session_name = session_name
+        self.screen_mode = screen_mode
+        self.scrollback = scrollback if session_name else 0
+        self.output_lock = threading.Lock()
+        # All below are protected by self.output_lock.
+        self.attached = False
+        self.session_conn = None
+        # Map from pty_id to ServerPty.
+        self.ptys = collections.OrderedDict()
+        self.next_pty_id = 0
+        if session_name:
+            self.session_sock = listen_session_socket(session_name)
+            self.session_conn_q = Queue()
+            self.msg_helper = None
+        else:
+            sys.stdout.write('\nssh server started\n')
+            sys.stdout.flush()
+            self.msg_helper = MsgHelper(sys.stdin, sys.stdout, self.logger)
+            self.attached = True
+        self.screen_lock = threading.Lock()
+        self.frame_interval = 1.0 / frame_rate
+        self.max_pending_output = 1024 * 1024
+        # Written to wake up the poll thread when a pty is opened.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        if shell:
+            self.open_pty()
         self.poll_thread = threading.Thread(target=self._run_poll_thread)
+        self.poll_thread.daemon = True
         self.poll_thread.start()
+        # Map from job_id to RateLimiter, job_id 0 is for the whole session.
+        self.rate_limiters = {0: RateLimiter()}
         self.start_file_server()
+        # Map from job_id to (data queue, stop event) of background job FileServers.
+        self.file_jobs = {}
+        self.port_forwarder = PortForwarder(self.msg_helper, self.logger)
 
     def start_file_server(self):
-        self.file_data_q = Queue()
+        self.file_data_q = CreditQueue(lambda size: self.msg_helper.write_credit_msg(0, size))
+        self.file_server_stop_event = threading.Event()
+        file_data_q = self.file_data_q
+        stop_event = self.file_server_stop_event
         def write_line_function(data):
+            if stop_event.is_set():
+                raise FileTransferJobEnd()
             self.msg_helper.write_file_msg(data)
         def read_line_function():
-            return self.file_data_q.get()
+            data = file_data_q.get()
+            if data is None:
+                raise FileTransferJobEnd()
+            return data
 
         def file_server_thread_func():
             server = FileServer(write_line_function, read_line_function, self.logger)
-            server.run()
+            server.rate_limiters = [self.rate_limiters[0]]
+            try:
+                server.run()
+            except FileTransferJobEnd:
+                pass
         self.file_server_thread = threading.Thread(target=file_server_thread_func)
+        self.file_server_thread.daemon = True
         self.file_server_thread.start()
 
-    def create_child_shell(self):
-        pid, fd = pty.fork()
-        if pid == 0:
-            # child process
-            subprocess.call(['/bin/bash'], shell=False)
+    def start_file_job_server(self, job_id):
+        data_q = CreditQueue(lambda size: self.msg_helper.write_credit_msg(job_id, size))
+        stop_event = threading.Event()
+        def write_line_function(data):
+            if stop_event.is_set():
+                raise FileTransferJobEnd()
+            self.msg_helper.write_job_msg(job_id, data)
+        def read_line_function():
+            data = data_q.get()
+            if data is None:
+                raise FileTransferJobEnd()
+            return data
+
+        rate_limiters = [self.rate_limiters[0], self.get_rate_limiter(job_id)]
+
+        def file_job_server_thread_func():
+            server = FileServer(write_line_function, read_line_function, self.logger)
+            server.rate_limiters = rate_limiters
+            try:
+                server.run()
+            except FileTransferJobEnd:
+                pass
+        thread = threading.Thread(target=file_job_server_thread_func)
+        thread.daemon = True
+        thread.start()
+        self.file_jobs[job_id] = (data_q, stop_event)
+
+    def get_rate_limiter(self, job_id):
+        if job_id not in self.rate_limiters:
+            self.rate_limiters[job_id] = RateLimiter()
+        return self.rate_limiters[job_id]
+
+    def close_file_job_server(self, job_id):
+        self.rate_limiters.pop(job_id, None)
+        if job_id in self.file_jobs:
+            data_q, stop_event = self.file_jobs.pop(job_id)
+            stop_event.set()
+            data_q.close()
+            self.msg_helper.close_channel(job_id)
+
+    def open_pty(self, width=0, height=0, reply=False):
+        with self.output_lock:
+            server_pty = ServerPty(self.next_pty_id, width, height, self.screen_mode,
+                                   self.scrollback)
+            self.next_pty_id += 1
+            self.ptys[server_pty.pty_id] = server_pty
+            if reply and self.attached:
+                self.msg_helper.write_open_pty_msg('%d' % server_pty.pty_id)
+        os.write(self.wakeup_w, 'x')
+        self.logger.log('open pty %d' % server_pty.pty_id)
+
+    def get_pty(self, pty_id):
+        with self.output_lock:
+            return self.ptys.get(int(pty_id))
+
+    def close_pty(self, server_pty):
+        """ Close a pty whose shell has exited, return True if no pty is left. """
+        # poll thread
+        self.flush_terminal_data(server_pty)
+        os.close(server_pty.fd)
+        os.waitpid(server_pty.child_pid, 0)
+        self.logger.log('close pty %d' % server_pty.pty_id)
+        with self.output_lock:
+            del self.ptys[server_pty.pty_id]
+            no_pty_left = not self.ptys
+            if self.attached:
+                self.msg_helper.write_close_pty_msg(server_pty.pty_id)
+                if no_pty_left:
+                    self.msg_helper.write_exit_msg()
+        if no_pty_left and self.session_name:
+            os.remove(get_session_socket_path(self.session_name))
             os._exit(0)
-        return pid, fd
+        return no_pty_left
 
     def _run_poll_thread(self):
         # poll thread
-        try:
-            make_file_nonblocking(self.pty_fd)
-            while True:
-                rlist, _, xlist = select.select([self.pty_fd], [], [self.pty_fd])
-                if self.pty_fd in rlist or self.pty_fd in xlist:
+        while True:
+            with self.output_lock:
+                ptys = list(self.ptys.values())
+                # Stop reading ptys when terminal data isn't written as fast as
+                # it is read, so programs writing to ptys block instead.
+                paused = (self.attached and
+                          self.msg_helper.get_urgent_size() >= self.max_pending_output)
+            timeout = 0.05 if paused else None
+            for server_pty in ptys:
+                if server_pty.pending_data:
+                    wait_time = max(0, server_pty.last_flush_time + self.frame_interval -
+                                    time.time())
+                    timeout = wait_time if timeout is None else min(timeout, wait_time)
+            fds = [] if paused else [server_pty.fd for server_pty in ptys]
+            rlist, _, xlist = select.select(fds + [self.wakeup_r], [], fds, timeout)
+            if self.wakeup_r in rlist:
+                os.read(self.wakeup_r, 1024)
+            for server_pty in ptys:
+                if server_pty.fd in rlist or server_pty.fd in xlist:
                     try:
-                        data = os.read(self.pty_fd, 1024)
+                        data = os.read(server_pty.fd,
+                                       1024 if server_pty.screen is None else 65536)
                     except OSError:
                         data = ''
                     if not data:
-                        self.msg_helper.write_exit_msg()
-                        break
-                    self.msg_helper.write_terminal_msg(data)
-        finally:
-            pass
+                        if self.close_pty(server_pty):
+                            return
+                        continue
+                    self.receive_pty_data(server_pty, data)
+                if (server_pty.pending_data and
+                        time.time() - server_pty.last_flush_time >= self.frame_interval):
+                    self.flush_terminal_data(server_pty)
+
+    def receive_pty_data(self, server_pty, data):
+        # poll thread
+        for item_type, item in server_pty.marker_parser.feed(data):
+            if item_type == 'P':
+                self.flush_terminal_data(server_pty)
+                server_pty.shell_dir = item.split(';', 1)[1]
+                server_pty.prompt = item
+                with self.output_lock:
+                    if self.attached:
+                        self.msg_helper.write_prompt_msg(server_pty.pty_id, item)
+            elif server_pty.screen is None:
+                self.write_terminal_data(server_pty, item)
+            else:
+                with self.screen_lock:
+                    server_pty.screen.feed(item)
+                server_pty.pending_data.append(item)
+
+    def flush_terminal_data(self, server_pty):
+        # poll thread
+        if not server_pty.pending_data:
+            return
+        data = ''.join(server_pty.pending_data)
+        server_pty.pending_data = []
+        server_pty.last_flush_time = time.time()
+        with self.screen_lock:
+            screen = server_pty.screen
+            if screen.trusted and len(data) > screen.width * screen.height:
+                data = screen.render_diff(server_pty.client_screen)
+                server_pty.client_screen = screen.snapshot()
+                self.logger.log('send screen diff instead of %d bytes' % len(data))
+            else:
+                server_pty.client_screen = screen.take_raw_snapshot()
+        for i in range(0, len(data), 16384):
+            self.write_terminal_data(server_pty, data[i:i + 16384])
+
+    def write_terminal_data(self, server_pty, data):
+        # poll thread
+        with self.output_lock:
+            if server_pty.output_ring:
+                server_pty.output_ring.append(data)
+            if self.attached:
+                self.msg_helper.write_terminal_msg(server_pty.pty_id, data)
 
     def run(self):
+        if not self.session_name:
+            self.serve_client()
+            with self.output_lock:
+                for server_pty in self.ptys.values():
+                    os.kill(server_pty.child_pid, signal.SIGTERM)
+            return
+        accept_thread = threading.Thread(target=self._run_accept_thread)
+        accept_thread.daemon = True
+        accept_thread.start()
+        while True:
+            conn = self.session_conn_q.get()
+            self.msg_helper = MsgHelper(conn.makefile('rb'), conn.makefile('wb'), self.logger)
+            self.serve_client()
+            self.detach_client()
+            conn.close()
+
+    def _run_accept_thread(self):
+        # accept thread
+        while True:
+            conn, _ = self.session_sock.accept()
+            with self.output_lock:
+                old_conn = self.session_conn
+                self.session_conn = conn
+            if old_conn:
+                # The old client may be gone without closing its connection.
+                try:
+                    old_conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.session_conn_q.put(conn)
+
+    def attach_client(self, offsets):
+        with self.output_lock:
+            for server_pty in self.ptys.values():
+                ring = server_pty.output_ring
+                offset = offsets.get(server_pty.pty_id, 0)
+                if ring:
+                    start_offset, data = ring.get_since(offset)
+                    dropped = start_offset > offset
+                else:
+                    # No scrollback is kept, offsets restart from 0.
+                    data, dropped = '', True
+                if dropped and server_pty.screen:
+                    # Diffs in the ring need the dropped data, redraw the screen instead.
+                    with self.screen_lock:
+                        data = server_pty.screen.render_diff(None)
+                        server_pty.client_screen = server_pty.screen.snapshot()
+                reply_offset = ring.end_offset - len(data) if ring else 0
+                self.msg_helper.write_attach_reply_msg(server_pty.pty_id, reply_offset)
+                for i in range(0, len(data), 16384):
+                    self.msg_helper.write_terminal_msg(server_pty.pty_id, data[i:i + 16384])
+                if server_pty.prompt:
+                    self.msg_helper.write_prompt_msg(server_pty.pty_id, server_pty.prompt)
+                self.logger.log('attach pty %d at offset %d, send %d bytes' % (
+                                server_pty.pty_id, offset, len(data)))
+            self.attached = True
+
+    def detach_client(self):
+        with self.output_lock:
+            self.attached = False
+        self.msg_helper.close()
+        self.port_forwarder.reset(None)
+        for job_id in list(self.file_jobs):
+            self.close_file_job_server(job_id)
+        # The file server may be in the middle of a cmd, start a new one.
+        self.file_server_stop_event.set()
+        self.file_data_q.close()
+        self.start_file_server()
+        self.logger.log('detach client')
+
+    def serve_client(self):
+        self.port_forwarder.reset(self.msg_helper)
         try:
             while True:
-                msg_type, msg_data = self.msg_helper.read_msg()
+                try:
+                    msg_type, msg_data = self.msg_helper.read_msg()
+                except (EOFError, IOError) as e:
+                    self.logger.log('connection closed: %r' % e)
+                    break
                 if msg_type == 'E':
-                    os.kill(self.child_pid, signal.SIGTERM)
                     break
+                elif msg_type == 'A':
+                    offsets = {}
+                    for item in msg_data.split():
+                        pty_id, offset = [int(x) for x in item.split(':')]
+                        offsets[pty_id] = offset
+                    self.attach_client(offsets)
                 elif msg_type == 'T':
-                    os.write(self.pty_fd, msg_data)
+                    pty_id, data = msg_data.split(' ', 1)
+                    server_pty = self.get_pty(pty_id)
+                    if server_pty:
+                        server_pty.prompt = None
+                        os.write(server_pty.fd, data)
                 elif msg_type == 'W':
+                    pty_id, size = msg_data.split(' ', 1)
+                    w, h = [int(x) for x in size.split('_')]
+                    server_pty = self.get_pty(pty_id)
+                    if server_pty:
+                        self.logger.log('set_window_size(%s, %d, %d)' % (pty_id, w, h))
+                        set_terminal_size(server_pty.fd, w, h)
+                        if server_pty.screen:
+                            with self.screen_lock:
+                                server_pty.screen.resize(w, h)
+                                server_pty.client_screen = None
+                elif msg_type == 'O':
                     w, h = [int(x) for x in msg_data.split('_')]
-                    self.logger.log('set_window_size(%d, %d)' % (w, h))
-                    set_terminal_size(self.pty_fd, w, h)
+                    self.open_pty(w, h, reply=True)
                 elif msg_type == 'F':
                     self.file_data_q.put(msg_data)
                 elif msg_type == 'S':
-                    self.sync_dir_with_shell()
+                    self.sync_dir_with_shell(msg_data)
+                elif msg_type == 'J':
+                    job_id, data = msg_data.split(' ', 1)
+                    job_id = int(job_id)
+                    if job_id not in self.file_jobs:
+                        self.start_file_job_server(job_id)
+                    self.file_jobs[job_id][0].put(data)
+                elif msg_type == 'K':
+                    self.close_file_job_server(int(msg_data))
+                elif msg_type == 'R':
+                    job_id, rate = [int(x) for x in msg_data.split()]
+                    self.get_rate_limiter(job_id).set_rate(rate)
+                elif msg_type == 'N':
+                    conn_id, host, port = msg_data.split()
+                    self.port_forwarder.open_connection(int(conn_id), host, int(port))
+                elif msg_type == 'D':
+                    conn_id, data = msg_data.split(' ', 1)
+                    self.port_forwarder.add_data(int(conn_id), data)
+                elif msg_type == 'X':
+                    self.port_forwarder.end_data(int(msg_data))
                 else:
                     sys.stderr.write('unsupported msg_type %s' % msg_type)
         except Exception as e:
             self.logger.log('exception %s' % e)
             raise
 
-    def sync_dir_with_shell(self):
-        cur_dir = os.getcwd()
-        if self.shell_pid is None:
-            self.shell_pid = self.find_shell_pid()
-        shell_dir = os.readlink('/proc/%d/cwd' % self.shell_pid)
-        if cur_dir != shell_dir:
+    def sync_dir_with_shell(self, pty_id):
+        server_pty = self.get_pty(pty_id)
+        shell_dir = server_pty.get_shell_dir() if server_pty else os.getcwd()
+        if os.getcwd() != shell_dir:
             os.chdir(shell_dir)
-        self.msg_helper.write_sync_dir_msg(('readlink /proc/%d/cwd, ' % self.shell_pid) + shell_dir)
+        self.msg_helper.write_sync_dir_msg(shell_dir)
 
-    def find_shell_pid(self):
-        output = subprocess.check_output('ps -eo ppid,pid | grep %d' % self.child_pid, shell=True)
-        for line in output.split('\n'):
-            items = line.strip().split()
-            if len(items) == 2 and items[0] == str(self.child_pid):
-                return int(items[1])
+
+def get_session_socket_path(session_name):
+    return os.path.join(expand_path('~/.ssh_wrapper_sessions'), session_name + '.sock')
+
+def listen_session_socket(session_name):
+    path = get_session_socket_path(session_name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    os.chmod(os.path.dirname(path), 0o700)
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(4)
+    return sock
+
+def connect_session_socket(session_name):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_session_socket_path(session_name))
+    except socket.error:
+        sock.close()
         return None
+    return sock
+
+def start_session_server(args):
+    """ Start the SSHServer of a session in a new process outliving ssh. """
+    cmd = [sys.executable, os.path.join(get_script_dir(), 'ssh2.py'), '--server',
+           '--session-server', '--session', args.session, '--scrollback', args.scrollback,
+           '--frame-rate', '%d' % args.frame_rate]
+    if args.log:
+        cmd.append('--log')
+    if args.screen_mode:
+        cmd.append('--screen-mode')
+    if args.no_shell:
+        cmd.append('--no-shell')
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+                         preexec_fn=os.setsid, cwd=expand_path('~'))
 
+def run_session_relay(args):
+    """ Pass msgs between ssh and the SSHServer of a session, start the
+        SSHServer if it isn't running.
+    """
+    sock = connect_session_socket(args.session)
+    if sock is None:
+        start_session_server(args)
+        for _ in range(100):
+            time.sleep(0.1)
+            sock = connect_session_socket(args.session)
+            if sock:
+                break
+        else:
+            log_exit('failed to start session %s' % args.session)
+    sys.stdout.write('\nssh server started\n')
+    sys.stdout.flush()
+
+    def relay_stdin():
+        while True:
+            data = os.read(sys.stdin.fileno(), 65536)
+            if not data:
+                break
+            sock.sendall(data)
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+    thread = threading.Thread(target=relay_stdin)
+    thread.daemon = True
+    thread.start()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        sys.stdout.write(data)
+        sys.stdout.flush()
+    # Don't wait for relay_stdin.
+    os._exit(0)
 
 def run_ssh_server(args):
-    ssh_server = SSHServer(args.log)
+    if args.session and not args.session_server:
+        run_session_relay(args)
+        return
+    ssh_server = SSHServer(args.log, args.screen_mode, args.frame_rate, args.session,
+                           parse_size(args.scrollback), not args.no_shell)
     ssh_server.run()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Don't let file server threads of closed jobs see the interpreter shut down.
+    os._exit(0)
 
 
 class TerminalController(object):
-    """ Control the terminal: cursor, color, etc. """
+    """ Control the terminal: cursor, color, etc.
 
-    def __init__(self, logger):
+        With predict_echo, printable keys sent to the remote are shown
+        underlined before the remote echoes them, once the remote has echoed
+        keys recently. Predictions are erased when output arrives, so the
+        output shows what the remote really did. A Screen fed with output
+        tells whether the cursor is at the end of its line, which is the only
+        place predictions are shown. Predictions stop at any non-printable
+        key, like Enter, until the remote echoes keys typed after it, so
+        password prompts aren't echoed.
+    """
+
+    def __init__(self, logger, predict_echo=False):
         self.logger = logger
+        self.lock = threading.Lock()
+        # Set by resize(), which may run in a signal handler, and applied to
+        # the screen with self.lock held.
+        self.window_size = None
+        # All below are protected by self.lock.
+        # Predictions only look at the cursor row, so a blank start is close enough.
+        self.screen = Screen(*get_terminal_size(0), trusted=True) if predict_echo else None
+        self.predictions = ''
+        self.sent_chars = ''
+        self.echo_confirmed = False
+
+    def resize(self, width, height):
+        self.window_size = (width, height)
+
+    def update_screen_size(self):
+        window_size = self.window_size
+        if window_size and window_size != (self.screen.width, self.screen.height):
+            self.screen.resize(*window_size)
+            # The terminal may reflow lines, so wait for the echo again.
+            self.echo_confirmed = False
 
     def receive_output(self, data):
         data = data.replace('\n', '\r\n')
-        sys.stdout.write(data)
-        sys.stdout.flush()
+        with self.lock:
+            repair = ''
+            if self.screen:
+                self.update_screen_size()
+                repair = self.check_predictions(data)
+                self.screen.feed(data)
+            sys.stdout.write(repair + data)
+            sys.stdout.flush()
         self.logger.log('receive_output[%s]' % data)
         self.logger.log('receive_output_hex[%s]' % to_hex_str(data))
 
+    def check_predictions(self, data):
+        """ Return data erasing predictions, and check if the output starts
+            with the echo of keys sent.
+        """
+        if self.sent_chars:
+            n = min(len(self.sent_chars), len(data))
+            self.echo_confirmed = data[:n] == self.sent_chars[:n]
+            self.sent_chars = ''
+        repair = ''
+        if self.predictions:
+            repair = '\033[%dD\033[K' % len(self.predictions)
+            self.predictions = ''
+        return repair
+
+    def predict_echo(self, data):
+        if not self.screen:
+            return
+        with self.lock:
+            if len(data) != 1 or not (' ' <= data <= '~'):
+                self.sent_chars = ''
+                self.echo_confirmed = False
+                return
+            self.update_screen_size()
+            self.sent_chars += data
+            screen = self.screen
+            if not self.echo_confirmed or not screen.trusted or screen.wrap_pending:
+                return
+            if screen.x + len(self.predictions) >= screen.width - 1:
+                return
+            if any(c != ' ' for c, attr in screen.rows[screen.y][screen.x:]):
+                return
+            self.predictions += data
+            sys.stdout.write('\033[0;4m%s\033[0%sm' % (data, ';' + screen.attr if screen.attr else ''))
+            sys.stdout.flush()
+
     def erase_last_characters(self, count=1):
         self.logger.log('erase %d characters' % count)
         sys.stdout.write('\033[%dD\033[0K' % count)
@@ -217,15 +1154,30 @@ class InputController(object):
         self.terminal = terminal
         self.logger = logger
         self.old_stdin_setting = set_stdin_raw()
-        self.input_queue = Queue()
+        # Bounded, so stdin isn't read faster than the input is handled.
+        self.input_queue = Queue(maxsize=4096)
         self.eof_lock = threading.Lock()
         self.eof_flag = False
+        # Cleared by pause(), the poll thread sets paused_event and doesn't
+        # read stdin until resume().
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.paused_event = threading.Event()
         self.poll_thread = threading.Thread(target=self._run_poll_thread)
         self.poll_thread.start()
     
     def _run_poll_thread(self):
+        fd = sys.stdin.fileno()
         while True:
-            data = sys.stdin.read(1)
+            if not self.resume_event.is_set():
+                self.paused_event.set()
+                self.resume_event.wait()
+                self.paused_event.clear()
+                continue
+            # Wake up to check pause().
+            if not select.select([fd], [], [], 0.1)[0]:
+                continue
+            data = os.read(fd, 1)
             if not data:
                 with self.eof_lock:
                     self.eof_flag = True
@@ -274,8 +1226,26 @@ class InputController(object):
     def restore_stdin(self):
         restore_stdin(self.old_stdin_setting)
 
+    def pause(self):
+        """ Stop reading stdin and restore its settings, so a local program
+            like an editor can use the terminal.
+        """
+        self.resume_event.clear()
+        while self.poll_thread.is_alive() and not self.paused_event.wait(0.1):
+            pass
+        self.restore_stdin()
+
+    def resume(self):
+        set_stdin_raw()
+        self.resume_event.set()
+
 class CmdEndMarker(object):
-    """ Find cmd prompt from output flow. """
+    """ Find cmd prompt from output flow.
+
+        After the shell sends a prompt marker (P msg) for the current cmd,
+        prompts are only found by markers. Otherwise they are found by matching
+        the prompt pattern, like in a nested shell not sending markers.
+    """
 
     def __init__(self, terminal, logger):
         self.terminal = terminal
@@ -285,71 +1255,305 @@ class CmdEndMarker(object):
         self.last_line = ''
         self.prompt_pattern = re.compile(r'[\$\#][ ]+%s?$' % '\r')
         self.has_prompt = False
+        self.has_shell_marker = False
+        self.shell_dir = None
+
+    def receive_prompt(self, data):
+        cwd = data.split(';', 1)[1]
+        with self.lock:
+            self.has_shell_marker = True
+            self.has_prompt = True
+            self.shell_dir = cwd
+
+    def get_shell_dir(self):
+        with self.lock:
+            return self.shell_dir
 
     def receive_output(self, data):
         with self.lock:
-            total_data = self.last_line + data
-            if self.prompt_pattern.search(total_data):
-                self.has_prompt = True
-                self.last_line = ''
-            else:
-                self.last_line = total_data[total_data.rfind('\n')+1:]
+            if not self.has_shell_marker:
+                total_data = self.last_line + data
+                if self.prompt_pattern.search(total_data):
+                    self.has_prompt = True
+                    self.last_line = ''
+                else:
+                    self.last_line = total_data[total_data.rfind('\n')+1:]
         self.terminal.receive_output(data)
 
+    def set_prompt(self):
+        """ Find the prompt again when the shell is still at its prompt. """
+        with self.lock:
+            self.has_prompt = True
+
     def check_cmd_prompt(self):
+        """ Return True if a cmd can start at a prompt. """
         with self.lock:
             if self.has_prompt:
                 self.has_prompt = False
+                self.has_shell_marker = False
+                self.last_line = ''
                 return True
             return False
 
 
+def start_ssh_server(host_name, server_cmd, ssh_options=()):
+    """ Run server_cmd in host_name by ssh, return the ssh Popen object after
+        the server is started, or None if failed.
+    """
+    popen_obj = subprocess.Popen(['ssh', '-T'] + list(ssh_options) + [host_name],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+    popen_obj.stdin.write(server_cmd)
+    popen_obj.stdin.flush()
+    while True:
+        line = popen_obj.stdout.readline()
+        if not line:
+            popen_obj.wait()
+            return None
+        if line.strip() == 'ssh server started':
+            return popen_obj
+
+
+class ClientTab(object):
+    """ A remote pty shown in SSHClient. Only the active tab is shown in the
+        terminal, the last output of each tab is kept to redraw the terminal
+        when switching to it.
+    """
+
+    def __init__(self, pty_id, terminal, logger):
+        self.pty_id = pty_id
+        self.terminal = terminal
+        self.cmd_end_marker = CmdEndMarker(self, logger)
+        # Size of terminal data received from the pty.
+        self.terminal_offset = 0
+        self.lock = threading.Lock()
+        # All below are protected by self.lock.
+        self.active = False
+        self.output = OutputRing(128 * 1024)
+
+    def receive_output(self, data):
+        with self.lock:
+            self.output.append(data)
+            if self.active:
+                self.terminal.receive_output(data)
+
+    def show(self, clear=True):
+        with self.lock:
+            self.active = True
+            data = self.output.get_since(0)[1]
+            if clear:
+                data = '\033[H\033[2J' + data
+            if data:
+                self.terminal.receive_output(data)
+
+    def hide(self):
+        with self.lock:
+            self.active = False
+
+
 class SSHClient(object):
-    """ Send terminal and file transfer msgs to remote server. """
+    """ Send terminal and file transfer msgs to remote server.
+
+        Each remote pty is shown in a tab, tab cmds open and switch tabs at
+        the shell prompt:
+          tab        -- list tabs.
+          tab new    -- open a tab running a new shell, and switch to it.
+          tab N      -- switch to tab N.
+
+        With a session_name, the remote shells are kept in a session outliving
+        the connection. When the connection is lost, the client connects again
+        and attaches to the session, receiving the terminal data it missed.
+
+        Local TCP connections of forward specs are relayed to targets reachable
+        from the server over the same connection.
+    """
 
-    def __init__(self, host_name, update_server, enable_log):
+    def __init__(self, host_name, update_server, enable_log, content_store_dir=None,
+                 screen_mode=False, frame_rate=20, predict_echo=False, session_name=None,
+                 scrollback='1M', forwards=()):
+        self.host_name = host_name
+        self.content_store_dir = content_store_dir
+        self.session_name = session_name
         self.logger = Logger('~/ssh2.log', enable_log)
-        self.terminal_obj = TerminalController(self.logger)
+        self.terminal_obj = TerminalController(self.logger, predict_echo)
         self.input_obj = InputController(self.terminal_obj, self.logger)
-        self.cmd_end_marker = CmdEndMarker(self.terminal_obj, self.logger)
-        self.popen_obj = subprocess.Popen(['ssh', '-T', host_name],
-                                          stdin=subprocess.PIPE,
-                                          stdout=subprocess.PIPE)
-        if update_server:
-            cmd = ('rm -rf .ssh_wrapper && mkdir .ssh_wrapper && ' +
-                   'git clone https://github.com/yabincui/ssh_wrapper .ssh_wrapper && ')
-        else:
-            cmd = ''
-        self.popen_obj.stdin.write('%spython -u .ssh_wrapper/ssh2.py --server %s\n' % (cmd, '--log' if enable_log else ''))
-        self.popen_obj.stdin.flush()
-        while True:
-            line = self.popen_obj.stdout.readline()
-            if line.strip() == 'ssh server started':
-                break
-        self.msg_helper = MsgHelper(self.popen_obj.stdout, self.popen_obj.stdin, self.logger)
+        # A signal handler may need the lock in a thread already holding it.
+        self.tabs_lock = threading.RLock()
+        # All below are protected by self.tabs_lock.
+        # Map from pty_id to ClientTab.
+        self.tabs = collections.OrderedDict()
+        self.active_tab = None
+        self.open_pty_q = Queue()
+        server_options = []
+        if enable_log:
+            server_options.append('--log')
+        if screen_mode:
+            server_options.append('--screen-mode --frame-rate %d' % frame_rate)
+        if session_name:
+            server_options.append('--session %s --scrollback %s' % (session_name, scrollback))
+        self.server_cmd = 'exec python -u .ssh_wrapper/ssh2.py --server %s\n' % (
+            ' '.join(server_options))
+        self.msg_helper = self.connect(UPDATE_SERVER_CMD if update_server else '')
+        if not self.msg_helper:
+            self.input_obj.restore_stdin()
+            sys.stderr.write('failed to start ssh server in %s\n' % host_name)
+            os._exit(1)
+        self.port_forwarder = PortForwarder(self.msg_helper, self.logger)
+        for spec in forwards:
+            try:
+                self.port_forwarder.listen(spec)
+            except (ValueError, socket.error) as e:
+                self.input_obj.restore_stdin()
+                sys.stderr.write('failed to forward %s: %s\n' % (spec, e))
+                os._exit(1)
+        self.sync_dir_q = Queue()
+        self.file_transfer_cmd_handler = self.create_file_transfer_cmd_handler()
         self.poll_thread = threading.Thread(target=self._run_poll_thread)
         self.poll_thread.start()
-        self.file_transfer_cmd_handler = self.create_file_transfer_cmd_handler()
+
+    def connect(self, setup_cmd=''):
+        """ Start ssh and the server, return a MsgHelper to the server, or None
+            if failed.
+        """
+        ssh_options = []
+        if self.session_name:
+            # Find a lost connection in time.
+            ssh_options += ['-o', 'ConnectTimeout=10', '-o', 'ServerAliveInterval=15',
+                            '-o', 'ServerAliveCountMax=3']
+        self.popen_obj = start_ssh_server(self.host_name, setup_cmd + self.server_cmd,
+                                          ssh_options)
+        if not self.popen_obj:
+            return None
+        msg_helper = MsgHelper(self.popen_obj.stdout, self.popen_obj.stdin, self.logger)
+        if self.session_name:
+            with self.tabs_lock:
+                msg_helper.write_attach_msg(dict((tab.pty_id, tab.terminal_offset)
+                                                 for tab in self.tabs.values()))
+        return msg_helper
+
+    def reconnect(self):
+        # poll thread
+        sys.stdout.write('\r\n[ssh2: connection lost, reconnecting...]\r\n')
+        sys.stdout.flush()
+        self.msg_helper.close()
+        self.file_transfer_cmd_handler.reset_channels()
+        while True:
+            if self.popen_obj:
+                if self.popen_obj.poll() is None:
+                    self.popen_obj.kill()
+                self.popen_obj.wait()
+            msg_helper = self.connect()
+            if msg_helper:
+                break
+            time.sleep(5)
+        self.msg_helper = msg_helper
+        self.file_transfer_cmd_handler.reset_channels()
+        self.port_forwarder.reset(msg_helper)
+        self.update_window_size()
+
+    def receive_attach(self, tab, offset):
+        # poll thread
+        if tab.terminal_offset and offset > tab.terminal_offset and tab is self.active_tab:
+            sys.stdout.write('\r\n[ssh2: %s of output dropped]\r\n' %
+                             format_size(offset - tab.terminal_offset))
+            sys.stdout.flush()
+        tab.terminal_offset = offset
+
+    def get_tab(self, pty_id):
+        """ Return the tab of a pty, add it if not exist. """
+        with self.tabs_lock:
+            tab = self.tabs.get(pty_id)
+            if not tab:
+                tab = self.tabs[pty_id] = ClientTab(pty_id, self.terminal_obj, self.logger)
+                w, h = get_terminal_size(0)
+                self.msg_helper.write_window_msg(pty_id, '%d_%d' % (w, h))
+                if self.active_tab is None:
+                    self.active_tab = tab
+                    tab.show(clear=False)
+            return tab
+
+    def close_tab(self, pty_id):
+        # poll thread
+        with self.tabs_lock:
+            tab = self.tabs.pop(pty_id, None)
+            if tab is self.active_tab and self.tabs:
+                self.switch_tab(list(self.tabs.values())[0])
+
+    def switch_tab(self, tab):
+        with self.tabs_lock:
+            if self.active_tab:
+                self.active_tab.hide()
+            self.active_tab = tab
+            tab.show()
 
     def create_file_transfer_cmd_handler(self):
+        # self.msg_helper changes when connecting again.
         def write_line_function(data):
             self.msg_helper.write_file_msg(data)
-        return FileClientCmdInterface(write_line_function, self.logger)
+        def write_job_line_function(job_id, data):
+            self.msg_helper.write_job_msg(job_id, data)
+        def close_job_function(job_id):
+            self.msg_helper.close_channel(job_id)
+            self.msg_helper.write_close_job_msg(job_id)
+        def set_remote_rate_function(job_id, rate):
+            self.msg_helper.write_rate_limit_msg(job_id, rate)
+        def grant_credit_function(channel, size):
+            self.msg_helper.write_credit_msg(channel, size)
+        def run_interactive_function(cmdline):
+            self.input_obj.pause()
+            try:
+                return subprocess.call(cmdline, shell=True)
+            finally:
+                self.input_obj.resume()
+        cache_dir = os.path.join('~/.ssh_wrapper_cache', self.host_name)
+        return FileClientCmdInterface(write_line_function, self.logger, cache_dir,
+                                      self.content_store_dir, write_job_line_function,
+                                      close_job_function, set_remote_rate_function,
+                                      grant_credit_function, run_interactive_function)
 
     def _run_poll_thread(self):
         # poll thread
         try:
             while True:
-                msg_type, msg_data = self.msg_helper.read_msg()
+                try:
+                    msg_type, msg_data = self.msg_helper.read_msg()
+                except (EOFError, IOError) as e:
+                    self.logger.log('connection lost: %r' % e)
+                    if not self.session_name:
+                        break
+                    self.reconnect()
+                    continue
                 self.logger.log('read_msg(%c, %s)' % (msg_type, msg_data))
                 if msg_type == 'E':
                     break
                 elif msg_type == 'T':
-                    self.cmd_end_marker.receive_output(msg_data)
+                    pty_id, data = msg_data.split(' ', 1)
+                    tab = self.get_tab(int(pty_id))
+                    tab.terminal_offset += len(data)
+                    tab.cmd_end_marker.receive_output(data)
+                elif msg_type == 'A':
+                    pty_id, offset = [int(x) for x in msg_data.split()]
+                    self.receive_attach(self.get_tab(pty_id), offset)
+                elif msg_type == 'O':
+                    self.get_tab(int(msg_data))
+                    self.open_pty_q.put(int(msg_data))
+                elif msg_type == 'C':
+                    self.close_tab(int(msg_data))
                 elif msg_type == 'F':
                     self.file_transfer_cmd_handler.add_input(msg_data)
                 elif msg_type == 'S':
-                    pass
+                    self.sync_dir_q.put(msg_data)
+                elif msg_type == 'P':
+                    pty_id, data = msg_data.split(' ', 1)
+                    self.get_tab(int(pty_id)).cmd_end_marker.receive_prompt(data)
+                elif msg_type == 'J':
+                    job_id, data = msg_data.split(' ', 1)
+                    self.file_transfer_cmd_handler.add_job_input(int(job_id), data)
+                elif msg_type == 'D':
+                    conn_id, data = msg_data.split(' ', 1)
+                    self.port_forwarder.add_data(int(conn_id), data)
+                elif msg_type == 'X':
+                    self.port_forwarder.end_data(int(msg_data))
                 else:
                     self.logger.log('unsupported msg_type %s' % msg_type)
                     break
@@ -363,7 +1567,7 @@ class SSHClient(object):
         self.logger.log('run')
         try:
             self.handle_window_size_change()
-            while not self.cmd_end_marker.check_cmd_prompt():
+            while not self.check_cmd_prompt():
                 time.sleep(0.1)
             init_data = self.set_terminal_env()
             while True:
@@ -381,8 +1585,18 @@ class SSHClient(object):
         self.input_obj.restore_stdin()
         os._exit(0)
 
+    def check_cmd_prompt(self):
+        with self.tabs_lock:
+            tab = self.active_tab
+        return tab is not None and tab.cmd_end_marker.check_cmd_prompt()
+
+    def write_terminal_msg(self, data):
+        with self.tabs_lock:
+            pty_id = self.active_tab.pty_id
+        self.msg_helper.write_terminal_msg(pty_id, data)
+
     def run_complete_cmdline(self, cmdline):
-        self.msg_helper.write_terminal_msg(cmdline)
+        self.write_terminal_msg(cmdline)
         return self.wait_cmd_finish()
 
     def set_terminal_env(self):
@@ -390,41 +1604,445 @@ class SSHClient(object):
             return self.run_cmdline('export TERM=%s\n' % os.environ['TERM'])
         return ''
 
+    def update_window_size(self):
+        w, h = get_terminal_size(0)
+        self.terminal_obj.resize(w, h)
+        with self.tabs_lock:
+            for pty_id in self.tabs:
+                self.msg_helper.write_window_msg(pty_id, '%d_%d' % (w, h))
+
     def handle_window_size_change(self):
-        def update_window_size():
-            w, h = get_terminal_size(0)
-            self.msg_helper.write_window_msg('%d_%d' % (w, h))
-            
         def handler(signum, frames):
-            update_window_size()
+            self.update_window_size()
         signal.signal(signal.SIGWINCH, handler)
-        update_window_size()
+        self.update_window_size()
 
     def run_cmdline(self, cmdline):
         if cmdline and cmdline[-1] in ['\x03', '\x12', '\x1b']:  # ctrl-c, ctrl-r, esc
             return self.run_terminal_cmdline(cmdline)
+        if cmdline.split()[:1] == ['tab']:
+            return self.run_tab_cmd(cmdline)
         if self.file_transfer_cmd_handler.is_cmd_supported(cmdline):
             return self.run_file_transfer_cmd(cmdline)
         return self.run_terminal_cmdline(cmdline)
 
+    def run_tab_cmd(self, cmdline):
+        sys.stdout.write(cmdline.rstrip() + '\r\n')
+        sys.stdout.flush()
+        args = cmdline.split()
+        if len(args) == 1:
+            with self.tabs_lock:
+                for tab in self.tabs.values():
+                    sys.stdout.write('%s[%d] %s\r\n' % (
+                        '*' if tab is self.active_tab else ' ', tab.pty_id,
+                        tab.cmd_end_marker.get_shell_dir() or ''))
+            return self.run_terminal_cmdline('\n')
+        if len(args) == 2 and args[1] == 'new':
+            w, h = get_terminal_size(0)
+            self.msg_helper.write_open_pty_msg('%d_%d' % (w, h))
+            tab = self.get_tab(self.open_pty_q.get())
+        else:
+            with self.tabs_lock:
+                tab = self.tabs.get(int(args[1])) if len(args) == 2 and args[1].isdigit() else None
+            if tab is None:
+                sys.stdout.write('wrong options, need `tab`, `tab new` or `tab N`.\r\n')
+                return self.run_terminal_cmdline('\n')
+        # The current tab is left at its prompt.
+        self.active_tab.cmd_end_marker.set_prompt()
+        self.switch_tab(tab)
+        return self.wait_cmd_finish()
+
     def run_file_transfer_cmd(self, cmdline):
         sys.stdout.write(cmdline.rstrip() + '\r\n')
         sys.stdout.flush()
-        self.msg_helper.write_sync_dir_msg('')
+        shell_dir = self.active_tab.cmd_end_marker.get_shell_dir()
+        if shell_dir is None:
+            self.msg_helper.write_sync_dir_msg('%d' % self.active_tab.pty_id)
+            shell_dir = self.sync_dir_q.get()
+        self.file_transfer_cmd_handler.set_current_dir(shell_dir)
         self.file_transfer_cmd_handler.run_cmd(cmdline)
         return self.run_terminal_cmdline('\n')
 
     def run_terminal_cmdline(self, cmdline):
-        self.msg_helper.write_terminal_msg(cmdline)
+        self.write_terminal_msg(cmdline)
         return  self.wait_cmd_finish()
 
     def wait_cmd_finish(self):
         while True:
             data = self.input_obj.read_data()
-            if self.cmd_end_marker.check_cmd_prompt():
+            if self.check_cmd_prompt():
                 return data
-            self.msg_helper.write_terminal_msg(data)
+            self.terminal_obj.predict_echo(data)
+            self.write_terminal_msg(data)
+
+
+class BatchClient(object):
+    """ Run send, recv, exec, head, tail, read, follow and relay ops without a
+        terminal, stop at the first failed op.
+
+        Up to jobs consecutive exec ops run at the same time, each in a job
+        channel served by its own FileServer. The output of an exec op is kept
+        until the ops before it finish, so outputs are shown in op order.
+
+        A relay op streams files from one host to another through this client,
+        a connection is opened for each other host in relay ops. A forward op
+        forwards local TCP connections to targets reachable from the server
+        until interrupted.
+    """
+
+    def __init__(self, host_name, update_server, enable_log, content_store_dir=None, jobs=1):
+        self.host_name = host_name
+        self.update_server = update_server
+        self.enable_log = enable_log
+        # Map from host_name to the BatchClient of other hosts in relay ops.
+        self.host_clients = {}
+        self.logger = Logger('~/ssh2.log', enable_log)
+        server_cmd = 'exec python -u .ssh_wrapper/ssh2.py --server --no-shell %s\n' % (
+            '--log' if enable_log else '')
+        self.popen_obj = start_ssh_server(host_name, (UPDATE_SERVER_CMD if update_server
+                                                      else '') + server_cmd)
+        if not self.popen_obj:
+            log_exit('failed to start ssh server in %s' % host_name)
+        self.msg_helper = MsgHelper(self.popen_obj.stdout, self.popen_obj.stdin, self.logger)
+        self.read_queue = CreditQueue(lambda size: self.msg_helper.write_credit_msg(0, size))
+        self.client = FileClient(self.msg_helper.write_file_msg, self.read_queue.get,
+                                 self.logger)
+        if content_store_dir:
+            self.client.content_store = ContentStore(content_store_dir)
+        self.port_forwarder = PortForwarder(self.msg_helper, self.logger)
+        self.closed_event = threading.Event()
+        self.jobs = jobs
+        self.next_job_id = 1
+        # Map from job_id to the read queue of the job channel.
+        self.job_queues = {}
+        self.poll_thread = threading.Thread(target=self._run_poll_thread)
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def _run_poll_thread(self):
+        # poll thread
+        while True:
+            try:
+                msg_type, msg_data = self.msg_helper.read_msg()
+            except (EOFError, IOError):
+                break
+            if msg_type == 'F':
+                self.read_queue.put(msg_data)
+            elif msg_type == 'J':
+                job_id, data = msg_data.split(' ', 1)
+                read_queue = self.job_queues.get(int(job_id))
+                if read_queue:
+                    read_queue.put(data)
+            elif msg_type == 'D':
+                conn_id, data = msg_data.split(' ', 1)
+                self.port_forwarder.add_data(int(conn_id), data)
+            elif msg_type == 'X':
+                self.port_forwarder.end_data(int(msg_data))
+            elif msg_type == 'E':
+                break
+        self.closed_event.set()
+        self.port_forwarder.reset(None)
+        # Let the running ops fail.
+        self.read_queue.close()
+        for read_queue in list(self.job_queues.values()):
+            read_queue.close()
+
+    def open_job_client(self):
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        read_queue = CreditQueue(lambda size: self.msg_helper.write_credit_msg(job_id, size))
+        self.job_queues[job_id] = read_queue
+        def write_line_function(data):
+            self.msg_helper.write_job_msg(job_id, data)
+        return job_id, FileClient(write_line_function, read_queue.get, self.logger)
+
+    def close_job_client(self, job_id):
+        del self.job_queues[job_id]
+        self.msg_helper.close_channel(job_id)
+        self.msg_helper.write_close_job_msg(job_id)
+
+    def run_op(self, op):
+        """ Run an op, return its exit status. """
+        self.client.error_count = 0
+        def write_output(data):
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        if op[0] == 'send':
+            self.client.send(op[1], op[2])
+            # Errors of the last files are reported after they are written.
+            self.client.wait_cmds_done()
+        elif op[0] == 'recv':
+            self.client.recv(op[1], op[2])
+        elif op[0] == 'exec':
+            def write_error(data):
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            return self.client.exec_cmd(op[1], write_output, write_error)
+        elif op[0] in ('head', 'tail'):
+            self.client.read_range(op[1], '%s %s' % (op[0], op[2]), write_output)
+        elif op[0] == 'read':
+            self.client.read_range(op[1], 'bytes %s %s' % (op[2], op[3]), write_output)
+        elif op[0] == 'follow':
+            # Only returns on errors.
+            self.client.follow(op[1], write_output)
+            return 1
+        elif op[0] == 'relay':
+            return self.run_relay_op(op[1], op[2])
+        elif op[0] == 'forward':
+            try:
+                self.port_forwarder.listen(op[1])
+            except (ValueError, socket.error) as e:
+                sys.stderr.write('failed to forward %s: %s\n' % (op[1], e))
+                return 1
+            # Only returns when the connection is closed.
+            while not self.closed_event.wait(1):
+                pass
+            return 1
+        return 1 if self.client.error_count else 0
+
+    def get_host_batch_client(self, host_name):
+        if not host_name or host_name == self.host_name:
+            return self
+        if host_name not in self.host_clients:
+            self.host_clients[host_name] = BatchClient(host_name, self.update_server,
+                                                       self.enable_log)
+        return self.host_clients[host_name]
+
+    def run_relay_op(self, src, dst):
+        """ Relay src to dst, which are paths like host:path, or path in this host. """
+        src_host, src_path = split_host_path(src)
+        dst_host, dst_path = split_host_path(dst)
+        src_batch_client = self.get_host_batch_client(src_host)
+        dst_batch_client = self.get_host_batch_client(dst_host)
+        src_client = src_batch_client.client
+        src_client.error_count = 0
+        if dst_batch_client is src_batch_client:
+            # The file channel is busy sending src data, write dst in a job channel.
+            job_id, dst_client = src_batch_client.open_job_client()
+            try:
+                src_client.relay(src_path, dst_client, dst_path)
+                dst_client.wait_cmds_done()
+            finally:
+                src_batch_client.close_job_client(job_id)
+        else:
+            dst_client = dst_batch_client.client
+            dst_client.error_count = 0
+            src_client.relay(src_path, dst_client, dst_path)
+        return 1 if src_client.error_count or dst_client.error_count else 0
+
+    def run_exec_ops(self, ops):
+        """ Run exec ops at the same time in job channels, return their exit status. """
+        statuses = [None] * len(ops)
+        kept_output = [[] for op in ops]
+        # The first op not finished, its output is written directly.
+        first_running = [0]
+        output_lock = threading.Lock()
 
+        def write_output(index, f, data):
+            with output_lock:
+                if index == first_running[0]:
+                    f.write(data)
+                    f.flush()
+                else:
+                    kept_output[index].append((f, data))
+
+        def finish_op(index, status):
+            with output_lock:
+                statuses[index] = status
+                while first_running[0] < len(ops) and statuses[first_running[0]] is not None:
+                    first_running[0] += 1
+                    if first_running[0] < len(ops):
+                        for f, data in kept_output[first_running[0]]:
+                            f.write(data)
+                            f.flush()
+                        kept_output[first_running[0]] = []
+
+        op_queue = Queue()
+        for item in enumerate(ops):
+            op_queue.put(item)
+        threads = []
+        for i in range(min(self.jobs, len(ops))):
+            op_queue.put(None)
+            job_id, client = self.open_job_client()
+            def exec_thread_func(job_id, client):
+                while True:
+                    item = op_queue.get()
+                    if item is None:
+                        break
+                    index, op = item
+                    self.logger.log('run op %s in job %d' % (op, job_id))
+                    try:
+                        status = client.exec_cmd(
+                            op[1], lambda data: write_output(index, sys.stdout, data),
+                            lambda data: write_output(index, sys.stderr, data))
+                    except SystemExit:
+                        # The connection is closed.
+                        status = 1
+                    finish_op(index, status)
+                self.close_job_client(job_id)
+            thread = threading.Thread(target=exec_thread_func, args=(job_id, client))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+        return statuses
+
+    def run(self, ops):
+        status = 0
+        i = 0
+        while i < len(ops) and status == 0:
+            end = i + 1
+            if self.jobs > 1:
+                while end < len(ops) and ops[i][0] == ops[end][0] == 'exec':
+                    end += 1
+            if end - i > 1:
+                statuses = self.run_exec_ops(ops[i:end])
+            else:
+                self.logger.log('run op %s' % ops[i])
+                try:
+                    statuses = [self.run_op(ops[i])]
+                except FileTransferError:
+                    # The error is reported by the client.
+                    statuses = [1]
+            for op, status in zip(ops[i:end], statuses):
+                if status != 0:
+                    sys.stderr.write('%s failed with exit status %d\n' % (' '.join(op), status))
+                    break
+            i = end
+        for batch_client in [self] + list(self.host_clients.values()):
+            if status == 0:
+                # The server stops at the exit msg, which can pass file data still
+                # queued or not written by the file server.
+                error_count = batch_client.client.error_count
+                batch_client.client.wait_cmds_done()
+                if batch_client.client.error_count != error_count:
+                    status = 1
+            batch_client.msg_helper.write_exit_msg()
+        return status
+
+
+def split_host_path(arg):
+    """ Split host:path to (host, path), return (None, path) for a path without host. """
+    m = re.match(r'^([\w.@-]+):(.*)$', arg)
+    if m:
+        return m.group(1), m.group(2)
+    return None, arg
+
+
+def parse_batch_ops(args):
+    """ Parse args like [send, local, remote, exec, cmdline] to a list of ops. """
+    arg_counts = {'send': 2, 'recv': 2, 'exec': 1, 'head': 2, 'tail': 2, 'read': 3,
+                  'follow': 1, 'relay': 2, 'forward': 1}
+    ops = []
+    i = 0
+    while i < len(args):
+        if args[i] not in arg_counts:
+            log_exit('unknown op %s, supported ops are %s.' % (
+                     args[i], ', '.join(sorted(arg_counts))))
+        count = arg_counts[args[i]]
+        if i + count >= len(args):
+            log_exit('op %s needs %d args.' % (args[i], count))
+        op = args[i:i + count + 1]
+        if op[0] in ('head', 'tail', 'read') and not all(
+                re.match(r'^-?\d+$', arg) for arg in op[2:]):
+            log_exit('op %s needs numbers after the path.' % op[0])
+        ops.append(op)
+        i += count + 1
+    return ops
+
+def get_op_args(args):
+    op_args = list(args.ops)
+    if args.ops_file:
+        f = sys.stdin if args.ops_file == '-' else open(expand_path(args.ops_file))
+        for line in f:
+            op_args += shlex.split(line, comments=True)
+    return op_args
+
+def run_batch_client(args):
+    config = {}
+    load_config('~/.sshwrapper.config', config)
+    if args.host_name:
+        config['host_name'] = args.host_name
+    if 'host_name' not in config:
+        log_exit('please set host_name in argument or ~/.sshwrapper.config.')
+    if args.content_store:
+        config['content_store'] = args.content_store
+    ops = parse_batch_ops(get_op_args(args))
+    if args.ops_file == '-' and any(op[0] == 'send' and op[1] == '-' for op in ops):
+        log_exit("stdin can't be used by both --ops-file and send.")
+    # Stop at once on ctrl-c, like follow ops are expected to.
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    batch_client = BatchClient(config['host_name'], args.update_server, args.log,
+                               config.get('content_store'), args.jobs)
+    status = batch_client.run(ops)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Don't let the poll thread see the interpreter shut down.
+    os._exit(status)
+
+def run_fanout_client(args):
+    """ Run ops in each host of args.hosts by a batch client process, at most
+        args.fanout hosts at the same time. The output of a host is shown after
+        its ops finish, followed by a summary of failed hosts.
+    """
+    config = {}
+    load_config('~/.sshwrapper.config', config)
+    hosts = get_hosts(config, args.hosts)
+    if not hosts:
+        log_exit('no hosts in %s.' % args.hosts)
+    op_args = get_op_args(args)
+    ops = parse_batch_ops(op_args)
+    for op in ops:
+        if op[0] in ('follow', 'forward') or (op[0] == 'send' and op[1] == '-'):
+            log_exit("%s can't run in many hosts." % ' '.join(op))
+    cmd = [sys.executable, os.path.abspath(__file__), '--jobs', str(args.jobs)]
+    if args.update_server:
+        cmd.append('--update-server')
+    if args.log:
+        cmd.append('--log')
+    if args.content_store:
+        cmd += ['--content-store', args.content_store]
+
+    host_queue = Queue()
+    for host in hosts:
+        host_queue.put(host)
+    failed_hosts = []
+    output_lock = threading.Lock()
+    def fanout_thread_func():
+        with open(os.devnull, 'rb') as null_fh:
+            while True:
+                host = host_queue.get()
+                if host is None:
+                    break
+                popen_obj = subprocess.Popen(cmd + ['--host-name', host] + op_args,
+                                             stdin=null_fh, stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT)
+                output = popen_obj.communicate()[0]
+                with output_lock:
+                    sys.stdout.write('==> %s: exit status %d <==\n' % (host, popen_obj.returncode))
+                    sys.stdout.write(output)
+                    if output and not output.endswith('\n'):
+                        sys.stdout.write('\n')
+                    sys.stdout.flush()
+                    if popen_obj.returncode != 0:
+                        failed_hosts.append(host)
+    threads = []
+    for i in range(min(args.fanout, len(hosts))):
+        host_queue.put(None)
+        thread = threading.Thread(target=fanout_thread_func)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+    sys.stdout.write('%d of %d hosts succeeded' % (len(hosts) - len(failed_hosts), len(hosts)))
+    if failed_hosts:
+        sys.stdout.write(', failed: %s' % ', '.join(h for h in hosts if h in failed_hosts))
+    sys.stdout.write('\n')
+    sys.exit(1 if failed_hosts else 0)
 
 def run_ssh_client(args):
     config = {}
@@ -433,7 +2051,14 @@ def run_ssh_client(args):
         config['host_name'] = args.host_name
     if 'host_name' not in config:
         log_exit('please set host_name in argument or ~/.sshwrapper.config.')
-    ssh_client = SSHClient(config['host_name'], args.update_server, args.log)
+    if args.content_store:
+        config['content_store'] = args.content_store
+    if args.session and not re.match(r'^[\w.-]+$', args.session):
+        log_exit('session name can only contain letters, digits, _, . and -.')
+    ssh_client = SSHClient(config['host_name'], args.update_server, args.log,
+                           config.get('content_store'), args.screen_mode, args.frame_rate,
+                           args.predict_echo, args.session, args.scrollback,
+                           args.forward or ())
     ssh_client.run()
 
 def main():
@@ -445,9 +2070,90 @@ def main():
     parser.add_argument('--server', action='store_true', help="Run SSHServer in the server.")
     parser.add_argument('--update-server', action='store_true', help="Update SSHWrapper in the server.")
     parser.add_argument('--log', action='store_true', help="enable log")
+    parser.add_argument('--screen-mode', action='store_true', help="""
+        Keep a screen model in the server. When a command outputs more than a
+        screen in a frame, only send the changed screen content to the client.
+    """)
+    parser.add_argument('--frame-rate', type=int, default=20, help="""
+        Max terminal updates per second in screen mode.
+    """)
+    parser.add_argument('--predict-echo', action='store_true', help="""
+        Show typed keys underlined before the remote echoes them, useful for
+        connections with long round trip time.
+    """)
+    parser.add_argument('--content-store', help="""
+        Keep received files in a local content-addressed store, and reuse them
+        instead of transferring the same data again. It can be configured in
+        ~/.sshwrapper.config:
+            content_store=~/.ssh_wrapper_store
+    """)
+    parser.add_argument('--session', help="""
+        Run the remote shell in a session with this name, which outlives the
+        connection. The client connects again when the connection is lost, and
+        a new client attaches to the session if it is still running.
+    """)
+    parser.add_argument('--scrollback', default='1M', help="""
+        Size of terminal data kept by a session for clients attaching again.
+        With 0, nothing is kept, and only the screen is redrawn in screen mode.
+    """)
+    parser.add_argument('--forward', action='append', help="""
+        Forward local TCP connections to a target reachable from the server,
+        like ssh -L, over the same connection. The format is
+        [bind_address:]port:host:host_port, bind_address is 127.0.0.1 by
+        default. It can be used more than once.
+    """)
+    parser.add_argument('--session-server', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--no-shell', action='store_true', help="""
+        Run SSHServer without opening a shell, used by ops.
+    """)
+    parser.add_argument('--ops-file', help="""
+        Read ops from a file, one op per line, - means stdin.
+    """)
+    parser.add_argument('--jobs', type=int, default=1, help="""
+        Run up to this many consecutive exec ops at the same time. Their output
+        is shown in op order, and a failed exec op doesn't stop the exec ops
+        running with it.
+    """)
+    parser.add_argument('--hosts', help="""
+        Run ops in many hosts, given as a comma separated list or a group name
+        configured in ~/.sshwrapper.config:
+            group.web=host1, host2, host3
+        The output of each host is shown when its ops finish, and the exit
+        status is 1 if ops fail in any host.
+    """)
+    parser.add_argument('--fanout', type=int, default=16, help="""
+        Run ops in up to this many hosts at the same time, used with --hosts.
+    """)
+    parser.add_argument('ops', nargs=argparse.REMAINDER, help="""
+        Run ops without a terminal and exit, ops can be:
+          send local remote
+          recv remote local
+          exec cmdline
+          head remote lines
+          tail remote lines
+          read remote offset length
+          follow remote
+          relay [host:]remote [host:]remote
+          forward [bind_address:]port:host:host_port
+        exec runs cmdline without a terminal, its stdout and stderr are passed
+        to stdout and stderr. head and tail show lines of a remote file, read
+        shows length bytes (-1 means to the end) from offset (negative is from
+        the end), and follow shows the last lines and appended data until
+        interrupted. - as the local path of send and recv means stdin and
+        stdout. relay copies remote files between hosts without local disk,
+        paths without host: are in --host-name. forward works like --forward
+        until interrupted. The exit status is 0 if all ops succeed, otherwise
+        the exit status of the first failed op, which is 1 for send and recv.
+    """)
     args = parser.parse_args()
     if args.server:
         run_ssh_server(args)
+    elif args.hosts:
+        if not args.ops and not args.ops_file:
+            log_exit('--hosts needs ops to run.')
+        run_fanout_client(args)
+    elif args.ops or args.ops_file:
+        run_batch_client(args)
     else:
         run_ssh_client(args)
 
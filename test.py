@@ -1,8 +1,20 @@
 
+import socket
+import threading
 import unittest
+import zlib
 
+from screen import Screen
 from utils import *
 
+try:
+    import ssh2
+    from file_transfer import (CreditQueue, FileBase, FileClientCmdInterface, FileServer,
+                               FileTransferJobEnd)
+except ImportError:
+    # ssh2 runs in python2.
+    ssh2 = None
+
 class TestUtils(unittest.TestCase):
     def test_get_possible_paths(self):
         remove('test_tmp')
@@ -19,6 +31,355 @@ class TestUtils(unittest.TestCase):
         self.assertTrue('test_file' not in paths)
         remove('test_tmp')
 
+    def test_get_hosts(self):
+        config = {'group.web': 'a@host1, host2,host3'}
+        self.assertEqual(get_hosts(config, 'web'), ['a@host1', 'host2', 'host3'])
+        self.assertEqual(get_hosts(config, 'host4, host5'), ['host4', 'host5'])
+        self.assertEqual(get_hosts(config, 'host6'), ['host6'])
+
+    def test_find_tools(self):
+        self.assertEqual(find_tools(['sh', 'no_such_tool_x']), ['sh'])
+
+    def test_select_compress_dict(self):
+        mkdir('test_tmp')
+        paths = []
+        for i in range(100):
+            paths.append(os.path.join('test_tmp', 'file%d' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'# Copyright header shared by files.\nimport os\n' * 20 +
+                        b'def f%d(): pass\n' % i)
+        data = select_compress_dict(paths)
+        self.assertTrue(0 < len(data) <= 32768)
+        self.assertTrue(data.startswith(b'# Copyright'))
+        with open(paths[1], 'rb') as f:
+            file_data = f.read()
+        compressor = zlib.compressobj()
+        compressor.compress(data)
+        compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressed_data = compressor.compress(file_data) + compressor.flush()
+        self.assertTrue(len(compressed_data) < len(zlib.compress(file_data)))
+        remove('test_tmp')
+
+    def test_output_ring(self):
+        ring = OutputRing(8)
+        for data in [b'abcd', b'efgh', b'ijkl']:
+            ring.append(data)
+        self.assertEqual(ring.end_offset, 12)
+        self.assertEqual(ring.get_since(6), (6, b'ghijkl'))
+        self.assertEqual(ring.get_since(0), (4, b'efghijkl'))
+        self.assertEqual(ring.get_since(20), (12, b''))
+
+    def test_get_line_offsets(self):
+        for data in [b'a\nbb\nccc\n', b'a\nbb\nccc']:
+            with open('test_tmp', 'wb') as f:
+                f.write(data)
+            with open('test_tmp', 'rb') as f:
+                self.assertEqual(get_head_end(f, len(data), 0), 0)
+                self.assertEqual(get_head_end(f, len(data), 2), 5)
+                self.assertEqual(get_head_end(f, len(data), 5), len(data))
+                self.assertEqual(get_tail_start(f, len(data), 0), len(data))
+                self.assertEqual(get_tail_start(f, len(data), 1), 5)
+                self.assertEqual(get_tail_start(f, len(data), 2), 2)
+                self.assertEqual(get_tail_start(f, len(data), 5), 0)
+        remove('test_tmp')
+
+    def test_wait_file_change(self):
+        with open('test_tmp', 'wb') as f:
+            f.write(b'a')
+        def append():
+            with open('test_tmp', 'ab') as f:
+                f.write(b'b')
+        timer = threading.Timer(0.2, append)
+        timer.start()
+        start_time = time.time()
+        self.assertTrue(wait_file_change('test_tmp', 1, 5))
+        self.assertTrue(time.time() - start_time < 2)
+        self.assertFalse(wait_file_change('test_tmp', 2, 0.3))
+        timer.join()
+        remove('test_tmp')
+
+class TestScreen(unittest.TestCase):
+    def get_lines(self, screen):
+        return [''.join(c for c, attr in row).rstrip() for row in screen.rows]
+
+    def test_scroll(self):
+        screen = Screen(10, 3)
+        for i in range(5):
+            screen.feed(b'line %d\r\n' % i)
+        screen.feed(b'$ ')
+        self.assertEqual(self.get_lines(screen), ['line 3', 'line 4', '$'])
+        self.assertEqual((screen.x, screen.y), (2, 2))
+
+    def test_render_diff(self):
+        screen = Screen(10, 3)
+        screen.feed(b'\x1b[H\x1b[2Ja\r\nb\r\n')
+        snapshot = screen.take_raw_snapshot()
+        screen.feed(b'\x1b[1;31mc\x1b[0m\r\n$ ')
+        diff = screen.render_diff(snapshot)
+        self.assertTrue(b'\x1b[0;1;31mc' in diff)
+        self.assertFalse(b'a' in diff)
+        self.assertTrue(diff.endswith(b'$ '))
+        other = Screen(10, 3)
+        other.feed(b'a\r\nb\r\n')
+        other.feed(diff)
+        self.assertEqual(self.get_lines(other), self.get_lines(screen))
+
+    def test_untrusted(self):
+        screen = Screen(10, 3)
+        # What the client terminal shows before the first clear is unknown.
+        self.assertFalse(screen.trusted)
+        screen.feed(b'a\r\n')
+        self.assertIsNone(screen.take_raw_snapshot())
+        screen.feed(b'\x1b[2J')
+        self.assertTrue(screen.trusted)
+        screen.feed(b'\x1b[?6h')
+        self.assertFalse(screen.trusted)
+        self.assertIsNone(screen.take_raw_snapshot())
+        screen.feed(b'\x1b[H\x1b[2J')
+        self.assertTrue(screen.trusted)
+
+@unittest.skipIf(ssh2 is None, 'ssh2 needs python2')
+class TestMsgHelper(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger(os.devnull, False)
+        self.msg_helpers = []
+        self.fhs = []
+
+    def tearDown(self):
+        for msg_helper in self.msg_helpers:
+            msg_helper.close()
+            with msg_helper.write_cond:
+                while msg_helper.writing:
+                    msg_helper.write_cond.wait()
+        # Readers stop at EOF.
+        for fh in self.fhs[1::2]:
+            fh.close()
+
+    def open_msg_helpers(self, window_size=4 * 1024 * 1024):
+        """ Return two MsgHelpers connected by pipes. """
+        fds = os.pipe() + os.pipe()
+        self.fhs = [os.fdopen(fds[0], 'rb'), os.fdopen(fds[1], 'wb', 0),
+                    os.fdopen(fds[2], 'rb'), os.fdopen(fds[3], 'wb', 0)]
+        self.msg_helpers = [
+            ssh2.MsgHelper(self.fhs[2], self.fhs[1], self.logger, window_size=window_size),
+            ssh2.MsgHelper(self.fhs[0], self.fhs[3], self.logger, window_size=window_size)]
+        return self.msg_helpers
+
+    def start_thread(self, target):
+        def run():
+            try:
+                target()
+            except EOFError:
+                pass
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_job_msg_credits(self):
+        a, b = self.open_msg_helpers(window_size=1000)
+        read_queue = CreditQueue(lambda size: b.write_credit_msg(1, size), grant_size=100)
+        def read_msgs():
+            # Only returns non G msgs.
+            a.read_msg()
+        def read_job_msgs():
+            while True:
+                msg_type, msg_data = b.read_msg()
+                read_queue.put(msg_data.split(' ', 1)[1])
+        def write_job_msgs():
+            # Take many times the window, which stalls if credits leak.
+            for i in range(2000):
+                a.write_job_msg(1, 'x' * 10)
+        def take_job_msgs():
+            for i in range(2000):
+                data.append(read_queue.get())
+        data = []
+        self.start_thread(read_msgs)
+        self.start_thread(read_job_msgs)
+        self.start_thread(write_job_msgs)
+        thread = self.start_thread(take_job_msgs)
+        thread.join(10)
+        self.assertEqual(data, ['x' * 10] * 2000)
+        # All credits are granted back.
+        for i in range(100):
+            if a.credits[1] == 1000:
+                break
+            time.sleep(0.05)
+        self.assertEqual(a.credits[1], 1000)
+
+    def test_background_send(self):
+        a, b = self.open_msg_helpers()
+        def close_job_function(job_id):
+            a.close_channel(job_id)
+            a.write_close_job_msg(job_id)
+        cmd_interface = FileClientCmdInterface(
+            a.write_file_msg, self.logger, 'test_tmp/cache',
+            write_job_line_function=a.write_job_msg, close_job_function=close_job_function,
+            grant_credit_function=a.write_credit_msg)
+        def read_client_msgs():
+            while True:
+                msg_type, msg_data = a.read_msg()
+                if msg_type == 'J':
+                    job_id, data = msg_data.split(' ', 1)
+                    cmd_interface.add_job_input(int(job_id), data)
+        def run_job_server(job_id, read_queue):
+            def write_line_function(data):
+                b.write_job_msg(job_id, data)
+            def read_line_function():
+                data = read_queue.get()
+                if data is None:
+                    raise FileTransferJobEnd()
+                return data
+            try:
+                FileServer(write_line_function, read_line_function, self.logger).run()
+            except FileTransferJobEnd:
+                pass
+        def read_server_msgs():
+            # Like SSHServer, serve each job by a FileServer.
+            read_queues = {}
+            while True:
+                msg_type, msg_data = b.read_msg()
+                if msg_type == 'J':
+                    job_id, data = msg_data.split(' ', 1)
+                    job_id = int(job_id)
+                    if job_id not in read_queues:
+                        read_queue = CreditQueue(
+                            lambda size, job_id=job_id: b.write_credit_msg(job_id, size))
+                        read_queues[job_id] = read_queue
+                        self.start_thread(
+                            lambda job_id=job_id, read_queue=read_queue:
+                                run_job_server(job_id, read_queue))
+                    read_queues[job_id].put(data)
+                elif msg_type == 'K':
+                    job_id = int(msg_data)
+                    read_queues.pop(job_id).close()
+                    b.close_channel(job_id)
+        self.start_thread(read_client_msgs)
+        self.start_thread(read_server_msgs)
+        remove('test_tmp')
+        mkdir('test_tmp')
+        src = os.path.abspath('test_tmp/src')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(8 * 1024 * 1024))
+        cmd_interface.run_cmd('send %s %s &' % (src, src + '.dst'))
+        cmd_interface.run_cmd('wait')
+        # Data of the job isn't dropped after the job is done.
+        self.assertEqual(os.path.getsize(src + '.dst'), os.path.getsize(src))
+        remove('test_tmp')
+
+    def test_rate_limit_payload(self):
+        lines = []
+        file_base = FileBase(lines.append, None, self.logger)
+        rate_limiter = RateLimiter()
+        file_base.rate_limiters = [rate_limiter]
+        file_base.write_item('cmd', 'send_file')
+        file_base.write_data_items(b'x' * 20000)
+        file_base.write_skip_item(4096)
+        # Rates count file data, not hex encoded lines.
+        self.assertEqual(rate_limiter.total_size, 20000 + 4096)
+        self.assertEqual(len(lines), 4)
+
+    def test_parse_forward_spec(self):
+        self.assertEqual(ssh2.parse_forward_spec('8080:localhost:80'),
+                         ('127.0.0.1', 8080, 'localhost', 80))
+        self.assertEqual(ssh2.parse_forward_spec('0.0.0.0:8080:10.0.0.1:80'),
+                         ('0.0.0.0', 8080, '10.0.0.1', 80))
+        for spec in ['8080', 'localhost:80', '8080:localhost:http', 'a:1:b:2:c']:
+            self.assertRaises(ValueError, ssh2.parse_forward_spec, spec)
+
+    def get_free_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def open_port_forwarders(self):
+        """ Return the client and server PortForwarders of two MsgHelpers. """
+        # Larger than the grant size of CreditQueue and the max data size of a msg.
+        a, b = self.open_msg_helpers(window_size=512 * 1024)
+        client = ssh2.PortForwarder(a, self.logger)
+        server = ssh2.PortForwarder(b, self.logger)
+        def read_msgs(msg_helper, port_forwarder):
+            while True:
+                msg_type, msg_data = msg_helper.read_msg()
+                if msg_type == 'N':
+                    conn_id, host, port = msg_data.split()
+                    port_forwarder.open_connection(int(conn_id), host, int(port))
+                elif msg_type == 'D':
+                    conn_id, data = msg_data.split(' ', 1)
+                    port_forwarder.add_data(int(conn_id), data)
+                elif msg_type == 'X':
+                    port_forwarder.end_data(int(msg_data))
+        self.start_thread(lambda: read_msgs(a, client))
+        self.start_thread(lambda: read_msgs(b, server))
+        return client, server
+
+    def connect_forward(self, client, target_port):
+        port = self.get_free_port()
+        client.listen('%d:127.0.0.1:%d' % (port, target_port))
+        sock = socket.create_connection(('127.0.0.1', port), 10)
+        sock.settimeout(10)
+        return sock
+
+    def recv_size(self, sock, size):
+        data = []
+        while size:
+            new_data = sock.recv(size)
+            if not new_data:
+                break
+            data.append(new_data)
+            size -= len(new_data)
+        return ''.join(data)
+
+    def recv_all(self, sock):
+        data = []
+        while True:
+            new_data = sock.recv(4096)
+            if not new_data:
+                return ''.join(data)
+            data.append(new_data)
+
+    def test_forward_echo(self):
+        client, server = self.open_port_forwarders()
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(('127.0.0.1', 0))
+        listen_sock.listen(1)
+        def run_echo_server():
+            sock = listen_sock.accept()[0]
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                sock.sendall(data)
+            # Still writable after the peer shuts down writing.
+            sock.sendall('bye')
+            sock.close()
+        self.start_thread(run_echo_server)
+        sock = self.connect_forward(client, listen_sock.getsockname()[1])
+        sock.sendall('hello')
+        self.assertEqual(sock.recv(4096), 'hello')
+        # Data larger than the window waits for credits.
+        data = os.urandom(2 * 1024 * 1024)
+        self.start_thread(lambda: sock.sendall(data))
+        self.assertTrue(self.recv_size(sock, len(data)) == data)
+        sock.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.recv_all(sock), 'bye')
+        sock.close()
+        listen_sock.close()
+        for i in range(100):
+            if not client.conns and not server.conns:
+                break
+            time.sleep(0.05)
+        self.assertEqual((client.conns, server.conns), ({}, {}))
+
+    def test_forward_refused(self):
+        client, server = self.open_port_forwarders()
+        sock = self.connect_forward(client, self.get_free_port())
+        self.assertEqual(self.recv_all(sock), '')
+        sock.close()
+
+
 def main():
     unittest.main(failfast=True)
 
@@ -1,11 +1,17 @@
+import collections
+import errno
 import fcntl
+import hashlib
 import os
 import re
+import select
+import stat
 import struct
 import subprocess
 import sys
 import termios
 import threading
+import time
 import tty
 
 def expand_path(path):
@@ -22,6 +28,13 @@ def load_config(config_path, config):
                     continue
                 config[items[0].strip()] = items[1].strip()
 
+def get_hosts(config, hosts):
+    """ Return hosts of a group configured like group.web=host1, host2, or
+        hosts in a comma separated list.
+    """
+    value = config.get('group.' + hosts, hosts)
+    return [host.strip() for host in value.split(',') if host.strip()]
+
 def log_exit(msg):
     sys.stderr.write(msg + '\n')
     sys.exit(1)
@@ -99,6 +112,258 @@ def get_file_type(path):
         result.append('executable')
     return result
 
+def get_file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+if sys.platform == 'darwin':
+    SEEK_DATA, SEEK_HOLE = 4, 3
+else:
+    SEEK_DATA, SEEK_HOLE = 3, 4
+
+def get_data_extents(fd, size):
+    """ Return [(offset, length)] of data regions in a file, holes are omitted.
+        Return the whole file if the file system can't report holes.
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # No data after offset.
+                    break
+                raise
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        extents = [(0, size)]
+    os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+def parse_size(s):
+    """ Parse sizes like 512, 100K, 2M, 1G. """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    s = s.strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def format_size(size):
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024 or unit == 'G':
+            break
+        size /= 1024.0
+    return ('%d%s' if unit == '' else '%.1f%s') % (size, unit)
+
+class RateLimiter(object):
+    """ Token bucket limiting bytes per second, rate 0 means unlimited.
+        It also records the achieved rate.
+    """
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        # All below are protected by self.lock.
+        self.rate = rate
+        self.tokens = 0.0
+        self.last_time = time.time()
+        self.total_size = 0
+        self.start_time = None
+        self.end_time = None
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = 0.0
+            self.last_time = time.time()
+
+    def get_rate(self):
+        with self.lock:
+            return self.rate
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            if self.start_time is None:
+                self.start_time = now
+            self.total_size += size
+            if self.rate <= 0:
+                self.end_time = now
+                return
+            capacity = max(self.rate / 10.0, 8192)
+            self.tokens = min(capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= size
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.end_time = now + wait_time
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def get_achieved_rate(self):
+        with self.lock:
+            if self.start_time is None or self.end_time <= self.start_time:
+                return 0
+            return self.total_size / (self.end_time - self.start_time)
+
+class OutputRing(object):
+    """ Keep the last max_size bytes of output, data is addressed by offsets
+        counted from the start of the output.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+        self.end_offset = 0
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        self.end_offset += len(data)
+        while self.size - len(self.chunks[0]) >= self.max_size:
+            self.size -= len(self.chunks.popleft())
+
+    def get_since(self, offset):
+        """ Return (start_offset, data) of the data after offset. start_offset is
+            bigger than offset if some of the data were dropped.
+        """
+        start_offset = self.end_offset - self.size
+        offset = min(max(offset, start_offset), self.end_offset)
+        return offset, b''.join(self.chunks)[offset - start_offset:]
+
+def find_tools(names):
+    """ Return names of the executables found in PATH. """
+    paths = os.environ.get('PATH', '').split(os.pathsep)
+    return [name for name in names
+            if any(os.access(os.path.join(path, name), os.X_OK) for path in paths)]
+
+def select_compress_dict(paths, dict_size=32768, max_samples=64):
+    """ Select a dictionary for compressing small files from heads of sampled
+        files, like license headers and imports shared by source files.
+    """
+    samples = paths[::max(1, len(paths) // max_samples)][:max_samples]
+    head_size = dict_size // len(samples)
+    data = []
+    for path in samples:
+        with open(path, 'rb') as f:
+            data.append(f.read(head_size))
+    return b''.join(data)
+
+def get_tree_size(path):
+    """ Return (size, file_count) of regular files in path, links aren't followed. """
+    if os.path.islink(path):
+        return 0, 0
+    if os.path.isfile(path):
+        return os.path.getsize(path), 1
+    size = 0
+    file_count = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            st = os.lstat(os.path.join(root, f))
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+                file_count += 1
+    return size, file_count
+
+def get_head_end(f, size, lines):
+    """ Return the end offset of the first lines of file f. """
+    f.seek(0)
+    offset = 0
+    count = 0
+    while count < lines:
+        block = f.read(65536)
+        if not block:
+            break
+        i = -1
+        while count < lines:
+            i = block.find(b'\n', i + 1)
+            if i == -1:
+                break
+            count += 1
+        offset += len(block) if i == -1 else i + 1
+    return min(offset, size)
+
+def get_tail_start(f, size, lines):
+    """ Return the start offset of the last lines of file f, the newline at
+        the end of the file doesn't start a line.
+    """
+    if lines <= 0:
+        return size
+    offset = size
+    if size:
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            offset -= 1
+    count = 0
+    while offset > 0:
+        block_start = max(0, offset - 65536)
+        f.seek(block_start)
+        block = f.read(offset - block_start)
+        i = len(block)
+        while True:
+            i = block.rfind(b'\n', 0, i)
+            if i == -1:
+                break
+            count += 1
+            if count == lines:
+                return block_start + i + 1
+        offset = block_start
+    return 0
+
+def watch_file(path):
+    """ Return an inotify fd readable when path is modified, moved or deleted,
+        or None if inotify isn't supported.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+    mask = 0x2 | 0x4 | 0x400 | 0x800
+    if libc.inotify_add_watch(fd, path if isinstance(path, bytes) else path.encode('utf-8'),
+                              mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def wait_file_change(path, size, timeout, inode=None):
+    """ Wait until the size of path isn't size, or its inode isn't inode if
+        set, return False on timeout. A missing path is waited for. The file
+        is checked when inotify reports a change, and polled to find files
+        replaced by log rotation.
+    """
+    def get_size_and_inode():
+        try:
+            st = os.stat(path)
+            return st.st_size, st.st_ino if inode is not None else None
+        except OSError:
+            return size, inode
+    end_time = time.time() + timeout
+    fd = watch_file(path)
+    try:
+        while get_size_and_inode() == (size, inode):
+            wait_time = end_time - time.time()
+            if wait_time <= 0:
+                return False
+            if fd is None:
+                time.sleep(min(wait_time, 0.5))
+            elif select.select([fd], [], [], min(wait_time, 1))[0]:
+                os.read(fd, 4096)
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
 def get_script_dir():
     return os.path.dirname(os.path.realpath(__file__))
 